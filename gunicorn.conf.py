@@ -1,5 +1,7 @@
 # gunicorn.conf.py
 import os
+import subprocess
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -17,3 +19,9 @@ loglevel = 'debug'
 accesslog = '/tmp/log/gunicorn/access_log_tex'
 acceslogformat ="%(h)s %(l)s %(u)s %(t)s %(r)s %(s)s %(b)s %(f)s %(a)s"
 errorlog =  '/tmp/log/gunicorn/error_log_tex'
+
+
+def on_starting(server):
+    # Apply schema migrations once, before any worker boots (workers only check them). This runs in its own process,
+    # so the arbiter never imports the app and its connection pool before forking
+    subprocess.run([sys.executable, '-m', 'src.backend.migrations'], check=True)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from .scoring import _strip_prefix, score_tag_counts
+from .spans import Segment, compress_tags
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of worker processes used to score pairs; 0 or 1 scores in the calling process
+AGREEMENT_WORKERS = int(os.environ.get("AGREEMENT_WORKERS", 0))
+# Pairs sent to a worker at once
+AGREEMENT_CHUNKSIZE = int(os.environ.get("AGREEMENT_CHUNKSIZE", 16))
+
+
+class PackedTags(NamedTuple):
+    """Character-level tags of a save, without B-/I- prefixes, as runs
+
+    Run `i` covers positions `[bounds[i], bounds[i + 1])` and has the tags `vocab[labels[i]]`. The vocabulary is in
+    order of first occurrence.
+    """
+
+    bounds: np.ndarray
+    labels: np.ndarray
+    vocab: tuple[tuple[str, ...], ...]
+
+    @property
+    def length(self) -> int:
+        return int(self.bounds[-1])
+
+
+def pack_segments(segments: list[Segment]) -> PackedTags:
+    """Packs contiguous tag runs (see `spans.compute_tag_segments`) for scoring"""
+    index: dict[tuple[str, ...], int] = {}
+    bounds, labels = [0], []
+    for start, end, tags in segments:
+        label = index.setdefault(tuple(_strip_prefix(t) for t in tags), len(index))
+        # Runs differing only by prefix are merged
+        if labels and labels[-1] == label:
+            bounds[-1] = end
+        else:
+            labels.append(label)
+            bounds.append(end)
+    return PackedTags(np.array(bounds, dtype=np.int64), np.array(labels, dtype=np.int64), tuple(index))
+
+
+def pack_tags(char_tags: list[list[str]]) -> PackedTags:
+    """Packs one tag list per character for scoring"""
+    return pack_segments(compress_tags(char_tags))
+
+
+def _class_table(packed: PackedTags, classes: list[str]) -> np.ndarray:
+    table = np.zeros((len(packed.vocab), len(classes)), dtype=bool)
+    for i, labels in enumerate(packed.vocab):
+        for c, cls in enumerate(classes):
+            table[i, c] = cls in labels
+    return table
+
+
+def score_classes(sys: PackedTags, ref: PackedTags, tags: list[str]) -> list[str]:
+    """Classes scored by `score_packed`, in the same order as `scoring.compute_annotation_score`
+
+    The order depends on string hashes, which differ between processes, so it is always worked out by the caller.
+    """
+    # Iterating the vocabularies in order of first occurrence gives the same class order as the unpacked scorer
+    ref_present = set(l for labels in ref.vocab for l in labels)
+    sys_present = set(l for labels in sys.vocab for l in labels)
+    return list(set(tags).intersection(ref_present.union(sys_present)))
+
+
+def score_packed(sys: PackedTags, ref: PackedTags, tags: list[str], classes: Optional[list[str]] = None) -> dict:
+    """Same as `scoring.compute_annotation_score` on the unpacked tags, in time proportional to the number of runs
+
+    Parameters
+    ----------
+    sys, ref : PackedTags
+        System and reference tags
+    tags : list[str]
+        Tags to score
+    classes : list[str], optional
+        Output of `score_classes`, computed here if not given
+
+    Returns
+    -------
+    dict
+        `f1`, `precision`, `recall` and `per_tag`, see `scoring.score_tag_counts`
+    """
+    assert sys.length == ref.length, "System and reference must be the same length!"
+    if classes is None:
+        classes = score_classes(sys, ref, tags)
+
+    # Split both sides on the union of their run boundaries, so every piece has a single label on each side
+    bounds = np.union1d(sys.bounds, ref.bounds)
+    starts, widths = bounds[:-1], np.diff(bounds)
+    sys_hits = _class_table(sys, classes)[sys.labels[np.searchsorted(sys.bounds, starts, side="right") - 1]]
+    ref_hits = _class_table(ref, classes)[ref.labels[np.searchsorted(ref.bounds, starts, side="right") - 1]]
+
+    tp = widths @ (sys_hits & ref_hits)
+    pred = widths @ sys_hits
+    true = widths @ ref_hits
+    return score_tag_counts(tp, pred, true, sys.length, classes)
+
+
+def _score_job(job: tuple[PackedTags, PackedTags, list[str]], tags: list[str]) -> dict:
+    return score_packed(*job[:2], tags, classes=job[2])
+
+
+class AgreementEngine:
+    """Scores (system, reference) pairs of saves, fanned out over a process pool
+
+    Parameters
+    ----------
+    workers : int
+        Number of worker processes; with 0 or 1, pairs are scored in the calling process
+    chunksize : int
+        Number of pairs sent to a worker at once
+    """
+
+    def __init__(self, workers: int, chunksize: int = AGREEMENT_CHUNKSIZE):
+        self.workers = workers
+        self.chunksize = chunksize
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._pool_pid: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        # Like the DB pool, never share a pool across a fork; workers are spawned so they don't inherit our threads
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self.workers, mp_context=get_context("spawn"))
+                self._pool_pid = os.getpid()
+            return self._pool
+
+    def score_pairs(self, pairs: list[tuple[PackedTags, PackedTags]], tags: list[str]) -> list[dict]:
+        """Scores every `(sys, ref)` pair, in order"""
+        if self.workers <= 1 or len(pairs) <= 1:
+            return [score_packed(sys, ref, tags) for sys, ref in pairs]
+        jobs = [(sys, ref, score_classes(sys, ref, tags)) for sys, ref in pairs]
+        return list(self._executor().map(_score_job, jobs, repeat(tags), chunksize=self.chunksize))
+
+    def score_groups(self, groups: list[tuple[list[str], list[PackedTags]]], tags: list[str]) -> list[dict]:
+        """Scores each user's save against every other user's save, for each group of saves
+
+        Parameters
+        ----------
+        groups : list[tuple[list[str], list[PackedTags]]]
+            User and tags of every save in each group; a user's first save is the one scored
+        tags : list[str]
+            Tags to score
+
+        Returns
+        -------
+        list[dict]
+            For each group, `f1` with the average F1 of each save (None when no other user annotated the group) and
+            `pairs` with the scores of each `(sys, ref)` pair of save indices
+        """
+        # Every distinct pair across all groups is scored in a single fan out
+        jobs = []
+        layout = []
+        for userids, packed in groups:
+            pairs: dict[tuple[int, int], int] = {}
+            refs_per_save = []
+            for userid in userids:
+                sys_idx = userids.index(userid)
+                refs = []
+                for ref_idx, user in enumerate(userids):
+                    if user != userid:
+                        if (sys_idx, ref_idx) not in pairs:
+                            pairs[(sys_idx, ref_idx)] = len(jobs)
+                            jobs.append((packed[sys_idx], packed[ref_idx]))
+                        refs.append(pairs[(sys_idx, ref_idx)])
+                refs_per_save.append(refs)
+            layout.append((pairs, refs_per_save))
+
+        scores = self.score_pairs(jobs, tags)
+        return [
+            dict(
+                f1=[sum(scores[j]["f1"] for j in refs) / len(refs) if len(refs) else None for refs in refs_per_save],
+                pairs={pair: scores[j] for pair, j in pairs.items()},
+            )
+            for pairs, refs_per_save in layout
+        ]
+
+    def group_f1(
+        self, groups: list[tuple[list[str], list[PackedTags]]], tags: list[str]
+    ) -> list[list[Optional[float]]]:
+        """Average F1 of each save in each group, see `score_groups`"""
+        return [group["f1"] for group in self.score_groups(groups, tags)]
+
+    def shutdown(self):
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown()
+            self._pool = None
+
+
+engine = AgreementEngine(AGREEMENT_WORKERS)
+
+
+def agreement_report(tags: list[str], fileid: Optional[str] = None, workers: int = AGREEMENT_WORKERS) -> list[dict]:
+    """Per-user and pairwise agreement over every group of final saves
+
+    Uses (and fills) the same stored per-save inputs as the dashboard.
+    """
+    from .data import _dashboard_inputs, _final_saves, _save_key
+    from .data_utils import get_connection
+
+    groups: dict[tuple, list[dict]] = {}
+    with get_connection() as conn:
+        for save in _final_saves(conn):
+            if fileid is None or save["fileid"] == fileid:
+                groups.setdefault((save["fileid"], save["start"], save["end"]), []).append(save)
+        keys = sorted(groups)
+        inputs = [[_dashboard_inputs(conn, save) for save in groups[key]] for key in keys]
+
+    report_engine = engine if workers == engine.workers else AgreementEngine(workers)
+    try:
+        scores = report_engine.score_groups(
+            [([save["initial_userid"] for save in groups[key]], packed) for key, packed in zip(keys, inputs)], tags
+        )
+    finally:
+        if report_engine is not engine:
+            report_engine.shutdown()
+
+    report = []
+    for (fileid, start, end), group in zip(keys, scores):
+        saves = groups[(fileid, start, end)]
+        report.append(
+            dict(
+                fileid=fileid,
+                start=start,
+                end=end,
+                saves=[dict(zip(("userid", "savename", "timestamp"), _save_key(save))) for save in saves],
+                userid=[save["initial_userid"] for save in saves],
+                f1=group["f1"],
+                pairs=[dict(sys=sys, ref=ref, **score) for (sys, ref), score in group["pairs"].items()],
+            )
+        )
+    return report
+
+
+def main():
+    from .data import DASHBOARD_TAGS
+
+    parser = argparse.ArgumentParser(description="Corpus-wide inter-annotator agreement over final saves")
+    parser.add_argument("--tags", default=";".join(DASHBOARD_TAGS), help="semicolon-separated tags to score")
+    parser.add_argument("--fileid", default=None, help="only report on this file")
+    parser.add_argument("--workers", type=int, default=AGREEMENT_WORKERS or os.cpu_count(), help="worker processes")
+    parser.add_argument("--output", default="-", help="path of the JSON report, or - for stdout")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    report = agreement_report(args.tags.split(";"), fileid=args.fileid, workers=args.workers)
+    logger.info(f"Scored {len(report)} groups in {time.perf_counter() - start:.2f}s")
+    if args.output == "-":
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
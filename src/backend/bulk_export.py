@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""Exports many saves at once, tokenized and aligned like `/annotations/export`, as shards of JSONL or Parquet
+
+Usage: python -m src.backend.bulk_export exports/final --tokenizer EleutherAI/llemma_7b --format parquet
+"""
+import argparse
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import get_context
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from .scoring import align_segments_to_tokens
+from .tokenization import DEFAULT_TOKENIZER, get_tokenizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of worker processes tokenizing and writing shards; 0 or 1 exports in the calling process
+EXPORT_WORKERS = int(os.environ.get("EXPORT_WORKERS", os.cpu_count() or 1))
+# Saves per shard
+EXPORT_SHARD_SIZE = int(os.environ.get("EXPORT_SHARD_SIZE", 500))
+FORMATS = ("jsonl", "parquet")
+
+
+class SaveSelection(NamedTuple):
+    """Which saves to export; lists are OR'd, everything else is AND'd
+
+    `since` and `until` bound the save's timestamp (inclusive and exclusive). Deleted saves and saves without
+    annotations are never exported.
+    """
+
+    final: bool = True
+    userids: tuple[str, ...] = ()
+    fileids: tuple[str, ...] = ()
+    since: Optional[str] = None
+    until: Optional[str] = None
+    autosaves: bool = False
+
+
+def select_saves(selection: SaveSelection) -> list[dict]:
+    """`fileid`, `userid`, `savename` and `timestamp` of every selected save, oldest first"""
+    from .data_utils import query_db
+
+    conditions = ["s.deleted = 0"]
+    if selection.final:
+        conditions.append("s.final = 1")
+    if not selection.autosaves:
+        conditions.append("s.autosave = 0")
+    if selection.userids:
+        conditions.append("s.userid = ANY(%(userids)s)")
+    if selection.fileids:
+        conditions.append("s.fileid = ANY(%(fileids)s)")
+    if selection.since is not None:
+        conditions.append('s."timestamp" >= %(since)s')
+    if selection.until is not None:
+        conditions.append('s."timestamp" < %(until)s')
+    query = (
+        """SELECT s.fileid, s.userid, s.savename, s."timestamp"
+           FROM saves s
+           WHERE """
+        + " AND ".join(conditions)
+        + """ AND EXISTS (SELECT 1 FROM annotations a WHERE a.fileid = s.fileid AND a.timestamp = s.timestamp)
+           ORDER BY s."timestamp", s.fileid, s.userid, s.savename;"""
+    )
+    params = dict(
+        userids=list(selection.userids), fileids=list(selection.fileids), since=selection.since, until=selection.until
+    )
+    return query_db(query, params)
+
+
+def _export_record(tokenizer, save: dict, inputs: tuple) -> dict:
+    annotations, tex, segments, begin, end = inputs
+    tokens = tokenizer(tex, add_special_tokens=False, return_offsets_mapping=True)
+    token_tags = align_segments_to_tokens(tokens, segments)
+    names = tokenizer.convert_ids_to_tokens(tokens["input_ids"])
+    return dict(
+        **save, iob_tags=list(zip(names, token_tags)), annotations=annotations, tex=tex, begin=begin, end=end
+    )
+
+
+def _write_parquet(path: Path, records: list[dict]):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    # Annotations and endpoints have no fixed schema, so they're kept as JSON
+    table = pa.table(
+        {
+            "fileid": [r["fileid"] for r in records],
+            "userid": [r["userid"] for r in records],
+            "savename": [r["savename"] for r in records],
+            "timestamp": [r["timestamp"] for r in records],
+            "tokens": [[token for token, _ in r["iob_tags"]] for r in records],
+            "tags": [[tags for _, tags in r["iob_tags"]] for r in records],
+            "tex": [r["tex"] for r in records],
+            "annotations": [json.dumps(r["annotations"]) for r in records],
+            "begin": [json.dumps(r["begin"]) for r in records],
+            "end": [json.dumps(r["end"]) for r in records],
+        }
+    )
+    pq.write_table(table, path, compression="zstd")
+
+
+def _write_shard(path: str, format: str, tokenizer_id: str, saves: list[dict], inputs: list[tuple]) -> dict:
+    """Tokenizes and writes one shard, then returns its manifest entry; runs in the export workers"""
+    tokenizer = get_tokenizer(tokenizer_id)
+    records = [_export_record(tokenizer, save, save_inputs) for save, save_inputs in zip(saves, inputs)]
+
+    path = Path(path)
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    if format == "parquet":
+        _write_parquet(tmp, records)
+    else:
+        with open(tmp, "w") as f:
+            for record in records:
+                f.write(json.dumps(record) + "\n")
+    os.replace(tmp, path)
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return dict(file=path.name, rows=len(records), bytes=path.stat().st_size, sha256=digest.hexdigest())
+
+
+def _load_shard_inputs(saves: list[dict]) -> tuple[list[dict], list[tuple], list[dict]]:
+    """Annotations, text, tag runs and endpoints of each save, as the export would compute them"""
+    from .data import _export_inputs
+
+    loaded, inputs, failed = [], [], []
+    for save in saves:
+        try:
+            # The workers tokenize without the token cache, so they don't need the digest and offset
+            inputs.append(_export_inputs(save["fileid"], save["userid"], save["timestamp"])[:5])
+            loaded.append(save)
+        except Exception as e:
+            logger.error(f"failed to load {save}: {e}")
+            failed.append(save)
+    return loaded, inputs, failed
+
+
+def export_params(selection: SaveSelection, tokenizer_id: str, format: str, shard_size: int) -> dict:
+    """Parameters of an export, as recorded in its manifest"""
+    params = dict(selection=selection._asdict(), tokenizer=tokenizer_id, format=format, shard_size=shard_size)
+    return json.loads(json.dumps(params))
+
+
+def export_id(params: dict, saves: list[dict]) -> str:
+    """Stable name for an export with these parameters, of exactly these saves (see `select_saves`)"""
+    return hashlib.sha256(json.dumps([params, saves], sort_keys=True).encode()).hexdigest()[:16]
+
+
+def read_manifest(output_dir: str) -> Optional[dict]:
+    try:
+        return json.loads(Path(output_dir, "manifest.json").read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def _write_manifest(output_dir: Path, manifest: dict):
+    path = Path(output_dir, "manifest.json")
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(manifest, indent=2))
+    os.replace(tmp, path)
+
+
+def bulk_export(
+    output_dir: str,
+    selection: SaveSelection = SaveSelection(),
+    tokenizer_id: str = DEFAULT_TOKENIZER,
+    format: str = "jsonl",
+    shard_size: int = EXPORT_SHARD_SIZE,
+    workers: int = EXPORT_WORKERS,
+    saves: Optional[list[dict]] = None,
+) -> dict:
+    """Exports the selected saves to `output_dir` and returns the manifest
+
+    The saves are listed once, in `manifest.json`, and split into shards of `shard_size`. Each shard is recorded in the
+    manifest once its file is written, so running the same export again picks up from the shards that are left.
+
+    Workers tokenize and write shards while this process loads the saves of the next ones. The loading (annotations
+    from the database, text from S3) is serial: the workers are spawned without `data`, whose import fetches the
+    database credentials. So only tokenizing, encoding and writing scale with `workers`.
+
+    Parameters
+    ----------
+    output_dir : str
+        Directory of the shards and manifest
+    selection : SaveSelection
+        Saves to export
+    tokenizer_id : str
+        Tokenizer the tags are aligned to
+    format : str
+        One of `FORMATS`
+    shard_size : int
+        Saves per shard
+    workers : int
+        Number of worker processes; with 0 or 1, shards are written in the calling process
+    saves : list[dict], optional
+        Output of `select_saves` for `selection`, if already known; ignored when resuming
+
+    Returns
+    -------
+    dict
+        The manifest: export parameters, saves, `shards` with the file, rows, size, digest and saves that failed to
+        load of each one, and all the saves that failed in `failed`
+    """
+    if format not in FORMATS:
+        raise ValueError(f"unknown export format {format}, expected one of {FORMATS}")
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(Path(output_dir, "export.lock"), "w") as lock:
+        # Raises BlockingIOError if another process is running this export
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return _bulk_export(output_dir, selection, tokenizer_id, format, shard_size, workers, saves)
+
+
+def _bulk_export(
+    output_dir: Path,
+    selection: SaveSelection,
+    tokenizer_id: str,
+    format: str,
+    shard_size: int,
+    workers: int,
+    saves: Optional[list[dict]],
+) -> dict:
+    params = export_params(selection, tokenizer_id, format, shard_size)
+    manifest = read_manifest(output_dir)
+    if manifest is not None and manifest["params"] != params:
+        raise ValueError(f"{output_dir} holds an export with different parameters: {manifest['params']}")
+    if manifest is None:
+        saves = select_saves(selection) if saves is None else saves
+        manifest = dict(params=params, saves=saves, shards={}, failed=[], complete=False)
+        _write_manifest(output_dir, manifest)
+
+    saves = manifest["saves"]
+    shards = [saves[start : start + shard_size] for start in range(0, len(saves), shard_size)]
+    pending = [
+        i
+        for i in range(len(shards))
+        if str(i) not in manifest["shards"] or not Path(output_dir, manifest["shards"][str(i)]["file"]).exists()
+    ]
+    logger.info(f"Exporting {len(saves)} saves: {len(shards) - len(pending)} of {len(shards)} shards already done")
+
+    start = time.perf_counter()
+
+    def finish(i: int, entry: dict, failed: list[dict]):
+        # Kept per shard, so a shard that is written again replaces its failures rather than adding to them
+        manifest["shards"][str(i)] = dict(entry, failed=failed)
+        shard_entries = [manifest["shards"][key] for key in sorted(manifest["shards"], key=int)]
+        manifest["failed"] = [save for shard_entry in shard_entries for save in shard_entry["failed"]]
+        _write_manifest(output_dir, manifest)
+        logger.info(f"Wrote {entry['file']} ({entry['rows']} saves)")
+
+    def job(i: int):
+        loaded, inputs, failed = _load_shard_inputs(shards[i])
+        path = str(Path(output_dir, f"shard-{i:05d}.{format}"))
+        return (path, format, tokenizer_id, loaded, inputs), failed
+
+    if workers <= 1 or len(pending) <= 1:
+        for i in pending:
+            args, failed = job(i)
+            finish(i, _write_shard(*args), failed)
+    else:
+        # Spawned like the agreement workers; only a couple of shards per worker are loaded ahead
+        workers = min(workers, len(pending))
+        with ProcessPoolExecutor(workers, mp_context=get_context("spawn")) as pool:
+            queue = list(pending)
+            running = {}
+            while queue or running:
+                while queue and len(running) < 2 * workers:
+                    i = queue.pop(0)
+                    args, failed = job(i)
+                    running[pool.submit(_write_shard, *args)] = (i, failed)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    i, failed = running.pop(future)
+                    finish(i, future.result(), failed)
+
+    manifest["complete"] = True
+    manifest["rows"] = sum(entry["rows"] for entry in manifest["shards"].values())
+    _write_manifest(output_dir, manifest)
+    logger.info(f"Exported {manifest['rows']} saves in {time.perf_counter() - start:.1f}s")
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("output_dir", help="directory of the shards and manifest; rerun with it to resume")
+    parser.add_argument("--all-saves", action="store_true", help="export saves that aren't final too")
+    parser.add_argument("--autosaves", action="store_true", help="export autosaves too")
+    parser.add_argument("--userid", action="append", default=[], help="only export saves of this user (repeatable)")
+    parser.add_argument("--fileid", action="append", default=[], help="only export saves of this file (repeatable)")
+    parser.add_argument("--since", default=None, help="only export saves from this timestamp on")
+    parser.add_argument("--until", default=None, help="only export saves before this timestamp")
+    parser.add_argument("--tokenizer", default=DEFAULT_TOKENIZER, help="tokenizer the tags are aligned to")
+    parser.add_argument("--format", choices=FORMATS, default="jsonl")
+    parser.add_argument("--shard-size", type=int, default=EXPORT_SHARD_SIZE, help="saves per shard")
+    parser.add_argument("--workers", type=int, default=EXPORT_WORKERS, help="worker processes")
+    args = parser.parse_args()
+
+    selection = SaveSelection(
+        final=not args.all_saves,
+        userids=tuple(args.userid),
+        fileids=tuple(args.fileid),
+        since=args.since,
+        until=args.until,
+        autosaves=args.autosaves,
+    )
+    manifest = bulk_export(args.output_dir, selection, args.tokenizer, args.format, args.shard_size, args.workers)
+    print(f"{manifest['rows']} saves in {len(manifest['shards'])} shards, {len(manifest['failed'])} failed")
+
+
+if __name__ == "__main__":
+    main()
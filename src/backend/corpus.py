@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Keeps a local copy of the definition library (textbooks and papers) in sync with where it comes from"""
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, NamedTuple
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of documents downloaded at once
+CORPUS_SYNC_WORKERS = int(os.environ.get("CORPUS_SYNC_WORKERS", 8))
+# Seconds between checks of the sources for new or changed documents
+CORPUS_SYNC_TTL = float(os.environ.get("CORPUS_SYNC_TTL", 600))
+
+
+class CorpusSource(NamedTuple):
+    """Where documents of one type come from
+
+    `list` returns the current version (e.g. an ETag) of every document by name, and `fetch(name, version, path)`
+    writes that version of the document to `path`.
+    """
+
+    type: str
+    list: Callable[[], dict[str, str]]
+    fetch: Callable[[str, str, Path], None]
+
+
+class CorpusSync:
+    """Local copy of the documents of every source, as `<name>.tex` files in `tex_dir`
+
+    `sync.json` records the version each file was downloaded at, so only new or changed documents are downloaded, and
+    its modification time is when the sources were last checked.
+
+    Parameters
+    ----------
+    tex_dir : str
+        Directory of the local copy
+    sources : list[CorpusSource]
+        Sources of the documents, in the order their files are listed
+    workers : int
+        Number of documents downloaded at once
+    ttl : float
+        Seconds before the sources are checked again
+    """
+
+    def __init__(
+        self,
+        tex_dir: str,
+        sources: list[CorpusSource],
+        workers: int = CORPUS_SYNC_WORKERS,
+        ttl: float = CORPUS_SYNC_TTL,
+    ):
+        self.tex_dir = Path(tex_dir)
+        self.sources = sources
+        self.workers = workers
+        self.ttl = ttl
+        self.manifest_path = Path(tex_dir, "sync.json")
+
+    def path(self, name: str) -> Path:
+        return Path(self.tex_dir, name).with_suffix(".tex")
+
+    def due(self) -> bool:
+        """Whether the sources haven't been checked in the last `ttl` seconds"""
+        try:
+            return time.time() - self.manifest_path.stat().st_mtime >= self.ttl
+        except OSError:
+            return True
+
+    def _read_manifest(self) -> dict[str, str]:
+        try:
+            return json.loads(self.manifest_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _write_manifest(self, manifest: dict[str, str]):
+        tmp = self.manifest_path.with_name(f"{self.manifest_path.name}.{os.getpid()}.tmp")
+        tmp.write_text(json.dumps(manifest))
+        os.replace(tmp, self.manifest_path)
+
+    def _fetch(self, source: CorpusSource, name: str, version: str) -> bool:
+        path = self.path(name)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            source.fetch(name, version, tmp)
+            os.replace(tmp, path)
+            return True
+        except Exception as e:
+            logger.error(f"failed to get {name}: {e}")
+            tmp.unlink(missing_ok=True)
+            return False
+
+    def sync(self) -> list[tuple[str, str]]:
+        """Downloads new and changed documents, and returns the `(path, type)` of every document
+
+        A document that fails to download keeps its previous copy, if any, and is retried on the next sync. Files of
+        documents no longer listed by their source are removed. If a source can't be listed, nothing changes and the
+        error is raised, but the sources aren't checked again until `ttl` seconds later.
+        """
+        self.tex_dir.mkdir(exist_ok=True, parents=True)
+        recorded = self._read_manifest()
+        try:
+            listed = [(source, source.list()) for source in self.sources]
+        except Exception:
+            # Rewriting the manifest as it was counts as a check, so an outage isn't retried on every call
+            self._write_manifest(recorded)
+            raise
+
+        files = []
+        manifest = {}
+        pending = []
+        for source, versions in listed:
+            for name, version in versions.items():
+                files.append((str(self.path(name)), source.type))
+                key = f"{source.type}/{name}"
+                if recorded.get(key) == version and self.path(name).exists():
+                    manifest[key] = version
+                else:
+                    pending.append((source, name, version))
+
+        if pending:
+            logger.info(f"Downloading {len(pending)} new or changed documents...")
+            with ThreadPoolExecutor(max(min(self.workers, len(pending)), 1)) as pool:
+                fetched = list(pool.map(lambda job: self._fetch(*job), pending))
+            for (source, name, version), ok in zip(pending, fetched):
+                if ok:
+                    manifest[f"{source.type}/{name}"] = version
+
+        current = {path for path, _ in files}
+        for key in recorded.keys() - manifest.keys():
+            name = key.split("/", maxsplit=1)[1]
+            if str(self.path(name)) not in current:
+                self.path(name).unlink(missing_ok=True)
+
+        self._write_manifest(manifest)
+        return files
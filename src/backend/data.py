@@ -1,22 +1,41 @@
 #!/usr/bin/env python3
 from collections import defaultdict
+from datetime import datetime
+from itertools import islice
+import hashlib
+import json
 import logging
-from typing import Optional
+import os
+from typing import Any, Callable, Iterator, Optional
 
 import pandas as pd
-import psycopg
 import randomname
 import uuid
 from pprint import pprint
-from psycopg.rows import dict_row
-from transformers import AutoTokenizer, PreTrainedTokenizer
-
-from .data_utils import CONN_STR, load_tex, parse_timestamp, query_db, list_s3_documents
-from .scoring import align_annotations_to_tokens, compute_annotation_score
+from psycopg.types.json import Jsonb
+from transformers import AutoTokenizer, BatchEncoding, PreTrainedTokenizer
+
+from .agreement import PackedTags, engine, pack_segments
+from .data_utils import (
+    get_connection,
+    load_tex_digest,
+    parse_timestamp,
+    query_db,
+    list_s3_documents,
+    tex_cache,
+    token_cache,
+)
+from .scoring import align_segments_to_token_ranges, align_segments_to_tokens
+from .spans import Segment, compress_tags, compute_tag_segments, expand_segments
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger()
 
+# Tags (or characters of text) encoded at once when streaming an export
+EXPORT_BATCH = int(os.environ.get("EXPORT_BATCH", 8192))
+# Max number of score/diff results kept in `result_cache`; 0 disables it
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", 10000))
+
 
 def load_anno_from_annoid(annoid: str):
     query = """SELECT * FROM annotations WHERE annoid = %(annoid)s;"""
@@ -67,94 +86,82 @@ def get_initial_user_from_savename(savename: str):
     return query_db(query, dict(savename=savename))[0]
 
 
-def load_all_annotations(fileid: str):
-    """Loads all annotations"""
-    query = """
+# Annotation columns which the loaders group on; rows with a null in any of them are skipped
+ANNOTATION_GROUP_COLUMNS = ("annoid", "fileid", "start", "end", "tag", "text", "color")
+
+
+def _link_object(columns: tuple[str, ...], prefix: Optional[str] = None) -> tuple[str, str]:
+    """SQL for one link as a JSON object with `columns` (in that order), and the filter skipping incomplete links
+
+    Source and target ids are prepended with the `prefix` parameter if given.
+    """
+    fields = []
+    for col in columns:
+        value = f'l."{col}"'
+        if prefix is not None and col in ("source", "target"):
+            value = f"{prefix} || {value}"
+        fields.append(f"'{col}', {value}")
+    complete = " AND ".join(f'l."{col}" IS NOT NULL' for col in columns)
+    return f"json_build_object({', '.join(fields)})", complete
+
+
+def _annotations_query(link_columns: tuple[str, ...], join: str, where: str, prefix: Optional[str] = None) -> str:
+    """Loads annotations with their outgoing links nested as a JSON list, one row per annotation, in annoid order"""
+    link, complete = _link_object(link_columns, prefix)
+    annoid = "a.annoid" if prefix is None else f"{prefix} || a.annoid"
+    group = ", ".join(f'a."{col}"' for col in ANNOTATION_GROUP_COLUMNS)
+    order = ", ".join(
+        f'a."{col}"' if col in ("start", "end") else f'a."{col}" COLLATE "C"' for col in ANNOTATION_GROUP_COLUMNS
+    )
+    not_null = " AND ".join(f'a."{col}" IS NOT NULL' for col in ANNOTATION_GROUP_COLUMNS)
+    return f"""
         SELECT
-            a.annoid, a.fileid, a.start, a.end, a.tag, a.text, a.color,
-            l.start AS link_start, l.end AS link_end,
-            l.tag AS link_tag, l.source AS link_source, l.target AS link_target,
-            l.fileid AS link_fileid, l.color AS link_color
+            {annoid} AS annoid, a.fileid, a.start, a."end", a.tag, a.text, a.color,
+            COALESCE(json_agg({link} ORDER BY l.linkid) FILTER (WHERE {complete}), '[]'::json) AS links
         FROM annotations a
         LEFT JOIN links l
-        ON a.annoid = l.source
-        WHERE a.timestamp = (SELECT MAX("timestamp") FROM annotations WHERE fileid = a.fileid)
-          AND a.fileid != %(fileid)s;
+            {join}
+        WHERE {where}
+          AND {not_null}
+        GROUP BY {group}
+        ORDER BY {order};
     """
 
-    # Query for annotations, but we don't care about user or file id
-    annotations = query_db(query, params=dict(fileid=fileid))
-    if len(annotations) == 0:
-        return []
-
-    annotations = pd.DataFrame.from_records(annotations)
 
-    grouped = (
-        annotations.groupby(["annoid", "fileid", "start", "end", "tag", "text", "color"])[
-            [
-                "link_start",
-                "link_end",
-                "link_tag",
-                "link_fileid",
-                "link_source",
-                "link_target",
-            ]
-        ]
-        .apply(
-            lambda s: pd.Series(
-                {
-                    "links": s[
-                        [
-                            "link_start",
-                            "link_end",
-                            "link_tag",
-                            "link_fileid",
-                            "link_source",
-                            "link_target",
-                        ]
-                    ]
-                    .reset_index(drop=True)
-                    .rename(columns=lambda x: x.strip("link_"))
-                    .dropna()
-                    .to_dict(orient="records")
-                }
-            )
-        )
-        .reset_index()
+def load_all_annotations(fileid: str):
+    """Loads all annotations of the latest save of every other file"""
+    query = _annotations_query(
+        ("start", "end", "tag", "fileid", "source", "target"),
+        join="ON a.annoid = l.source",
+        where="""(a.fileid, a.timestamp) IN (
+            SELECT fileid, "timestamp" FROM latest_saves WHERE fileid != %(fileid)s
+          )""",
     )
-    return grouped.to_dict(orient="records")
+
+    # Query for annotations, but we don't care about user or file id
+    return query_db(query, params=dict(fileid=fileid))
 
 
 def load_annotations(fileid, userid, timestamp=None, add_timestamp_to_ids: bool = False):
     # use most recent save by default
     if not timestamp:
         result = query_db(
-            """SELECT MAX("timestamp") FROM annotations WHERE fileid = %(fileid)s AND userid = %(userid)s;""",
+            """
+            SELECT MAX("timestamp") AS "timestamp" FROM annotations WHERE fileid = %(fileid)s AND userid = %(userid)s;
+            """,
             params=dict(fileid=fileid, userid=userid),
         )
-        result = pd.DataFrame.from_records(result)
-        if len(result) == 0 or result.iloc[0] is None:
+        if len(result) == 0 or result[0]["timestamp"] is None:
             return []
-        timestamp = result.iloc[0][result.columns[0]]
-
-    query = """
-        SELECT
-          a.annoid, a.fileid, a.start, a.end, a.tag, a.text, a.color,
-          l.start AS link_start, l.end AS link_end, l.tag AS link_tag,
-          l.source AS link_source, l.target AS link_target, l.fileid AS link_fileid, l.color AS link_color,
-          s.final AS final
-        FROM annotations a
-        LEFT JOIN links l
-            ON a.annoid = l.source
-            AND a.timestamp = l.timestamp
-        LEFT JOIN saves s
-            ON a.savename = s.savename
-            AND a.timestamp = s.timestamp
-            AND a.userid = s.userid
-            AND a.fileid = s.fileid
-        WHERE a.fileid = %(fileid)s
-        AND a.timestamp = %(timestamp)s;
-    """
+        timestamp = result[0]["timestamp"]
+
+    # The diff view prefixes ids with the save's timestamp, so that annotations of different saves don't collide
+    query = _annotations_query(
+        ("source", "target", "start", "color", "end", "tag", "fileid"),
+        join="ON a.annoid = l.source AND a.timestamp = l.timestamp",
+        where="a.fileid = %(fileid)s AND a.timestamp = %(timestamp)s",
+        prefix="%(prefix)s::text" if add_timestamp_to_ids else None,
+    )
 
     # For some reason, somewhere in the process the timestamp is being mangled
     # so it's no longer interpretable by psycopg.
@@ -163,126 +170,145 @@ def load_annotations(fileid, userid, timestamp=None, add_timestamp_to_ids: bool
     # know why...I think the only difference is the lack of a '+' before the
     # timezone 00 at the end, which may be mangled by over HTTP.
     parsed = parse_timestamp(timestamp)
-    params = dict(fileid=fileid, userid=userid, timestamp=parsed)
+    params = dict(fileid=fileid, userid=userid, timestamp=parsed, prefix=timestamp)
 
     # Query for annotations, but we don't care about user or file id
-    annotations = query_db(query, params=params)
-    if len(annotations) == 0:
-        return []
-
-    annotations = pd.DataFrame.from_records(annotations)
-    grouped = annotations.groupby(["annoid", "fileid", "start", "end", "tag", "text", "color"])[
-        [
-            "link_source",
-            "link_target",
-            "link_start",
-            "link_color",
-            "link_end",
-            "link_tag",
-            "link_fileid",
-        ]
-    ].apply(
-        lambda s: pd.Series(
-            {
-                "links": s.reset_index(drop=True)
-                .rename(columns=lambda x: x.strip("link_"))
-                .dropna()
-                .to_dict(orient="records")
-            }
+    return query_db(query, params=params)
+
+
+ANNOTATION_COLUMNS = ("annoid", "fileid", "userid", "start", "end", "text", "tag", "color", "savename", "autosave")
+ANNOTATION_CONFLICT = 'fileid,userid,start,"end",tag,savename,"timestamp",autosave'
+LINK_COLUMNS = ("fileid", "userid", "start", "end", "tag", "color", "source", "target")
+LINK_CONFLICT = 'fileid,userid,start,"end",tag,source,target,"timestamp"'
+
+
+def _bulk_insert(conn, table: str, columns: tuple[str, ...], rows: list[tuple], conflict: str):
+    """Inserts many rows into `table` with one set-based statement
+
+    The rows are streamed into a temporary staging table with COPY and then moved into `table` with a single
+    ``INSERT ... SELECT ... ON CONFLICT DO NOTHING``, so duplicates are skipped exactly like the old row-by-row
+    inserts. Columns that aren't listed (e.g. "timestamp") take their defaults, which are evaluated once per
+    transaction.
+
+    Parameters
+    ----------
+    conn : psycopg.Connection
+        Open connection; the caller owns the transaction
+    table : str
+        Destination table
+    columns : tuple[str, ...]
+        Columns to fill, in the same order as each row
+    rows : list[tuple]
+        Rows to insert
+    conflict : str
+        Conflict target (the table's UNIQUE columns)
+    """
+    if len(rows) == 0:
+        return
+    cols = ", ".join(f'"{c}"' for c in columns)
+    staging = f"staging_{table}"
+    conn.execute(f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {cols} FROM {table} WITH NO DATA;")
+    with conn.cursor().copy(f"COPY {staging} ({cols}) FROM STDIN") as copy:
+        for row in rows:
+            copy.write_row(row)
+    conn.execute(
+        f"INSERT INTO {table} ({cols}) SELECT {cols} FROM {staging} ON CONFLICT({conflict}) DO NOTHING;"
+    )
+    conn.execute(f"DROP TABLE {staging};")
+
+
+def _update_latest_save(conn, fileid: str, exact: bool = False):
+    """Records the latest annotation timestamp of `fileid` in `latest_saves`
+
+    Inserts only ever move it forward, so concurrent saves can't roll it back; pass `exact` after deleting
+    annotations, which may have removed the latest ones.
+    """
+    update = 'EXCLUDED."timestamp"' if exact else 'GREATEST(latest_saves."timestamp", EXCLUDED."timestamp")'
+    conn.execute(
+        f"""
+        INSERT INTO latest_saves (fileid, "timestamp")
+            SELECT %(fileid)s, MAX("timestamp") FROM annotations WHERE fileid = %(fileid)s
+        ON CONFLICT (fileid) DO UPDATE SET "timestamp" = {update};
+        """,
+        dict(fileid=fileid),
+    )
+
+
+def _link_row(userid: str, ln: dict) -> tuple:
+    return (
+        ln["fileid"],
+        userid,
+        ln["start"],
+        ln["end"],
+        ln["tag"],
+        ln.get("color", "#d3d3d3"),
+        ln["source"],
+        ln["target"],
+    )
+
+
+def _save_rows(fileid: str, userid: str, savename: str, autosave: int, annotations: list[dict]):
+    """Flattens annotations (and their nested links) into rows for ANNOTATION_COLUMNS and LINK_COLUMNS"""
+    annotation_rows = []
+    link_rows = []
+    for an in annotations:
+        annotation_rows.append(
+            (
+                str(an.get("annoid", uuid.uuid4())),
+                fileid,
+                userid,
+                an["start"],
+                an["end"],
+                an["text"],
+                an["tag"],
+                an.get("color", "#d3d3d3"),
+                savename,
+                autosave,
+            )
         )
+        link_rows.extend(_link_row(userid, ln) for ln in an.get("links", []))
+    return annotation_rows, link_rows
+
+
+def _insert_save(
+    conn, fileid: str, userid: str, savename: str, autosave: int, start: int, end: int, annotations: list[dict]
+):
+    """Writes a full save (save row, annotations and links) and returns the save info"""
+    result = conn.execute(
+        """
+        INSERT INTO saves (start, "end", fileid, userid, savename, final, autosave)
+            VALUES (%(start)s, %(end)s, %(fileid)s, %(userid)s, %(savename)s, %(final)s, %(autosave)s)
+        ON CONFLICT(fileid, userid, savename, autosave, "timestamp") DO NOTHING
+        RETURNING "timestamp";
+        """,
+        dict(start=start, end=end, fileid=fileid, userid=userid, savename=savename, autosave=autosave, final=0),
     )
-    # assign the annotations to the current state
-    grouped = grouped.reset_index()
-    if add_timestamp_to_ids:
-        grouped["annoid"] = timestamp + grouped["annoid"]
-
-        def _update_link_with_timestamp(links):
-            result = []
-            for link in links:
-                new = {}
-                for key, val in link.items():
-                    if key == "source" or key == "target":
-                        new[key] = timestamp + val
-                    else:
-                        new[key] = val
-                result.append(new)
-            return result
+    top = result.fetchone()
 
-        grouped["links"] = grouped["links"].apply(lambda links: _update_link_with_timestamp(links))
-    return grouped.to_dict(orient="records")
+    annotation_rows, link_rows = _save_rows(fileid, userid, savename, autosave, annotations)
+    _bulk_insert(conn, "annotations", ANNOTATION_COLUMNS, annotation_rows, ANNOTATION_CONFLICT)
+    _bulk_insert(conn, "links", LINK_COLUMNS, link_rows, LINK_CONFLICT)
+    _update_latest_save(conn, fileid)
+
+    # Return timestamp if it exists
+    if top is not None:
+        stamp = top["timestamp"]
+    else:
+        stamp = conn.execute("""SELECT CURRENT_TIMESTAMP::timestamp AS "timestamp";""").fetchone()["timestamp"]
+    return {"timestamp": stamp, "savename": savename, "fileid": fileid, "userid": userid}
 
 
 def insert_predictions(fileid: str, predictions: list[dict], savename: str):
     userid = "ai-model"
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         # Create save if needed
         start = min([a["start"] for a in predictions])
         end = max([a["end"] for a in predictions])
-
-        conn.execute(
-            """
-            INSERT INTO saves (start, "end", fileid, userid, savename, final, autosave)
-                VALUES (%(start)s, %(end)s, %(fileid)s, %(userid)s, %(savename)s, %(final)s, %(autosave)s)
-            ON CONFLICT(fileid, userid, savename, autosave, "timestamp") DO NOTHING;
-            """,
-            dict(start=start, end=end, fileid=fileid, userid=userid, savename=savename, autosave=0, final=0),
-        )
-        # Insert new entries
-        for an in predictions:
-            links = an.get("links", [])
-            conn.execute(
-                """
-                INSERT INTO annotations (annoid, fileid, userid, start, "end", text, tag, color, savename, autosave)
-                    VALUES (%(annoid)s, %(fileid)s, %(userid)s, %(start)s, %(end)s, %(text)s, %(tag)s, %(color)s, %(savename)s, %(autosave)s)
-                ON CONFLICT(fileid,userid,start,"end",tag,savename,"timestamp",autosave) DO NOTHING;
-                """,
-                dict(
-                    annoid=an.get("annoid", uuid.uuid4()),
-                    fileid=fileid,
-                    userid=userid,
-                    start=an["start"],
-                    end=an["end"],
-                    text=an["text"],
-                    tag=an["tag"],
-                    color=an.get("color", "#d3d3d3"),
-                    savename=savename,
-                    autosave=0,
-                ),
-            )
-            # Insert all the links
-            for ln in links:
-                conn.execute(
-                    """
-                    INSERT INTO links (fileid, userid, start, "end", tag, color, source, target)
-                        VALUES (%(fileid)s, %(userid)s, %(start)s, %(end)s, %(tag)s, %(color)s, %(source)s, %(target)s)
-                    ON CONFLICT(fileid,userid,start,"end",tag,source,target,"timestamp") DO NOTHING;
-                    """,
-                    dict(
-                        fileid=ln["fileid"],
-                        userid=userid,
-                        start=ln["start"],
-                        end=ln["end"],
-                        tag=ln["tag"],
-                        color=ln.get("color", "#d3d3d3"),
-                        source=ln["source"],
-                        target=ln["target"],
-                    ),
-                )
-        result = conn.execute(
-            """SELECT "timestamp" FROM annotations WHERE savename = %(savename)s AND autosave = %(autosave)s;""",
-            dict(savename=savename, autosave=0),
-        )
-        top = result.fetchone()
-        # Return timestamp if it exists
-        if top is not None:
-            stamp = top["timestamp"]
-        else:
-            stamp = conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()["timestamp"]
-        return {"timestamp": stamp, "savename": savename, "fileid": fileid, "userid": userid}
+        return _insert_save(conn, fileid, userid, savename, 0, start, end, predictions)
 
 
 def insert_annotations(fileid, userid, annotations, autosave: int = 0, savename: str | None = None):
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         if not savename:
             savename = randomname.get_name()
 
@@ -304,91 +330,198 @@ def insert_annotations(fileid, userid, annotations, autosave: int = 0, savename:
         # Create save if needed
         start = [a["start"] for a in annotations if a["tag"] == "begin annotation"][0]
         end = [a["end"] for a in annotations if a["tag"] == "end annotation"][0]
-
+        return _insert_save(conn, fileid, userid, savename, int(autosave), start, end, annotations)
+
+
+def apply_autosave_delta(
+    fileid: str,
+    userid: str,
+    savename: str,
+    added: list[dict],
+    modified: list[dict],
+    removed: list[str],
+    added_links: list[dict],
+    removed_links: list[dict],
+):
+    """Applies an incremental change to an existing autosave
+
+    Only the touched rows are written, and everything happens in one transaction. Like a full autosave, the result
+    gets a new timestamp, so it is still the latest save; the untouched annotations and links are moved to it rather
+    than written again.
+
+    Parameters
+    ----------
+    fileid, userid, savename : str
+        Identify the autosave to update
+    added : list[dict]
+        New annotations, including their outgoing links
+    modified : list[dict]
+        Changed annotations; the stored copy and its outgoing links are replaced
+    removed : list[str]
+        Annotation ids to delete, along with their links in both directions
+    added_links : list[dict]
+        New links between existing annotations
+    removed_links : list[dict]
+        Links to delete, identified by `source` and `target`
+
+    Returns
+    -------
+    dict | None
+        Save info like `insert_annotations`, or None if there is no autosave to apply the delta to
+    """
+    with get_connection() as conn:
+        save = conn.execute(
+            """
+            SELECT "timestamp", final, start, "end" FROM saves
+            WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+              AND deleted = 0
+            ORDER BY "timestamp" DESC
+            LIMIT 1
+            FOR UPDATE;
+            """,
+            dict(fileid=fileid, userid=userid, savename=savename),
+        ).fetchone()
+        if save is None:
+            return None
+
+        # Move the autosave to a new timestamp, as re-inserting it would
+        previous = dict(fileid=fileid, userid=userid, savename=savename, timestamp=parse_timestamp(save["timestamp"]))
+        stamp = conn.execute(
+            """
+            UPDATE saves SET "timestamp" = CURRENT_TIMESTAMP
+            WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+              AND "timestamp" = %(timestamp)s
+            RETURNING "timestamp";
+            """,
+            previous,
+        ).fetchone()["timestamp"]
+        params = dict(fileid=fileid, userid=userid, savename=savename, timestamp=parse_timestamp(stamp))
         conn.execute(
             """
-            INSERT INTO saves (start, "end", fileid, userid, savename, final, autosave)
-                VALUES (%(start)s, %(end)s, %(fileid)s, %(userid)s, %(savename)s, %(final)s, %(autosave)s)
-            ON CONFLICT(fileid, userid, savename, autosave, "timestamp") DO NOTHING;
+            UPDATE annotations SET "timestamp" = %(new)s
+            WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+              AND "timestamp" = %(timestamp)s;
             """,
-            dict(
-                start=start, end=end, fileid=fileid, userid=userid, savename=savename, autosave=int(autosave), final=0
-            ),
+            dict(**previous, new=params["timestamp"]),
+        )
+        # Links have no savename, so they're found through their source annotations (already moved above)
+        conn.execute(
+            """
+            UPDATE links SET "timestamp" = %(new)s
+            WHERE userid = %(userid)s AND "timestamp" = %(timestamp)s AND source IN (
+              SELECT annoid FROM annotations
+              WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+                AND "timestamp" = %(new)s
+            );
+            """,
+            dict(**previous, new=params["timestamp"]),
+        )
+        # The dashboard's inputs for the old timestamp are stale either way
+        conn.execute(
+            """
+            DELETE FROM dashboard_inputs
+            WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s
+              AND "timestamp" = %(timestamp)s;
+            """,
+            previous,
         )
 
-        # Insert new entries
-        for an in annotations:
-            links = an["links"]
+        # Modified annotations are replaced wholesale, links included
+        dropped = list(removed) + [an["annoid"] for an in modified]
+        if len(dropped) > 0:
             conn.execute(
                 """
-                INSERT INTO annotations (annoid, fileid, userid, start, "end", text, tag, color, savename, autosave)
-                    VALUES (%(annoid)s, %(fileid)s, %(userid)s, %(start)s, %(end)s, %(text)s, %(tag)s, %(color)s, %(savename)s, %(autosave)s)
-                ON CONFLICT(fileid,userid,start,"end",tag,savename,"timestamp",autosave) DO NOTHING;
+                DELETE FROM annotations
+                WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+                  AND "timestamp" = %(timestamp)s AND annoid = ANY(%(annoids)s);
                 """,
-                dict(
-                    annoid=an["annoid"],
-                    fileid=fileid,
-                    userid=userid,
-                    start=an["start"],
-                    end=an["end"],
-                    text=an["text"],
-                    tag=an["tag"],
-                    color=an.get("color", "#d3d3d3"),
-                    savename=savename,
-                    autosave=int(autosave),
-                ),
+                dict(**params, annoids=dropped),
             )
-            # Insert all the links
-            for ln in links:
+            # Removed annotations also lose the links pointing at them; modified ones keep those
+            conn.execute(
+                """
+                DELETE FROM links
+                WHERE userid = %(userid)s AND "timestamp" = %(timestamp)s
+                  AND (source = ANY(%(annoids)s) OR target = ANY(%(removed)s));
+                """,
+                dict(**params, annoids=dropped, removed=list(removed)),
+            )
+        if len(removed_links) > 0:
+            conn.cursor().executemany(
+                """
+                DELETE FROM links
+                WHERE userid = %(userid)s AND "timestamp" = %(timestamp)s
+                  AND source = %(source)s AND target = %(target)s;
+                """,
+                [dict(**params, source=ln["source"], target=ln["target"]) for ln in removed_links],
+            )
+
+        annotation_rows, link_rows = _save_rows(fileid, userid, savename, 1, added + modified)
+        link_rows.extend(_link_row(userid, ln) for ln in added_links)
+        _bulk_insert(
+            conn,
+            "annotations",
+            ANNOTATION_COLUMNS + ("timestamp",),
+            [row + (stamp,) for row in annotation_rows],
+            ANNOTATION_CONFLICT,
+        )
+        _bulk_insert(
+            conn, "links", LINK_COLUMNS + ("timestamp",), [row + (stamp,) for row in link_rows], LINK_CONFLICT
+        )
+        _update_latest_save(conn, fileid, exact=len(dropped) > 0)
+
+        # Keep the save's bounds in sync if the begin/end markers moved
+        for an in added + modified:
+            if an["tag"] == "begin annotation":
                 conn.execute(
                     """
-                    INSERT INTO links (fileid, userid, start, "end", tag, color, source, target)
-                        VALUES (%(fileid)s, %(userid)s, %(start)s, %(end)s, %(tag)s, %(color)s, %(source)s, %(target)s)
-                    ON CONFLICT(fileid,userid,start,"end",tag,source,target,"timestamp") DO NOTHING;
+                    UPDATE saves SET start = %(start)s
+                    WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+                      AND "timestamp" = %(timestamp)s;
                     """,
-                    dict(
-                        fileid=ln["fileid"],
-                        userid=userid,
-                        start=ln["start"],
-                        end=ln["end"],
-                        tag=ln["tag"],
-                        color=ln.get("color", "#d3d3d3"),
-                        source=ln["source"],
-                        target=ln["target"],
-                    ),
+                    dict(**params, start=an["start"]),
                 )
-        result = conn.execute(
-            """SELECT "timestamp" FROM annotations WHERE savename = %(savename)s AND autosave = %(autosave)s;""",
-            dict(savename=savename, autosave=int(autosave)),
-        )
-        top = result.fetchone()
-        # Return timestamp if it exists
-        if top is not None:
-            stamp = top["timestamp"]
-        else:
-            stamp = conn.execute("SELECT CURRENT_TIMESTAMP").fetchone()["timestamp"]
-        return {"timestamp": stamp, "savename": savename, "fileid": fileid, "userid": userid}
+            elif an["tag"] == "end annotation":
+                conn.execute(
+                    """
+                    UPDATE saves SET "end" = %(end)s
+                    WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND autosave = 1
+                      AND "timestamp" = %(timestamp)s;
+                    """,
+                    dict(**params, end=an["end"]),
+                )
+
+    # A final autosave is on the dashboard, and may have moved to another group
+    if save["final"] == 1:
+        _refresh_dashboard_for_save(fileid, userid, savename, stamp, drop_inputs=True, previous=save)
+    return {"timestamp": stamp, "savename": savename, "fileid": fileid, "userid": userid}
 
 
 def delete_save(fileid, userid, savename, timestamp):
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         parsed = parse_timestamp(timestamp)
-        conn.execute(
+        deleted = conn.execute(
             """
             UPDATE saves
               SET deleted = 1
             WHERE fileid = %(fileid)s
               AND userid = %(userid)s
               AND savename = %(savename)s
-              AND "timestamp" = %(timestamp)s;
+              AND "timestamp" = %(timestamp)s
+            RETURNING final;
             """,
             dict(savename=savename, timestamp=parsed, fileid=fileid, userid=userid),
-        )
+        ).fetchall()
+        _invalidate_results(conn, fileid, parsed)
+
+    # Only final saves are on the dashboard
+    if any(row["final"] == 1 for row in deleted):
+        _refresh_dashboard_for_save(fileid, userid, savename, parsed)
 
 
 def finalize_save(fileid, userid, savename, timestamp):
     parsed = parse_timestamp(timestamp)
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         conn.execute(
             """
             UPDATE saves
@@ -400,82 +533,115 @@ def finalize_save(fileid, userid, savename, timestamp):
             """,
             dict(savename=savename, fileid=fileid, userid=userid, timestamp=parsed),
         )
-        return True
+        _invalidate_results(conn, fileid, parsed)
+    _refresh_dashboard_for_save(fileid, userid, savename, parsed)
+    return True
 
 
-def init_annotation_db():
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS annotations
-            (
-                rowid SERIAL PRIMARY KEY,
-                annoid TEXT,
-                fileid TEXT,
-                userid TEXT,
-                start INTEGER,
-                "end" INTEGER,
-                text TEXT,
-                tag TEXT,
-                color TEXT,
-                savename TEXT,
-                autosave INTEGER,
-                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE (fileid, userid, start, "end", tag, savename, "timestamp", autosave)
-            );
+def _save_ref(fileid: str, timestamp: datetime) -> str:
+    # Saves are matched on file and timestamp, however the timestamp was formatted
+    return f"{fileid}/{timestamp.isoformat()}"
+
+
+def _invalidate_results(conn, fileid: str, timestamp: datetime):
+    # Called after updating the save, so a result `cached_result` inserted meanwhile (which waits on the save's row
+    # lock, see `_save_states`) is committed and visible here
+    conn.execute("DELETE FROM result_cache WHERE %(save)s = ANY(saves);", dict(save=_save_ref(fileid, timestamp)))
+
+
+def _save_states(conn, saves: list[tuple[str, datetime]], lock: bool = False) -> list[dict]:
+    """Autosave, final and deleted flags of every save matching the `(fileid, timestamp)` pairs, in a stable order"""
+    return conn.execute(
         """
-        )
+        SELECT fileid, "timestamp", userid, savename, autosave, final, deleted FROM saves
+        WHERE (fileid, "timestamp") IN (SELECT * FROM unnest(%(fileids)s::text[], %(timestamps)s::timestamp[]))
+        ORDER BY fileid, "timestamp", userid, savename
+        """
+        + (" FOR SHARE;" if lock else ";"),
+        dict(fileids=[fileid for fileid, _ in saves], timestamps=[timestamp for _, timestamp in saves]),
+    ).fetchall()
+
+
+def cached_result(kind: str, params: dict, saves: list[tuple[str, str]], compute: Callable[[], Any]) -> Any:
+    """Result of `compute()`, cached in `result_cache` for as long as the saves it depends on stay as they are
+
+    Saves don't change once written, except autosaves (moved to a new timestamp) and the deleted and final flags, so
+    results involving an autosave aren't cached and the others are dropped when one of their saves is deleted or
+    (un)finalized. A result is also not cached if its saves changed while it was computed. The key also covers the
+    content of the files, which can change under the saves. Past `RESULT_CACHE_SIZE` results, the least recently used
+    ones are dropped.
+
+    Parameters
+    ----------
+    kind : str
+        What is computed, e.g. `score`
+    params : dict
+        JSON-serializable arguments of the computation, besides the saves
+    saves : list[tuple[str, str]]
+        `(fileid, timestamp)` of every save the result is computed from
+    compute : Callable[[], Any]
+        Computes the result, which must be JSON-serializable
+
+    Returns
+    -------
+    Any
+        The result, as computed or read back from the cache
+    """
+    if RESULT_CACHE_SIZE <= 0:
+        return compute()
+
+    digests = {fileid: load_tex_digest(fileid) for fileid, _ in saves}
+    key = json.dumps([kind, params, saves, digests], sort_keys=True)
+    key = hashlib.sha256(key.encode()).hexdigest()
+    parsed = [(fileid, parse_timestamp(timestamp)) for fileid, timestamp in saves]
+    with get_connection() as conn:
+        row = conn.execute(
+            "UPDATE result_cache SET used = CURRENT_TIMESTAMP WHERE key = %(key)s RETURNING result;", dict(key=key)
+        ).fetchone()
+        states = _save_states(conn, parsed)
+    if row is not None:
+        return json.loads(row["result"])
+
+    result = compute()
+    if any(state["autosave"] == 1 for state in states):
+        return result
+    with get_connection() as conn:
+        # Holds off deletes and (un)finalizations of the saves until the result is in, so they invalidate it
+        if _save_states(conn, parsed, lock=True) != states:
+            return result
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS links
-            (
-                linkid SERIAL PRIMARY KEY,
-                fileid TEXT,
-                userid TEXT,
-                start INTEGER,
-                "end" INTEGER,
-                tag TEXT,
-                color TEXT,
-                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                source TEXT,
-                target TEXT,
-                UNIQUE (fileid, userid, start, "end", tag, source, target, "timestamp")
-            );
-        """
+            INSERT INTO result_cache (key, saves, result) VALUES (%(key)s, %(saves)s, %(result)s)
+            ON CONFLICT (key) DO UPDATE SET result = EXCLUDED.result, used = CURRENT_TIMESTAMP;
+            """,
+            dict(key=key, saves=[_save_ref(*save) for save in parsed], result=json.dumps(result)),
         )
         conn.execute(
             """
-            CREATE TABLE IF NOT EXISTS saves
-            (
-                saveid SERIAL PRIMARY KEY,
-                savename TEXT,
-                start INTEGER,
-                "end" INTEGER,
-                fileid TEXT,
-                userid TEXT,
-                final INTEGER,
-                autosave INTEGER,
-                deleted INTEGER DEFAULT 0,
-                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                UNIQUE (savename, fileid, userid, autosave, "timestamp")
-            );
-        """
+            DELETE FROM result_cache
+            WHERE key IN (SELECT key FROM result_cache ORDER BY used DESC OFFSET %(size)s);
+            """,
+            dict(size=RESULT_CACHE_SIZE),
         )
+    return result
 
 
-def export_annotations(
+def _export_inputs(
     fileid,
     userid,
     timestamp: Optional[str] = None,
     export_whole_file: bool = False,
-    tokenizer: Optional[PreTrainedTokenizer] = None,
     begin: Optional[dict] = None,
     end: Optional[dict] = None,
-    ignore_annotation_endpoints: Optional[bool] = None,
 ):
+    """Annotations, exported text, tag runs over it, and begin/end annotations of a save
+
+    Also returns the content digest of the file and where the exported text starts in it, which identify the text
+    in the token cache.
+    """
     # annotations is a list of dicts, each containing an annotation. We want to format this into an IOB tagged block of text.
     annotations = load_annotations(fileid, userid, timestamp)
-    tex = load_tex(fileid)
+    tex, digest = tex_cache.load_with_digest(fileid)
 
     # Find the begin/end annotations, otherwise use the earliest and latest annotations
     if begin is None:
@@ -498,26 +664,28 @@ def export_annotations(
         offset = first_anno
 
     # Now, we generate character-level IOB tags, which we can then merge together to create word/token level ones.
-    iob_tags = [[] for _ in tex]
+    # They're computed as runs of identical tags and only expanded per character when exporting characters.
+    segments = compute_tag_segments(annotations, offset, len(tex))
+    return annotations, tex, segments, begin, end, digest, offset
 
-    for anno in annotations:
-        # Ignore begin/end markers
-        if anno["tag"] in ["begin annotation", "end annotation"]:
-            continue
 
-        for char_idx in range(anno["start"], anno["end"]):
-            prefix = "B-" if char_idx == anno["start"] else "I-"
-            if (char_idx - offset) < len(iob_tags):
-                iob_tags[char_idx - offset].append(prefix + anno["tag"])
-            # iob_tags[char_idx - offset].append(anno["tag"])
-
-    for tag in iob_tags:
-        if len(tag) == 0:
-            tag.append("O")
+def export_annotations(
+    fileid,
+    userid,
+    timestamp: Optional[str] = None,
+    export_whole_file: bool = False,
+    tokenizer: Optional[PreTrainedTokenizer] = None,
+    begin: Optional[dict] = None,
+    end: Optional[dict] = None,
+    ignore_annotation_endpoints: Optional[bool] = None,
+):
+    annotations, tex, segments, begin, end, digest, offset = _export_inputs(
+        fileid, userid, timestamp, export_whole_file, begin, end
+    )
 
     if tokenizer:
-        tokens = tokenizer(tex, add_special_tokens=False)
-        token_tags = align_annotations_to_tokens(tokens, char_tags=iob_tags)
+        tokens = token_cache.tokenize(tokenizer, tex, digest, offset)
+        token_tags = align_segments_to_tokens(tokens, segments)
 
         # Returns a list of (token, [tags])
         return {
@@ -530,6 +698,7 @@ def export_annotations(
             "end": end,
         }
 
+    iob_tags = expand_segments(segments)
     return {
         "iob_tags": [(char, tag) for char, tag in zip(tex, iob_tags)],
         "tex": tex,
@@ -539,31 +708,289 @@ def export_annotations(
     }
 
 
-def load_dashboard_data(tags: list[str]):
-    # Load all final saves
-    finals = load_saves(final=True)
-    df = pd.DataFrame.from_records(finals)
-    df["userid"] = df["savename"].apply(lambda item: get_initial_user_from_savename(item)["userid"])
-
-    # Export all the final annotations
-    annos = [export_annotations(save.fileid, save.userid, timestamp=save.timestamp) for idx, save in df.iterrows()]
-    df["annotations"] = annos
-
-    # Now, group by the key (fileid, start, end) and grab the user and annotations
-    save_ids = df.groupby(["fileid", "start", "end"])[["userid", "annotations"]].agg(list)
-    save_ids["f1"] = [[] for _ in range(len(save_ids))]
-    for saveid, row in save_ids.iterrows():
-        # For each user, grab their reference save files and compute the F1
-        for userid in row.userid:
-            refs = [anno for user, anno in zip(row.userid, row.annotations) if user != userid]
-            sys = [anno for user, anno in zip(row.userid, row.annotations) if user == userid][0]
-            tags_sys = [tag for text, tag in sys["iob_tags"]]
-
-            scores = []
-            for ref in refs:
-                tags_ref = [tag for text, tag in ref["iob_tags"]]
-                scores.append(compute_annotation_score(tags_sys, tags_ref, tags)["f1"])
-            user_avg_f1 = sum(scores) / len(scores) if len(scores) else None
-            save_ids.loc[saveid, "f1"].append(user_avg_f1)
-
-    return save_ids[["userid", "f1"]]
+def export_spans(
+    fileid,
+    userid,
+    timestamp: Optional[str] = None,
+    export_whole_file: bool = False,
+    tokenizer: Optional[PreTrainedTokenizer] = None,
+    begin: Optional[dict] = None,
+    end: Optional[dict] = None,
+    ignore_annotation_endpoints: Optional[bool] = None,
+):
+    """Same as `export_annotations`, with the tags as runs instead of one list per character or token
+
+    `spans` holds `(start, end, tags)` runs of identical tags covering every position, in characters of `tex` or,
+    with a tokenizer, in indices of `tokens`. `spans.decode_iob_tags` turns this back into the `iob_tags` of
+    `export_annotations`, and `scoring.compute_score_and_diff` scores it as is.
+    """
+    annotations, tex, segments, begin, end, digest, offset = _export_inputs(
+        fileid, userid, timestamp, export_whole_file, begin, end
+    )
+
+    exported = {"format": "spans"}
+    if tokenizer:
+        tokens = token_cache.tokenize(tokenizer, tex, digest, offset)
+        token_tags = align_segments_to_tokens(tokens, segments)
+        exported["tokens"] = tokenizer.convert_ids_to_tokens(tokens["input_ids"])[: len(token_tags)]
+        segments = compress_tags(token_tags)
+    exported["spans"] = segments
+    return dict(exported, tex=tex, annotations=annotations, begin=begin, end=end)
+
+
+def _iter_token_tags(
+    tokenizer: PreTrainedTokenizer, tokens: BatchEncoding, segments: list[Segment], batch: int
+) -> Iterator[tuple[str, list[str]]]:
+    """`(token, tags)` pairs of `export_annotations`, converting `batch` token ids at a time"""
+    token_ranges, range_tags = align_segments_to_token_ranges(tokens, segments)
+    for start in range(0, len(token_ranges), batch):
+        names = tokenizer.convert_ids_to_tokens(tokens["input_ids"][start : start + batch])
+        yield from zip(names, (range_tags[i] for i in token_ranges[start : start + batch].tolist()))
+
+
+def _json_list_chunks(items: Iterator, batch: int) -> Iterator[str]:
+    yield "["
+    for n, chunk in enumerate(iter(lambda: list(islice(items, batch)), [])):
+        yield (", " if n else "") + json.dumps(chunk)[1:-1]
+    yield "]"
+
+
+def _json_str_chunks(text: str, batch: int) -> Iterator[str]:
+    # Characters are escaped one by one, so the string can be cut anywhere
+    yield '"'
+    for start in range(0, len(text), batch):
+        yield json.dumps(text[start : start + batch])[1:-1]
+    yield '"'
+
+
+def _json_object_chunks(fields: list[tuple[str, Iterator[str]]]) -> Iterator[str]:
+    yield "{"
+    for n, (key, chunks) in enumerate(fields):
+        yield (", " if n else "") + json.dumps(key) + ": "
+        yield from chunks
+    yield "}"
+
+
+def stream_export_annotations(
+    fileid,
+    userid,
+    timestamp: Optional[str] = None,
+    export_whole_file: bool = False,
+    tokenizer: Optional[PreTrainedTokenizer] = None,
+    begin: Optional[dict] = None,
+    end: Optional[dict] = None,
+    ignore_annotation_endpoints: Optional[bool] = None,
+    batch: int = EXPORT_BATCH,
+) -> Iterator[str]:
+    """Same JSON as `json.dumps(export_annotations(...))`, encoded `batch` tags (or characters of text) at a time
+
+    The save is loaded before this returns, so errors are raised before anything is sent. The per-character (or
+    per-token) tags, and the token strings, are only generated a batch at a time as they're encoded; what is held for
+    the whole document is the text, its runs of tags and, with a tokenizer, its token ids and offsets.
+    """
+    annotations, tex, segments, begin, end, digest, offset = _export_inputs(
+        fileid, userid, timestamp, export_whole_file, begin, end
+    )
+
+    if tokenizer:
+        tokens = token_cache.tokenize(tokenizer, tex, digest, offset)
+        iob_tags = _iter_token_tags(tokenizer, tokens, segments, batch)
+        order = ["iob_tags", "annotations", "tex", "begin", "end"]
+    else:
+        iob_tags = ((char, tags) for start, stop, tags in segments for char in tex[start:stop])
+        order = ["iob_tags", "tex", "annotations", "begin", "end"]
+
+    values = {
+        "iob_tags": _json_list_chunks(iob_tags, batch),
+        "annotations": _json_list_chunks(iter(annotations), batch),
+        "tex": _json_str_chunks(tex, batch),
+        "begin": iter([json.dumps(begin)]),
+        "end": iter([json.dumps(end)]),
+    }
+    return _json_object_chunks([(key, values[key]) for key in order])
+
+
+# Tags scored on the dashboard
+DASHBOARD_TAGS = ["definition", "theorem", "proof", "example", "name"]
+
+
+def _final_saves(conn, fileid: Optional[str] = None, start: Optional[int] = None, end: Optional[int] = None):
+    """Final, non-deleted saves with annotations (newest first), along with the user who created the savename"""
+    conditions = ["s.final = 1", "s.deleted = 0", "s.start IS NOT NULL", 's."end" IS NOT NULL']
+    if fileid is not None:
+        conditions.append('s.fileid = %(fileid)s AND s.start = %(start)s AND s."end" = %(end)s')
+    query = (
+        """SELECT s.fileid, s.userid, s.savename, s."timestamp", s.start, s."end", initial.userid AS initial_userid
+           FROM saves s
+           JOIN LATERAL (
+             SELECT f.userid FROM saves f WHERE f.savename = s.savename ORDER BY f."timestamp" LIMIT 1
+           ) initial ON TRUE
+           WHERE """
+        + " AND ".join(conditions)
+        + """ AND EXISTS (
+             SELECT 1 FROM annotations a
+             WHERE a.fileid = s.fileid AND a.userid = s.userid AND a.timestamp = s.timestamp AND a.savename = s.savename
+           )
+           ORDER BY s."timestamp" DESC;"""
+    )
+    return conn.execute(query, dict(fileid=fileid, start=start, end=end)).fetchall()
+
+
+def _save_key(save: dict) -> list:
+    return [save["userid"], save["savename"], save["timestamp"]]
+
+
+def _dashboard_inputs(conn, save: dict) -> PackedTags:
+    """Character-level tags of a final save, exported once and then read back from `dashboard_inputs`"""
+    key = dict(fileid=save["fileid"], userid=save["userid"], savename=save["savename"], timestamp=save["timestamp"])
+    row = conn.execute(
+        """
+        SELECT segments FROM dashboard_inputs
+        WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s AND "timestamp" = %(timestamp)s
+          AND initial_userid = %(initial_userid)s;
+        """,
+        dict(**key, initial_userid=save["initial_userid"]),
+    ).fetchone()
+    if row is not None:
+        return pack_segments(row["segments"])
+
+    exported = export_annotations(save["fileid"], save["initial_userid"], timestamp=save["timestamp"])
+    segments = compress_tags([tag for text, tag in exported["iob_tags"]])
+    conn.execute(
+        """
+        INSERT INTO dashboard_inputs (fileid, userid, savename, "timestamp", initial_userid, segments)
+            VALUES (%(fileid)s, %(userid)s, %(savename)s, %(timestamp)s, %(initial_userid)s, %(segments)s)
+        ON CONFLICT (fileid, userid, savename, "timestamp")
+            DO UPDATE SET initial_userid = EXCLUDED.initial_userid, segments = EXCLUDED.segments;
+        """,
+        dict(**key, initial_userid=save["initial_userid"], segments=Jsonb(segments)),
+    )
+    return pack_segments(segments)
+
+
+def refresh_dashboard_groups(groups: list[tuple[str, int, int]], tags: list[str] = DASHBOARD_TAGS):
+    """Recomputes the dashboard entries of the given `(fileid, start, end)` groups
+
+    Saves that aren't final anymore lose their stored inputs, and a group is dropped once it has no final saves. The
+    pairs of all groups are scored together by the agreement engine.
+    """
+    with get_connection() as conn:
+        scored = []
+        for fileid, start, end in groups:
+            params = dict(fileid=fileid, start=start, end=end)
+            conn.execute(
+                """
+                DELETE FROM dashboard_inputs i
+                USING saves s
+                WHERE i.fileid = s.fileid AND i.userid = s.userid AND i.savename = s.savename
+                  AND i."timestamp" = s."timestamp"
+                  AND s.fileid = %(fileid)s AND s.start = %(start)s AND s."end" = %(end)s
+                  AND NOT (s.final = 1 AND s.deleted = 0);
+                """,
+                params,
+            )
+            saves = _final_saves(conn, fileid, start, end)
+            if len(saves) == 0:
+                conn.execute(
+                    """
+                    DELETE FROM dashboard_groups WHERE fileid = %(fileid)s AND start = %(start)s AND "end" = %(end)s;
+                    """,
+                    params,
+                )
+            else:
+                scored.append((params, saves))
+
+        f1 = engine.group_f1(
+            [
+                ([save["initial_userid"] for save in saves], [_dashboard_inputs(conn, save) for save in saves])
+                for _, saves in scored
+            ],
+            tags,
+        )
+        for (params, saves), group_f1 in zip(scored, f1):
+            conn.execute(
+                """
+                INSERT INTO dashboard_groups (fileid, start, "end", tags, members, userids, f1)
+                    VALUES (%(fileid)s, %(start)s, %(end)s, %(tags)s, %(members)s, %(userids)s, %(f1)s)
+                ON CONFLICT (fileid, start, "end") DO UPDATE
+                    SET tags = EXCLUDED.tags, members = EXCLUDED.members, userids = EXCLUDED.userids,
+                        f1 = EXCLUDED.f1, "updated" = CURRENT_TIMESTAMP;
+                """,
+                dict(
+                    **params,
+                    tags=Jsonb(list(tags)),
+                    members=Jsonb([_save_key(save) for save in saves]),
+                    userids=Jsonb([save["initial_userid"] for save in saves]),
+                    f1=Jsonb(group_f1),
+                ),
+            )
+
+
+def _refresh_dashboard_for_save(
+    fileid: str, userid: str, savename: str, timestamp, drop_inputs: bool = False, previous: Optional[dict] = None
+):
+    """Refreshes the dashboard group a save belongs to (and the one it was in before, given its previous `start` and
+    `end`); failures are logged since the dashboard heals on read"""
+    try:
+        with get_connection() as conn:
+            params = dict(fileid=fileid, userid=userid, savename=savename, timestamp=timestamp)
+            if drop_inputs:
+                conn.execute(
+                    """
+                    DELETE FROM dashboard_inputs
+                    WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s
+                      AND "timestamp" = %(timestamp)s;
+                    """,
+                    params,
+                )
+            groups = conn.execute(
+                """
+                SELECT DISTINCT start, "end" FROM saves
+                WHERE fileid = %(fileid)s AND userid = %(userid)s AND savename = %(savename)s
+                  AND "timestamp" = %(timestamp)s AND start IS NOT NULL AND "end" IS NOT NULL;
+                """,
+                params,
+            ).fetchall()
+        groups = {(group["start"], group["end"]) for group in groups}
+        if previous is not None and previous["start"] is not None and previous["end"] is not None:
+            groups.add((previous["start"], previous["end"]))
+        refresh_dashboard_groups([(fileid, start, end) for start, end in sorted(groups)])
+    except Exception:
+        logger.exception(f"Failed to refresh dashboard for {fileid}/{userid}/{savename}/{timestamp}")
+
+
+def load_dashboard_data(tags: list[str] = DASHBOARD_TAGS):
+    """Reads the dashboard from `dashboard_groups`
+
+    Groups are kept up to date by `finalize_save`/`delete_save`; any group whose final saves (or tags) don't match
+    what was stored is recomputed here, which also builds the table up the first time.
+    """
+    with get_connection() as conn:
+        saves = _final_saves(conn)
+        stored = conn.execute("""SELECT fileid, start, "end", tags, members FROM dashboard_groups;""").fetchall()
+
+    # Now, group by the key (fileid, start, end) and grab the saves
+    members = defaultdict(list)
+    for save in saves:
+        members[(save["fileid"], save["start"], save["end"])].append(_save_key(save))
+    stored = {(row["fileid"], row["start"], row["end"]): row for row in stored}
+
+    stale = [
+        group
+        for group in sorted(members.keys() | stored.keys())
+        if group not in stored
+        or stored[group]["members"] != members.get(group)
+        or stored[group]["tags"] != list(tags)
+    ]
+    if len(stale) > 0:
+        refresh_dashboard_groups(stale, tags=tags)
+
+    with get_connection() as conn:
+        rows = conn.execute(
+            """
+            SELECT fileid, start, "end", userids AS userid, f1 FROM dashboard_groups
+            ORDER BY fileid COLLATE "C", start, "end";
+            """
+        ).fetchall()
+    save_ids = pd.DataFrame.from_records(rows, columns=["fileid", "start", "end", "userid", "f1"])
+    return save_ids.set_index(["fileid", "start", "end"])[["userid", "f1"]]
@@ -1,13 +1,23 @@
 #!/usr/bin/env python3
+import hashlib
 import json
 import os
 import re
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
+from pathlib import Path
+from urllib.parse import quote
 
 import boto3
+import numpy as np
+from botocore.exceptions import ClientError
 import psycopg
 from psycopg.adapt import Loader
 from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+from transformers import BatchEncoding, PreTrainedTokenizer
 
 # Open aws session to s3
 session = boto3.client(
@@ -41,7 +51,7 @@ def parse_timestamp(t_str: str):
 
 
 def query_db(query, params=()):
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         results = conn.execute(query, params)
         records = [dict(r) for r in results]
     return records
@@ -62,32 +72,198 @@ CONN_STR = (
     f"host=postgres port=5432 dbname=annotations-db connect_timeout=10 user=postgres password='{POSTGRES_PASSWORD}'"
 )
 
+# Connection pool settings, one pool per gunicorn worker
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", 1))
+POOL_MAX_SIZE = int(os.environ.get("DB_POOL_MAX_SIZE", 8))
+POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", 300))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 30))
+
+_pool: ConnectionPool | None = None
+_pool_pid: int | None = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Returns this process' connection pool, opening it on first use.
+
+    The pool is keyed on the pid so that a pool created before gunicorn forks its workers is never shared between
+    them; each worker opens its own on the first query.
+    """
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ConnectionPool(
+                CONN_STR,
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_idle=POOL_MAX_IDLE,
+                timeout=POOL_TIMEOUT,
+                kwargs=dict(row_factory=dict_row),
+                check=ConnectionPool.check_connection,
+                name=f"tex-annotater-{os.getpid()}",
+                open=True,
+            )
+            _pool_pid = os.getpid()
+        return _pool
+
+
+def get_connection():
+    """Borrows a connection from the pool
+
+    Use as a context manager; the transaction is committed when the block exits (or rolled back on error) and the
+    connection is returned to the pool.
+    """
+    return get_pool().connection()
+
+
+def pool_stats() -> dict:
+    """Returns usage statistics for this worker's connection pool"""
+    if _pool is None or _pool_pid != os.getpid():
+        return {"pid": os.getpid(), "open": False}
+    stats = _pool.get_stats()
+    return {
+        "pid": os.getpid(),
+        "open": True,
+        "in_use": stats.get("pool_size", 0) - stats.get("pool_available", 0),
+        "waiting": stats.get("requests_waiting", 0),
+        "wait_ms": stats.get("requests_wait_ms", 0),
+        **stats,
+    }
+
 # S3 stuff
 
+TEX_BUCKET = "tex-annotation"
 
-def list_s3_documents():
-    docs = session.list_objects(Bucket="tex-annotation")["Contents"]
-    objs = [
-        {
-            "name": d["Key"].replace("texs/", ""),
-            "modified": d["LastModified"].strftime("'%y %b %d @%H:%M"),
-            "size": f"{int(d['Size']) / 1024:.1f}",
-        }
-        for d in docs
-        if d["Key"].startswith("texs/")
-    ]
 
-    result = []
-    for obj in objs:
-        name = obj["name"]
+DOCUMENT_CATALOGUE_TTL = float(os.environ.get("DOCUMENT_CATALOGUE_TTL", 300))
+
+
+class DocumentCatalogue:
+    """Parsed listing of every TeX document under the `texs/` prefix
+
+    The listing is paginated (so it isn't truncated at 1000 keys) and the parsed records are kept for `ttl` seconds,
+    after which the next access re-lists the bucket.
+
+    Parameters
+    ----------
+    client :
+        boto3 S3 client
+    bucket : str
+        Bucket to list
+    ttl : float
+        Seconds before the listing is refreshed
+    """
+
+    SORT_KEYS = ("name", "stem", "arxiv_id", "modified", "size")
+
+    def __init__(self, client, bucket: str, ttl: float, prefix: str = "texs/"):
+        self.client = client
+        self.bucket = bucket
+        self.ttl = ttl
+        self.prefix = prefix
+        self._entries: list[dict] = []
+        self._loaded_at = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _parse(obj: dict, prefix: str) -> dict:
+        name = obj["Key"].replace(prefix, "")
         if re.match(r"\d+\.\d+-", name):
             arxiv_id, stem = name.split("-", maxsplit=1)
             stem = stem.replace(".tex", "").replace(".mmd", "")
         else:
             arxiv_id = ""
             stem = name.replace(".tex", "").replace(".mmd", "")
-        result.append({"arxiv_id": arxiv_id, "stem": stem, **obj})
-    return result
+        return {
+            "record": {
+                "arxiv_id": arxiv_id,
+                "stem": stem,
+                "name": name,
+                "modified": obj["LastModified"].strftime("'%y %b %d @%H:%M"),
+                "size": f"{int(obj['Size']) / 1024:.1f}",
+            },
+            "last_modified": obj["LastModified"],
+            "bytes": int(obj["Size"]),
+            "etag": obj.get("ETag"),
+        }
+
+    def _entries_fresh(self) -> list[dict]:
+        with self._lock:
+            if self._loaded_at is None or time.time() - self._loaded_at >= self.ttl:
+                entries = []
+                paginator = self.client.get_paginator("list_objects_v2")
+                for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+                    entries.extend(self._parse(obj, self.prefix) for obj in page.get("Contents", []))
+                self._entries = entries
+                self._loaded_at = time.time()
+            return self._entries
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def documents(self) -> list[dict]:
+        return [e["record"] for e in self._entries_fresh()]
+
+    def versions(self) -> dict[str, str]:
+        """Maps each document name to its S3 ETag"""
+        return {e["record"]["name"]: e["etag"] for e in self._entries_fresh()}
+
+    def query(
+        self,
+        search: str = "",
+        sort: str = "",
+        descending: bool = False,
+        offset: int = 0,
+        limit: int | None = None,
+    ) -> tuple[int, list[dict]]:
+        """Filters, sorts and pages the catalogue
+
+        Parameters
+        ----------
+        search : str
+            Case-insensitive substring matched against the name, stem and arXiv id
+        sort : str
+            One of `SORT_KEYS`, or empty to keep the bucket order
+        descending : bool
+            Reverse the sort order
+        offset : int
+            Number of matching documents to skip
+        limit : int, optional
+            Max number of documents to return
+
+        Returns
+        -------
+        tuple[int, list[dict]]
+            Total number of matching documents, and the requested page of them
+        """
+        entries = self._entries_fresh()
+        if search:
+            needle = search.lower()
+            entries = [
+                e
+                for e in entries
+                if needle in e["record"]["name"].lower()
+                or needle in e["record"]["stem"].lower()
+                or needle in e["record"]["arxiv_id"]
+            ]
+        if sort == "modified":
+            entries = sorted(entries, key=lambda e: e["last_modified"], reverse=descending)
+        elif sort == "size":
+            entries = sorted(entries, key=lambda e: e["bytes"], reverse=descending)
+        elif sort in self.SORT_KEYS:
+            entries = sorted(entries, key=lambda e: e["record"][sort].lower(), reverse=descending)
+        elif descending:
+            entries = entries[::-1]
+        page = entries[offset : offset + limit if limit is not None else None]
+        return len(entries), [e["record"] for e in page]
+
+
+documents = DocumentCatalogue(session, TEX_BUCKET, DOCUMENT_CATALOGUE_TTL)
+
+
+def list_s3_documents():
+    return documents.documents()
 
 
 def load_pdf(pdf_key):
@@ -95,7 +271,388 @@ def load_pdf(pdf_key):
     return url
 
 
+class ByteLRUCache:
+    """Least-recently-used mapping bounded by the total size of its values rather than their count
+
+    Parameters
+    ----------
+    max_bytes : int
+        Budget for the sum of the sizes given to `put`
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.evictions = 0
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            self._items.move_to_end(key)
+            return self._items[key][0]
+
+    def put(self, key, value, nbytes: int):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+            # Anything bigger than the whole budget is never cached
+            if nbytes > self.max_bytes:
+                return
+            self._items[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, (_, size) = self._items.popitem(last=False)
+                self.nbytes -= size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            if key in self._items:
+                self.nbytes -= self._items.pop(key)[1]
+
+    def __len__(self):
+        return len(self._items)
+
+
+class DiskBudget:
+    """Bounds the total size of the files under a directory that several processes write to
+
+    Each process counts the bytes it writes; once that passes a tenth of the budget (and on its first write), it scans
+    the directory and deletes the least recently used files, by mtime, until the total is back within `max_bytes`.
+    Readers bump the mtime of what they read with `touch`. Between scans the directory can overshoot by up to a tenth
+    of the budget per writing process.
+
+    Parameters
+    ----------
+    root : str
+        Directory to bound, including its subdirectories
+    max_bytes : int
+        Budget for the total size of the files under `root`
+    """
+
+    # Temporary files younger than this are assumed to still be written to
+    TMP_GRACE = 3600
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._written = max_bytes // 10
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def touch(path: Path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def added(self, nbytes: int):
+        """Records a write of `nbytes`, pruning the directory if enough has been written since the last scan"""
+        with self._lock:
+            self._written += nbytes
+            if self._written < self.max_bytes // 10:
+                return
+            self._written = 0
+        self.prune()
+
+    def prune(self):
+        files = []
+        now = time.time()
+        for path in self.root.rglob("*"):
+            try:
+                st = path.stat()
+            except OSError:
+                continue
+            if not path.is_file() or (path.suffix == ".tmp" and now - st.st_mtime < self.TMP_GRACE):
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                # Already pruned by another process
+                continue
+            total -= size
+            self.evictions += 1
+
+
+TEX_CACHE_DIR = os.environ.get("TEX_CACHE_DIR", "/tmp/tex-cache")
+TEX_CACHE_BYTES = int(os.environ.get("TEX_CACHE_BYTES", 256 * 1024 * 1024))
+# Disk budget for the cached TeX sources in TEX_CACHE_DIR, shared by all workers
+TEX_CACHE_DISK_BYTES = int(os.environ.get("TEX_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+# Seconds a cached copy is trusted before revalidating it against S3
+TEX_CACHE_TTL = float(os.environ.get("TEX_CACHE_TTL", 30))
+
+
+class TexCache:
+    """Two-tier cache for the TeX sources in S3
+
+    Contents live in an in-memory LRU (bounded by `max_bytes`) in front of an on-disk store under `cache_dir` (bounded
+    by `max_disk_bytes`), both keyed by the SHA-256 of the content. A small per-key ref records the S3
+    ETag/Last-Modified of the cached copy; once it is older than `ttl` seconds, the next read does a conditional GET
+    and only downloads the body if the object changed.
+
+    Parameters
+    ----------
+    client :
+        boto3 S3 client
+    bucket : str
+        Bucket holding the `texs/` prefix
+    cache_dir : str
+        Directory for the on-disk tier, shared by all workers
+    max_bytes : int
+        Memory budget for the in-memory tier
+    ttl : float
+        Seconds before a cached copy is revalidated
+    max_disk_bytes : int
+        Disk budget for the contents in the on-disk tier; the refs are not counted
+    """
+
+    def __init__(self, client, bucket: str, cache_dir: str, max_bytes: int, ttl: float, max_disk_bytes: int):
+        self.client = client
+        self.bucket = bucket
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.memory = ByteLRUCache(max_bytes)
+        self.disk = DiskBudget(Path(cache_dir, "objects"), max_disk_bytes)
+        self._refs: dict[str, dict] = {}
+        self.counters = dict(memory_hits=0, disk_hits=0, revalidated=0, misses=0)
+
+    def _object_path(self, digest: str) -> Path:
+        return Path(self.cache_dir, "objects", digest[:2], digest)
+
+    def _ref_path(self, obj_key: str) -> Path:
+        return Path(self.cache_dir, "refs", quote(obj_key, safe="") + ".json")
+
+    @staticmethod
+    def _write_atomic(path: Path, data: bytes):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+
+    def _get_ref(self, obj_key: str):
+        ref = self._refs.get(obj_key)
+        if ref is None and self._ref_path(obj_key).exists():
+            try:
+                ref = json.loads(self._ref_path(obj_key).read_text())
+                self._refs[obj_key] = ref
+            except (OSError, ValueError):
+                ref = None
+        return ref
+
+    def _save_ref(self, obj_key: str, ref: dict):
+        self._refs[obj_key] = ref
+        self._write_atomic(self._ref_path(obj_key), json.dumps(ref).encode())
+
+    def _read_content(self, digest: str):
+        text = self.memory.get(digest)
+        if text is not None:
+            self.counters["memory_hits"] += 1
+            return text
+        try:
+            data = self._object_path(digest).read_bytes()
+        except OSError:
+            return None
+        self.disk.touch(self._object_path(digest))
+        text = data.decode()
+        self.memory.put(digest, text, len(data))
+        self.counters["disk_hits"] += 1
+        return text
+
+    def expire(self, obj_key: str):
+        """Makes the next load of `obj_key` revalidate its cached copy, however recently it was checked"""
+        ref = self._get_ref(obj_key)
+        if ref is not None:
+            self._refs[obj_key] = {**ref, "checked": 0}
+
+    def load(self, obj_key: str) -> str:
+        return self.load_with_digest(obj_key)[0]
+
+    def load_with_digest(self, obj_key: str) -> tuple[str, str]:
+        """Returns the decoded TeX for `obj_key` along with its SHA-256 content digest"""
+        ref = self._get_ref(obj_key)
+        if ref is not None and time.time() - ref["checked"] < self.ttl:
+            text = self._read_content(ref["digest"])
+            if text is not None:
+                return text, ref["digest"]
+
+        # Stale or missing: ask S3, but let it answer 304 if our copy is still current
+        conditions = {}
+        if ref is not None and self._object_path(ref["digest"]).exists():
+            if ref.get("etag"):
+                conditions["IfNoneMatch"] = ref["etag"]
+            elif ref.get("last_modified"):
+                conditions["IfModifiedSince"] = datetime.fromisoformat(ref["last_modified"])
+        try:
+            obj = self.client.get_object(Bucket=self.bucket, Key=f"texs/{obj_key}", **conditions)
+        except ClientError as e:
+            if ref is None or e.response.get("Error", {}).get("Code") not in ("304", "NotModified"):
+                raise
+            text = self._read_content(ref["digest"])
+            if text is not None:
+                self.counters["revalidated"] += 1
+                self._save_ref(obj_key, {**ref, "checked": time.time()})
+                return text, ref["digest"]
+            obj = self.client.get_object(Bucket=self.bucket, Key=f"texs/{obj_key}")
+
+        data = obj["Body"].read()
+        digest = hashlib.sha256(data).hexdigest()
+        if not self._object_path(digest).exists():
+            self._write_atomic(self._object_path(digest), data)
+            self.disk.added(len(data))
+        last_modified = obj.get("LastModified")
+        self._save_ref(
+            obj_key,
+            {
+                "digest": digest,
+                "etag": obj.get("ETag"),
+                "last_modified": last_modified.isoformat() if last_modified else None,
+                "checked": time.time(),
+            },
+        )
+        text = data.decode()
+        self.memory.put(digest, text, len(data))
+        self.counters["misses"] += 1
+        return text, digest
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "memory_bytes": self.memory.nbytes,
+            "memory_items": len(self.memory),
+            "memory_evictions": self.memory.evictions,
+            "disk_evictions": self.disk.evictions,
+        }
+
+
+tex_cache = TexCache(session, TEX_BUCKET, TEX_CACHE_DIR, TEX_CACHE_BYTES, TEX_CACHE_TTL, TEX_CACHE_DISK_BYTES)
+
+
 def load_tex(obj_key):
-    obj = session.get_object(Bucket="tex-annotation", Key=f"texs/{obj_key}")
-    data = obj["Body"].read()
-    return data.decode()
+    return tex_cache.load(obj_key)
+
+
+def load_tex_digest(obj_key) -> str:
+    return tex_cache.load_with_digest(obj_key)[1]
+
+
+def tex_cache_stats() -> dict:
+    return tex_cache.stats()
+
+
+# Directory for the on-disk tier of the tokenization cache, shared by all workers
+TOKEN_CACHE_DIR = os.environ.get("TOKEN_CACHE_DIR", "/tmp/token-cache")
+# Memory budget for tokenized passages kept in each worker
+TOKEN_CACHE_BYTES = int(os.environ.get("TOKEN_CACHE_BYTES", 128 * 1024 * 1024))
+# Disk budget for the tokenized passages in TOKEN_CACHE_DIR, shared by all workers
+TOKEN_CACHE_DISK_BYTES = int(os.environ.get("TOKEN_CACHE_DISK_BYTES", 2 * 1024 * 1024 * 1024))
+
+
+class TokenCache:
+    """Two-tier cache of tokenized passages of the TeX sources
+
+    A passage is identified by the content digest of its file (see `TexCache.load_with_digest`), its character range
+    and the tokenizer, so cached entries never go stale. Input ids and offset mappings are kept as NumPy arrays in an
+    in-memory LRU (bounded by `max_bytes`) in front of `.npz` files under `cache_dir` (bounded by `max_disk_bytes`).
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the on-disk tier, shared by all workers
+    max_bytes : int
+        Memory budget for the in-memory tier
+    max_disk_bytes : int
+        Disk budget for the on-disk tier
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int, max_disk_bytes: int):
+        self.cache_dir = Path(cache_dir)
+        self.memory = ByteLRUCache(max_bytes)
+        self.disk = DiskBudget(cache_dir, max_disk_bytes)
+        self.counters = dict(memory_hits=0, disk_hits=0, misses=0)
+
+    def _path(self, key: str) -> Path:
+        return Path(self.cache_dir, key[:2], f"{key}.npz")
+
+    def _read(self, key: str):
+        try:
+            with np.load(self._path(key)) as npz:
+                arrays = npz["input_ids"], npz["offsets"]
+        except (OSError, ValueError, KeyError):
+            return None
+        self.disk.touch(self._path(key))
+        return arrays
+
+    def _write(self, key: str, input_ids: np.ndarray, offsets: np.ndarray):
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, input_ids=input_ids, offsets=offsets)
+        nbytes = tmp.stat().st_size
+        os.replace(tmp, path)
+        self.disk.added(nbytes)
+
+    def tokenize(self, tokenizer: PreTrainedTokenizer, text: str, digest: str, start: int) -> BatchEncoding:
+        """Same as `tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)`
+
+        Parameters
+        ----------
+        tokenizer : PreTrainedTokenizer
+            Fast tokenizer, identified by its `name_or_path`
+        text : str
+            Passage to tokenize
+        digest : str
+            SHA-256 content digest of the file the passage is from
+        start : int
+            Character index of the passage in the file
+
+        Returns
+        -------
+        BatchEncoding
+            `input_ids` and `offset_mapping` (as an array) of the passage; it has no `encodings`, so nothing that
+            needs the underlying tokenizer output (e.g. `sequence_ids`) is available
+        """
+        key = hashlib.sha256(f"{digest}:{start}:{start + len(text)}:{tokenizer.name_or_path}".encode()).hexdigest()
+        arrays = self.memory.get(key)
+        if arrays is not None:
+            self.counters["memory_hits"] += 1
+        else:
+            arrays = self._read(key)
+            if arrays is not None:
+                self.counters["disk_hits"] += 1
+            else:
+                tokens = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+                input_ids = np.array(tokens["input_ids"], dtype=np.int32)
+                offsets = np.array(tokens["offset_mapping"], dtype=np.int32).reshape(-1, 2)
+                arrays = (input_ids, offsets)
+                self._write(key, *arrays)
+                self.counters["misses"] += 1
+            self.memory.put(key, arrays, arrays[0].nbytes + arrays[1].nbytes)
+
+        input_ids, offsets = arrays
+        return BatchEncoding({"input_ids": input_ids.tolist(), "offset_mapping": offsets})
+
+    def stats(self) -> dict:
+        return {
+            **self.counters,
+            "memory_bytes": self.memory.nbytes,
+            "memory_items": len(self.memory),
+            "memory_evictions": self.memory.evictions,
+            "disk_evictions": self.disk.evictions,
+        }
+
+
+token_cache = TokenCache(TOKEN_CACHE_DIR, TOKEN_CACHE_BYTES, TOKEN_CACHE_DISK_BYTES)
+
+
+def token_cache_stats() -> dict:
+    return token_cache.stats()
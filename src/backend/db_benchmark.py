@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""Seeds a synthetic dataset in a scratch schema and reports EXPLAIN ANALYZE timings of the hot queries in `data.py`,
+before and after the index migrations
+
+Usage: python -m src.backend.db_benchmark --annotations 1000000
+"""
+import argparse
+import logging
+import time
+
+import psycopg
+from psycopg.rows import dict_row
+
+from . import data_utils
+from .data import _annotations_query
+from .migrations import MIGRATIONS, migrate
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+SCHEMA = "migration_benchmark"
+# Schema as of just before the first index migration is the "before" state
+BASELINE_VERSION = min(m.version for m in MIGRATIONS if m.indexes) - 1
+
+
+def _seed(conn: psycopg.Connection, annotations: int, per_save: int, files: int, users: int):
+    saves = max(annotations // per_save, 1)
+    params = dict(saves=saves, annotations=annotations, per_save=per_save, files=files, users=users)
+    conn.execute(
+        """
+        INSERT INTO saves (savename, start, "end", fileid, userid, final, autosave, deleted, "timestamp")
+        SELECT 'save-' || s, 0, 1000, 'file-' || (s %% %(files)s), 'user-' || (s %% %(users)s),
+               (s %% 7 = 0)::int, (s %% 3 = 0)::int, (s %% 11 = 0)::int,
+               TIMESTAMP '2024-01-01' + s * INTERVAL '1 second'
+        FROM generate_series(0, %(saves)s - 1) s;
+        """,
+        params,
+    )
+    conn.execute(
+        """
+        INSERT INTO annotations (annoid, fileid, userid, start, "end", text, tag, color, savename, autosave, "timestamp")
+        SELECT 'anno-' || g, 'file-' || (s %% %(files)s), 'user-' || (s %% %(users)s), (g * 37) %% 1000,
+               (g * 37) %% 1000 + 20, 'some annotated text',
+               (ARRAY['definition', 'theorem', 'proof', 'example', 'name'])[1 + g %% 5], '#d3d3d3',
+               'save-' || s, (s %% 3 = 0)::int, TIMESTAMP '2024-01-01' + s * INTERVAL '1 second'
+        FROM generate_series(0, %(annotations)s - 1) g, LATERAL (SELECT g / %(per_save)s AS s) save;
+        """,
+        params,
+    )
+    conn.execute(
+        """
+        INSERT INTO links (fileid, userid, start, "end", tag, color, "timestamp", source, target)
+        SELECT 'file-' || (s %% %(files)s), 'user-' || (s %% %(users)s), 0, 20, 'name', '#d3d3d3',
+               TIMESTAMP '2024-01-01' + s * INTERVAL '1 second',
+               'anno-' || g, 'anno-' || (g - g %% %(per_save)s + (g * 7) %% %(per_save)s)
+        FROM generate_series(0, %(annotations)s - 1, 5) g, LATERAL (SELECT g / %(per_save)s AS s) save;
+        """,
+        params,
+    )
+    conn.execute(
+        """
+        INSERT INTO latest_saves (fileid, "timestamp")
+            SELECT fileid, MAX("timestamp") FROM annotations GROUP BY fileid
+        ON CONFLICT (fileid) DO UPDATE SET "timestamp" = EXCLUDED."timestamp";
+        """
+    )
+
+
+def _queries(conn: psycopg.Connection) -> list[tuple[str, str, dict]]:
+    """The hot queries of `data.py`, with parameters picked from the middle of the seeded data"""
+    save = conn.execute(
+        """
+        SELECT * FROM saves WHERE final = 1 AND deleted = 0
+        ORDER BY saveid OFFSET (SELECT COUNT(*) / 2 FROM saves WHERE final = 1 AND deleted = 0) LIMIT 1;
+        """
+    ).fetchone()
+    annoid = conn.execute(
+        """SELECT annoid FROM annotations WHERE savename = %(savename)s LIMIT 1;""", dict(savename=save["savename"])
+    ).fetchone()["annoid"]
+    params = dict(
+        fileid=save["fileid"],
+        userid=save["userid"],
+        savename=save["savename"],
+        timestamp=save["timestamp"],
+        start=save["start"],
+        end=save["end"],
+        annoid=annoid,
+    )
+    return [
+        (
+            "load_annotations",
+            _annotations_query(
+                ("source", "target", "start", "color", "end", "tag", "fileid"),
+                join="ON a.annoid = l.source AND a.timestamp = l.timestamp",
+                where="a.fileid = %(fileid)s AND a.timestamp = %(timestamp)s",
+            ),
+            params,
+        ),
+        (
+            "load_all_annotations",
+            _annotations_query(
+                ("start", "end", "tag", "fileid", "source", "target"),
+                join="ON a.annoid = l.source",
+                where="""(a.fileid, a.timestamp) IN (
+                    SELECT fileid, "timestamp" FROM latest_saves WHERE fileid != %(fileid)s
+                  )""",
+            ),
+            params,
+        ),
+        (
+            "latest_user_save",
+            """SELECT MAX("timestamp") FROM annotations WHERE fileid = %(fileid)s AND userid = %(userid)s;""",
+            params,
+        ),
+        ("load_anno_from_annoid", """SELECT * FROM annotations WHERE annoid = %(annoid)s;""", params),
+        ("load_save_info_from_timestamp", """SELECT * FROM saves WHERE "timestamp" = %(timestamp)s;""", params),
+        (
+            "get_initial_user_from_savename",
+            """SELECT userid, timestamp FROM saves WHERE savename = %(savename)s ORDER BY timestamp LIMIT 1;""",
+            params,
+        ),
+        (
+            "load_saves",
+            """SELECT a.userid, a.fileid, a.timestamp, a.savename, a.autosave, s.final, s.start, s.end, COUNT(*)
+               FROM annotations a
+               LEFT JOIN saves s
+                 ON a.fileid = s.fileid AND a.userid = s.userid AND a.timestamp = s.timestamp
+                AND a.savename = s.savename
+               WHERE s.deleted = 0 AND a.fileid = %(fileid)s AND a.userid = %(userid)s
+               GROUP BY a.userid, a.fileid, a.timestamp, a.savename, a.autosave, s.final, s.start, s.end
+               ORDER BY a.timestamp DESC;""",
+            params,
+        ),
+        (
+            "dashboard_group",
+            """SELECT s.fileid, s.userid, s.savename, s."timestamp"
+               FROM saves s
+               WHERE s.final = 1 AND s.deleted = 0
+                 AND s.fileid = %(fileid)s AND s.start = %(start)s AND s."end" = %(end)s
+                 AND EXISTS (
+                   SELECT 1 FROM annotations a
+                   WHERE a.fileid = s.fileid AND a.userid = s.userid AND a.timestamp = s.timestamp
+                     AND a.savename = s.savename
+                 );""",
+            params,
+        ),
+        (
+            "autosave_delta_links",
+            """SELECT COUNT(*) FROM links
+               WHERE userid = %(userid)s AND "timestamp" = %(timestamp)s AND source = ANY(ARRAY[%(annoid)s]);""",
+            params,
+        ),
+    ]
+
+
+def _explain(conn: psycopg.Connection, queries: list[tuple[str, str, dict]], repeats: int) -> dict[str, float]:
+    timings = {}
+    for name, query, params in queries:
+        best = None
+        for _ in range(repeats):
+            plan = conn.execute("EXPLAIN (ANALYZE, FORMAT JSON) " + query, params).fetchone()["QUERY PLAN"]
+            elapsed = plan[0]["Execution Time"]
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return timings
+
+
+def benchmark(annotations: int, per_save: int, files: int, users: int, repeats: int, keep: bool = False):
+    conn_str = data_utils.CONN_STR
+    scratch = f"{conn_str} options='-c search_path={SCHEMA}'"
+    with psycopg.connect(conn_str, autocommit=True) as admin:
+        admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+        admin.execute(f"CREATE SCHEMA {SCHEMA};")
+
+    try:
+        migrate(scratch, target=BASELINE_VERSION)
+        with psycopg.connect(scratch, autocommit=True, row_factory=dict_row) as conn:
+            start = time.perf_counter()
+            _seed(conn, annotations, per_save, files, users)
+            conn.execute("ANALYZE;")
+            logger.info(f"Seeded {annotations} annotations in {time.perf_counter() - start:.1f}s")
+            queries = _queries(conn)
+            before = _explain(conn, queries, repeats)
+
+        start = time.perf_counter()
+        migrate(scratch)
+        logger.info(f"Applied the index migrations in {time.perf_counter() - start:.1f}s")
+        with psycopg.connect(scratch, autocommit=True, row_factory=dict_row) as conn:
+            conn.execute("ANALYZE;")
+            after = _explain(conn, queries, repeats)
+    finally:
+        if not keep:
+            with psycopg.connect(conn_str, autocommit=True) as admin:
+                admin.execute(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;")
+
+    print(f"{'query':<32} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>9}")
+    for name, _, _ in queries:
+        speedup = before[name] / after[name] if after[name] > 0 else float("inf")
+        print(f"{name:<32} {before[name]:>12.2f} {after[name]:>12.2f} {speedup:>8.1f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--annotations", type=int, default=1_000_000, help="number of annotations to seed")
+    parser.add_argument("--per-save", type=int, default=50, help="annotations per save")
+    parser.add_argument("--files", type=int, default=500, help="number of distinct files")
+    parser.add_argument("--users", type=int, default=20, help="number of distinct users")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per query; the fastest is reported")
+    parser.add_argument("--keep", action="store_true", help=f"keep the {SCHEMA} schema afterwards")
+    args = parser.parse_args()
+    benchmark(args.annotations, args.per_save, args.files, args.users, args.repeats, keep=args.keep)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""In-process replacement for the `fold -s`, `nl` and `grep` pipelines mapping book lines to wrapped lines
+
+Follows GNU coreutils in the C locale: columns are bytes, except for tabs, backspaces and carriage returns.
+"""
+import re
+from typing import NamedTuple
+
+import numpy as np
+
+# Format of `nl -ba -w2 -s :::`, and what `grep -o '^[0-9]\+:::'` picked out of its folded output
+NL_FORMAT = b"%2d:::"
+NL_UNNUMBERED = b" " * len(NL_FORMAT % 0)
+_NUMBERED = re.compile(rb"([0-9]+):::")
+# Lines that start a logical page section in `nl`; these are printed empty and restart the numbering
+_NL_SECTIONS = {b"\\:\\:\\:": "header", b"\\:\\:": "body", b"\\:": "footer"}
+_TAB_WIDTH = 8
+
+
+def _adjust_column(column: int, c: int) -> int:
+    if c == 0x08:
+        return max(column - 1, 0)
+    if c == 0x0D:
+        return 0
+    if c == 0x09:
+        return column + _TAB_WIDTH - column % _TAB_WIDTH
+    return column + 1
+
+
+def _fold_control(line: bytes, width: int) -> list[bytes]:
+    # fold.c, character by character
+    segments = []
+    buffer = bytearray()
+    column = 0
+    for c in line:
+        while True:
+            column = _adjust_column(column, c)
+            if column <= width:
+                buffer.append(c)
+                break
+            blank = max(buffer.rfind(b" "), buffer.rfind(b"\t"))
+            if blank >= 0:
+                # Break after the last blank, then rescan the rest of the line with this character
+                segments.append(bytes(buffer[: blank + 1]))
+                del buffer[: blank + 1]
+                column = 0
+                for b in buffer:
+                    column = _adjust_column(column, b)
+                continue
+            if not buffer:
+                # Wider than a whole line by itself
+                buffer.append(c)
+                break
+            segments.append(bytes(buffer))
+            buffer.clear()
+            column = 0
+    segments.append(bytes(buffer))
+    return segments
+
+
+def fold_line(line: bytes, width: int) -> list[bytes]:
+    """Lines `fold -s -w <width>` splits `line` (without its newline) into
+
+    Parameters
+    ----------
+    line : bytes
+        A line of input, without the trailing newline
+    width : int
+        Maximum number of columns per line
+
+    Returns
+    -------
+    list[bytes]
+        The folded lines, without newlines; the last one is empty only if `line` is
+    """
+    if width < 1:
+        raise ValueError(f"invalid number of columns: {width}")
+    if b"\t" in line or b"\b" in line or b"\r" in line:
+        if line.endswith(b"\r") and not (b"\t" in line or b"\b" in line or b"\r" in line[:-1]):
+            # CRLF line endings: the carriage return goes back to column 0, so it never causes a break
+            segments = fold_line(line[:-1], width)
+            segments[-1] += b"\r"
+            return segments
+        return _fold_control(line, width)
+
+    # Every byte is one column wide, so lines break after the last space of each full line
+    segments = []
+    position = 0
+    while len(line) - position > width:
+        blank = line.rfind(b" ", position, position + width)
+        end = blank + 1 if blank >= 0 else position + width
+        segments.append(line[position:end])
+        position = end
+    segments.append(line[position:])
+    return segments
+
+
+class FoldMapping(NamedTuple):
+    """Where lines of a book end up once it's folded
+
+    Line `old[i]` (as numbered by `nl -ba`) starts on line `new[i]` of the folded book, which has `lines` lines in
+    total. `old` is sorted.
+    """
+
+    old: np.ndarray
+    new: np.ndarray
+    lines: int
+
+    @property
+    def nbytes(self) -> int:
+        return self.old.nbytes + self.new.nbytes
+
+    def map(self, lines: list[int]) -> np.ndarray:
+        """Folded line of each of `lines`, or the line itself if it isn't mapped"""
+        lines = np.asarray(lines, dtype=np.int64)
+        if len(self.old) == 0:
+            return lines
+        found = np.minimum(np.searchsorted(self.old, lines), len(self.old) - 1)
+        return np.where(self.old[found] == lines, self.new[found], lines)
+
+
+def fold_mapping(content: bytes, width: int) -> FoldMapping:
+    """Same as the `fold -s | wc -l` and `nl -ba -w2 -s ::: | fold -s | grep -oin '^[0-9]\\+:::'` pipelines
+
+    Parameters
+    ----------
+    content : bytes
+        The book
+    width : int
+        Maximum number of columns per line
+
+    Returns
+    -------
+    FoldMapping
+        The line numbers picked out of the folded, numbered book, with the number of lines of the folded book
+
+    Notes
+    -----
+    As with the pipeline, the numbers are folded along with the text and lines 1 to 9 are padded with a space, so
+    they are never mapped.
+    """
+    if not content:
+        return FoldMapping(np.array([], dtype=np.int64), np.array([], dtype=np.int64), 0)
+    lines = content.split(b"\n")
+    terminated = lines[-1] == b""
+    if terminated:
+        lines.pop()
+
+    # Without tabs, backspaces or carriage returns, lines that fit are left as they are
+    simple = not (b"\t" in content or b"\b" in content or b"\r" in content)
+
+    # `wc -l` doesn't count a last line without a newline
+    total = -(0 if terminated else 1)
+    for line in lines:
+        total += 1 if simple and len(line) <= width else len(fold_line(line, width))
+
+    old2new = {}
+    section = "body"
+    number = 1
+    folded = 0
+    for line in lines:
+        if line in _NL_SECTIONS:
+            section = _NL_SECTIONS[line]
+            number = 1
+            numbered = b""
+        elif section == "body":
+            if simple and len(line) + len(NL_FORMAT % number) <= width:
+                folded += 1
+                if number >= 10:
+                    old2new[number] = folded
+                number += 1
+                continue
+            numbered = NL_FORMAT % number + line
+            number += 1
+        else:
+            numbered = NL_UNNUMBERED + line
+        for segment in fold_line(numbered, width):
+            folded += 1
+            match = _NUMBERED.match(segment)
+            if match:
+                old2new[int(match[1])] = folded
+
+    old = np.array(sorted(old2new), dtype=np.int64)
+    new = np.array([old2new[line] for line in old.tolist()], dtype=np.int64)
+    return FoldMapping(old, new, total)
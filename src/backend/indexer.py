@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+"""In-process replacement for `grep -oin` over the definition library
+
+Kept apart from `search` so that index workers don't import the S3 and database setup.
+"""
+import logging
+import mmap
+import os
+import re
+import string
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+import numpy as np
+import regex
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Number of worker processes used to index the library; 0 or 1 indexes in the calling process
+INDEX_WORKERS = int(os.environ.get("INDEX_WORKERS", os.cpu_count() or 1))
+# Only lines containing a literal every match needs are searched, unless a pattern has none this long
+MIN_LITERAL_LENGTH = 3
+
+# POSIX character classes in the C locale, minus the newline (grep matches within a line)
+_BRACKET_CLASSES = {
+    "alpha": "a-zA-Z",
+    "digit": "0-9",
+    "alnum": "a-zA-Z0-9",
+    "upper": "A-Z",
+    "lower": "a-z",
+    "space": " \\t\\r\\f\\v",
+    "blank": " \\t",
+    "punct": re.escape(string.punctuation),
+    "print": "\\x20-\\x7e",
+    "graph": "\\x21-\\x7e",
+    "cntrl": "\\x00-\\x09\\x0b-\\x1f\\x7f",
+    "xdigit": "0-9A-Fa-f",
+}
+_BRE_ESCAPES = {
+    "(": "(",
+    ")": ")",
+    "|": "|",
+    "{": "{",
+    "}": "}",
+    "?": "?",
+    "+": "+",
+    "<": r"\b(?=\w)",
+    ">": r"\b(?<=\w)",
+    "b": r"\b",
+    "B": r"\B",
+    "w": r"\w",
+    "W": r"[^\w\n]",
+    "s": r"[^\S\n]",
+    "S": r"\S",
+    "`": r"\A",
+    "'": r"\Z",
+}
+
+
+def _translate_bracket(pattern: str, i: int) -> tuple[str, int]:
+    """Translates the bracket expression starting at `pattern[i] == "["`, returns it and the index past its end"""
+    i += 1
+    negate = i < len(pattern) and pattern[i] == "^"
+    i += negate
+    items = []
+    first = True
+    while True:
+        if i >= len(pattern):
+            raise ValueError(f"Unmatched [ in {pattern!r}")
+        c = pattern[i]
+        if c == "]" and not first:
+            break
+        if c == "[" and pattern[i + 1 : i + 2] in (":", "=", "."):
+            kind = pattern[i + 1]
+            end = pattern.find(kind + "]", i + 2)
+            if end == -1:
+                raise ValueError(f"Unmatched [ in {pattern!r}")
+            name = pattern[i + 2 : end]
+            if kind == ":":
+                if name not in _BRACKET_CLASSES:
+                    raise ValueError(f"Invalid character class {name!r} in {pattern!r}")
+                items.append(_BRACKET_CLASSES[name])
+            else:
+                items.append(re.escape(name))
+            i = end + 2
+        elif c == "-" and not first and pattern[i + 1 : i + 2] != "]":
+            items.append("-")
+            i += 1
+        else:
+            # Backslashes are literal in bracket expressions
+            items.append(re.escape(c))
+            i += 1
+        first = False
+    # Like grep, never match across lines
+    body = "".join(items) + ("\\n" if negate else "")
+    return ("[^" if negate else "[") + body + "]", i + 1
+
+
+def _translate(pattern: str) -> tuple[str, list[list[bytes]]]:
+    """`bre_to_regex`, along with the literals (lowercased) that every match of each top-level branch contains"""
+    # Each group being built is a list of pieces, so that a quantifier always applies to the last atom
+    stack: list[list[str]] = [[]]
+    # Whether the next character starts a branch, where `*` and `^` are literal and an anchor respectively
+    branch_start = True
+    quantified = False
+    # Number of each open group, and top-level branch of each closed one, to validate back-references like grep
+    open_groups: list[int] = []
+    closed_groups: dict[int, int] = {}
+    branch = 0
+    # Run of required literal characters in the current top-level branch, and the runs before it
+    run = b""
+    last_literal = False
+    literals: list[list[bytes]] = [[]]
+    i = 0
+    while i < len(pattern):
+        pieces = stack[-1]
+        top = len(stack) == 1
+        c = pattern[i]
+        piece = quantifier = None
+        literal = False
+        if c == "\\":
+            if i + 1 >= len(pattern):
+                raise ValueError(f"Trailing backslash in {pattern!r}")
+            c = pattern[i + 1]
+            i += 2
+            if c == "(":
+                if top:
+                    literals[-1].append(run)
+                    run = b""
+                stack.append([])
+                open_groups.append(len(open_groups) + len(closed_groups) + 1)
+                branch_start = True
+                continue
+            if c == ")":
+                if top:
+                    raise ValueError(f"Unmatched ) or \\) in {pattern!r}")
+                group = stack.pop()
+                closed_groups[open_groups.pop()] = branch
+                stack[-1].append("(" + "".join(group) + ")")
+                branch_start = quantified = last_literal = False
+                continue
+            if c == "|":
+                if top:
+                    literals[-1].append(run)
+                    literals.append([])
+                    run = b""
+                    branch += 1
+                pieces.append("|")
+                branch_start = True
+                last_literal = False
+                continue
+            if c in "?+":
+                quantifier = "\\" + c
+            elif c == "{":
+                end = pattern.find("\\}", i)
+                if end == -1:
+                    raise ValueError(f"Unmatched \\{{ in {pattern!r}")
+                quantifier = "\\{" + pattern[i:end] + "\\}"
+                i = end + 2
+            elif c in _BRE_ESCAPES:
+                piece = _BRE_ESCAPES[c]
+            elif c.isdigit() and c != "0":
+                if closed_groups.get(int(c)) != branch:
+                    raise ValueError(f"Invalid back reference in {pattern!r}")
+                piece = "\\" + c
+            else:
+                piece, literal = re.escape(c), True
+        elif c == "[":
+            piece, i = _translate_bracket(pattern, i)
+        elif c == "*" and not branch_start:
+            quantifier = "*"
+            i += 1
+        elif c == "^" and branch_start:
+            # `*` right after a leading `^` is still literal
+            pieces.append("^")
+            i += 1
+            continue
+        elif c == "$" and (i + 1 == len(pattern) or pattern[i + 1 : i + 3] in ("\\)", "\\|")):
+            piece = "$"
+            i += 1
+        elif c == ".":
+            piece = "."
+            i += 1
+        else:
+            piece, literal = re.escape(c), True
+            i += 1
+
+        if quantifier is not None and branch_start:
+            # Nothing to repeat, e.g. `\(*a\)`, grep matches the operator literally
+            c = quantifier.replace("\\", "")
+            piece, literal, quantifier = re.escape(c), True, None
+
+        if quantifier is not None:
+            if top:
+                # A repeated literal may not appear at all
+                literals[-1].append(run[:-1] if last_literal else run)
+                run = b""
+            # Stacked quantifiers (`a**`) apply to the already repeated atom
+            atom = f"(?:{pieces[-1]})" if quantified else pieces[-1]
+            pieces[-1] = atom + quantifier.replace("\\", "")
+            quantified = True
+            last_literal = False
+            continue
+
+        if top and literal:
+            run += c.encode().lower()
+        elif top:
+            literals[-1].append(run)
+            run = b""
+        pieces.append(piece)
+        branch_start = quantified = False
+        last_literal = literal
+
+    if len(stack) != 1:
+        raise ValueError(f"Unmatched ( or \\( in {pattern!r}")
+    literals[-1].append(run)
+    return "".join(stack[0]), [[literal for literal in branch if literal] for branch in literals]
+
+
+def bre_to_regex(pattern: str) -> str:
+    """Translates a GNU grep basic regular expression to the `regex` module's syntax
+
+    Matched with `regex.POSIX` (leftmost-longest), `regex.MULTILINE` and `regex.IGNORECASE` on bytes, the result finds
+    what `grep -oi` finds in the C locale: `\\(`, `\\|`, `\\?`, `\\+` and `\\{m,n\\}` are operators and their bare
+    forms literals, `*` and `^` are literal where they can't be an operator, and nothing matches a newline.
+
+    Parameters
+    ----------
+    pattern : str
+        BRE, as passed to grep
+
+    Returns
+    -------
+    str :
+        Equivalent pattern
+    """
+    return _translate(pattern)[0]
+
+
+class CompiledPatterns(NamedTuple):
+    """BREs or'd together, compiled for `index_tex`
+
+    `search` finds where the leftmost match starts, then `longest` (leftmost-longest, which is slower to search with)
+    finds where it ends. When known, every line with a match contains one of `literals` (lowercased).
+    """
+
+    search: regex.Pattern
+    longest: regex.Pattern
+    literals: Optional[tuple[bytes, ...]]
+
+
+@lru_cache(maxsize=16)
+def compile_patterns(patterns: tuple[str, ...]) -> CompiledPatterns:
+    """Compiles the BREs `patterns`, or'd together, for `index_tex`"""
+    translated, literals = _translate(r"\|".join(patterns))
+    flags = regex.IGNORECASE | regex.MULTILINE
+    # Looking for more than one literal per branch costs more than the lines it rules out, so only the one most
+    # likely to be rare is, going by the number of words and then length ("is a" over "the ")
+    literals = [max(branch, key=lambda l: (len(l.split()), len(l)), default=b"") for branch in literals]
+    literals = list(dict.fromkeys(literals))
+    # Lines with "is called a" also have "is called ", so only the latter needs looking for
+    literals = [l for l in literals if not any(other != l and other in l for other in literals)]
+    return CompiledPatterns(
+        search=regex.compile(translated.encode(), flags),
+        longest=regex.compile(translated.encode(), flags | regex.POSIX),
+        # Short literals are on nearly every line
+        literals=tuple(literals) if all(len(l) >= MIN_LITERAL_LENGTH for l in literals) else None,
+    )
+
+
+def _find_all(lowered: np.ndarray, literals: list[bytes]) -> tuple[np.ndarray, dict[bytes, np.ndarray]]:
+    """Offsets of every newline, and of every occurrence of each of `literals`, in `lowered`"""
+    # A single pass picks out newlines and the first byte of every literal, the rest is checked only there
+    firsts = list(dict.fromkeys(literal[0] for literal in literals))
+    mask = lowered == ord("\n")
+    for first in firsts:
+        mask |= lowered == first
+    offsets = np.flatnonzero(mask)
+    values = lowered[offsets]
+
+    by_first = {first: offsets[values == first] for first in firsts}
+    found = {}
+    for literal in literals:
+        starts = by_first[literal[0]]
+        starts = starts[starts <= len(lowered) - len(literal)]
+        for k in range(1, len(literal)):
+            starts = starts[lowered[starts + k] == literal[k]]
+        found[literal] = starts
+    return offsets[values == ord("\n")], found
+
+
+def _candidate_spans(
+    buffer: mmap.mmap, literals: Optional[tuple[bytes, ...]]
+) -> tuple[np.ndarray, list[tuple[int, int]]]:
+    """Offsets of the newlines of `buffer`, and ranges of consecutive lines that contain any of `literals`"""
+    if literals is None:
+        return np.flatnonzero(np.frombuffer(buffer[:], dtype=np.uint8) == ord("\n")), [(0, len(buffer))]
+    lowered = np.frombuffer(buffer[:].lower(), dtype=np.uint8)
+    newlines, found = _find_all(lowered, list(literals))
+    lines = np.unique(np.searchsorted(newlines, np.concatenate(list(found.values()))))
+    if len(lines) == 0:
+        return newlines, []
+    starts = np.concatenate([[0], newlines + 1])[lines]
+    ends = np.concatenate([newlines, [len(buffer)]])[lines]
+    # Matches never span lines, so adjacent lines can be searched together
+    breaks = np.flatnonzero(np.diff(lines) > 1)
+    spans = zip(starts[np.concatenate([[0], breaks + 1])].tolist(), ends[np.concatenate([breaks, [-1]])].tolist())
+    return newlines, list(spans)
+
+
+def index_tex(patterns: tuple[str, ...], tex: str, type: str):
+    """Finds every match of `patterns` in `tex`, like `grep -oin`
+
+    Returns
+    -------
+    list[tuple[str, str, int, str]] :
+        `(tex, type, line, match)` of every non-empty match, where `line` is 1-indexed
+    """
+    try:
+        compiled = compile_patterns(tuple(patterns))
+    except (ValueError, regex.error) as e:
+        logger.error(f"invalid definition patterns: {e}")
+        return []
+    try:
+        with open(tex, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except OSError as e:
+        logger.error(f"failed to index {tex}: {e}")
+        return []
+
+    matches = []
+    with buffer:
+        newlines, spans = _candidate_spans(buffer, compiled.literals)
+        for start, end in spans:
+            position = start
+            while position < end and (found := compiled.search.search(buffer, position, end)) is not None:
+                # The leftmost match starts where the first one found does, but may be longer
+                match = compiled.longest.match(buffer, found.start(), end)
+                if match.end() > match.start():
+                    matches.append((match.start(), match.group()))
+                    position = match.end()
+                else:
+                    position = match.start() + 1
+    if not matches:
+        return []
+    linenums = np.searchsorted(newlines, [start for start, _ in matches]) + 1
+
+    searched = [
+        (tex, type, int(linenum), text.decode(errors="replace")) for linenum, (_, text) in zip(linenums, matches)
+    ]
+    # grep's output used to be stripped as a whole, which trimmed the last match
+    tex_, type_, linenum, text = searched[-1]
+    searched[-1] = (tex_, type_, linenum, text.rstrip())
+    return searched
@@ -1,19 +1,21 @@
 #!/usr/bin/env python3
 import uuid
-from flask import Flask, jsonify, request, send_file
+from flask import Flask, Response, jsonify, request, send_from_directory
 from flask_cors import CORS, cross_origin
 from pathlib import Path
 
 import time
 import base64
+import unicodedata
+from urllib.parse import quote
 import re
 import os
 import sqlite3
+import threading
 import boto3
 import json
 
 from apscheduler.schedulers.background import BackgroundScheduler
-from transformers import AutoTokenizer
 
 from .scoring import (
     compute_annotation_diff,
@@ -21,38 +23,64 @@ from .scoring import (
 )
 from .search import fuzzysearch
 from .data import (
-    export_annotations,
+    export_spans,
+    stream_export_annotations,
     insert_predictions,
+    DASHBOARD_TAGS,
     load_dashboard_data,
     load_save_info_from_timestamp,
     load_all_annotations,
     load_saves,
     load_annotations,
     insert_annotations,
+    apply_autosave_delta,
+    cached_result,
     load_anno_from_annoid,
-    init_annotation_db,
     finalize_save,
     delete_save,
 )
 from .data_utils import (
     load_tex,
     load_pdf,
-    list_s3_documents,
+    documents,
+    pool_stats,
+    tex_cache_stats,
+    token_cache_stats,
 )
 from .users import (
     add_user,
     authenticate_user,
-    init_users_db,
 )
 
-from .search import fuzzysearch, download_and_index_tex, compute_fold_mapping
+from .bulk_export import (
+    EXPORT_SHARD_SIZE,
+    FORMATS,
+    SaveSelection,
+    bulk_export,
+    export_id,
+    export_params,
+    read_manifest,
+    select_saves,
+)
+from .migrations import check_migrations
+from .search import fuzzysearch, download_and_index_tex, map_folded_lines
+from .tokenization import DEFAULT_TOKENIZER, get_tokenizer, tokenizer_stats, warmup_tokenizers
 
 app = Flask(__name__)
 cors = CORS(app)
 app.config["CORS_HEADERS"] = "Content-Type"
 
-init_annotation_db()
-init_users_db()
+# Where bulk exports are written, one directory per export
+BULK_EXPORT_DIR = os.environ.get("BULK_EXPORT_DIR", "/tmp/exports")
+# Worker processes of an export started through the API, per export; each one loads the tokenizer
+BULK_EXPORT_WORKERS = int(os.environ.get("BULK_EXPORT_WORKERS", 2))
+# Exports running at once in each web worker; more requests for new exports get a 503 until one finishes
+BULK_EXPORT_JOBS = int(os.environ.get("BULK_EXPORT_JOBS", 1))
+bulk_export_jobs: set[str] = set()
+bulk_export_lock = threading.Lock()
+
+check_migrations()
+warmup_tokenizers()
 
 
 @app.get("/annotations/export")
@@ -63,15 +91,112 @@ def get_export_save():
     timestamp = request.args.get("timestamp")
     savename = request.args.get("savename")
     ignore = request.args.get("ignore_annotation_endpoints")
-    tokenizer_id = request.args.get("tokenizer", "EleutherAI/llemma_7b")
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
-    anno_json = export_annotations(
-        fileid=fileid, userid=userid, timestamp=timestamp, tokenizer=tokenizer, ignore_annotation_endpoints=ignore
+    tokenizer_id = request.args.get("tokenizer", DEFAULT_TOKENIZER)
+    format = request.args.get("format", "iob")
+    if format not in ("iob", "spans"):
+        return {"error": "format must be one of iob, spans"}, 400
+    tokenizer = get_tokenizer(tokenizer_id)
+    if format == "spans":
+        exported = export_spans(
+            fileid=fileid, userid=userid, timestamp=timestamp, tokenizer=tokenizer, ignore_annotation_endpoints=ignore
+        )
+        response = Response(json.dumps(exported), mimetype="application/json")
+    else:
+        chunks = stream_export_annotations(
+            fileid=fileid, userid=userid, timestamp=timestamp, tokenizer=tokenizer, ignore_annotation_endpoints=ignore
+        )
+        response = Response(chunks, mimetype="application/json")
+    download_name = f"{fileid}-{userid}-{savename}-{tokenizer_id.replace('/', '_')}.json"
+    # Same header as send_file gives
+    try:
+        download_name.encode("ascii")
+        names = {"filename": download_name}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize("NFKD", download_name).encode("ascii", "ignore").decode("ascii")
+        names = {"filename": simple, "filename*": f"UTF-8''{quote(download_name, safe='!#$&+-.^_`|~')}"}
+    response.headers.set("Content-Disposition", "attachment", **names)
+    return response
+
+
+def run_bulk_export(job: str, output_dir: Path, *args):
+    try:
+        bulk_export(output_dir, *args)
+    except BlockingIOError:
+        # Already running in another worker
+        pass
+    except Exception as e:
+        app.logger.error(f"bulk export to {output_dir} failed: {e}")
+    finally:
+        with bulk_export_lock:
+            bulk_export_jobs.discard(job)
+
+
+@app.post("/export/bulk")
+@cross_origin()
+def post_bulk_export():
+    body = request.get_json(silent=True) or {}
+    selection = SaveSelection(
+        final=bool(body.get("final", True)),
+        userids=tuple(body.get("userids", [])),
+        fileids=tuple(body.get("fileids", [])),
+        since=body.get("since"),
+        until=body.get("until"),
+        autosaves=bool(body.get("autosaves", False)),
     )
-    out_file = f"/tmp/{fileid}-{userid}-{savename}-{tokenizer_id.replace('/', '_')}.json"
-    with open(out_file, "w") as f:
-        json.dump(anno_json, f)
-    return send_file(out_file, as_attachment=True, download_name=out_file.split("/")[-1])
+    tokenizer_id = body.get("tokenizer", DEFAULT_TOKENIZER)
+    format = body.get("format", "jsonl")
+    shard_size = int(body.get("shard_size", EXPORT_SHARD_SIZE))
+    if format not in FORMATS:
+        return {"error": f"format must be one of {', '.join(FORMATS)}"}, 400
+    if shard_size < 1:
+        return {"error": "shard_size must be positive"}, 400
+
+    # The same request exports anew once the selected saves change, e.g. when more of them are finalized
+    saves = select_saves(selection)
+    job = export_id(export_params(selection, tokenizer_id, format, shard_size), saves)
+    output_dir = Path(BULK_EXPORT_DIR, job)
+    manifest = read_manifest(output_dir)
+    if manifest is None or not manifest["complete"]:
+        with bulk_export_lock:
+            if job not in bulk_export_jobs:
+                if len(bulk_export_jobs) >= BULK_EXPORT_JOBS:
+                    return {"error": "too many bulk exports running, try again later"}, 503, {"Retry-After": "60"}
+                bulk_export_jobs.add(job)
+                # Picks up where a previous run of the same export stopped
+                args = (job, output_dir, selection, tokenizer_id, format, shard_size, BULK_EXPORT_WORKERS, saves)
+                threading.Thread(target=run_bulk_export, args=args, daemon=True).start()
+    return {"job": job}, 202
+
+
+@app.get("/export/bulk/<job>")
+@cross_origin()
+def get_bulk_export(job: str):
+    if not re.fullmatch("[0-9a-f]{16}", job) or not Path(BULK_EXPORT_DIR, job).is_dir():
+        return {"error": f"no export {job}"}, 404
+    manifest = read_manifest(Path(BULK_EXPORT_DIR, job))
+    if manifest is None:
+        # Still selecting the saves
+        return {"job": job, "complete": False, "saves": None, "shards": [], "total_shards": None, "failed": []}, 200
+    shard_size = manifest["params"]["shard_size"]
+    shards = [manifest["shards"][i] for i in sorted(manifest["shards"], key=int)]
+    return {
+        "job": job,
+        "complete": manifest["complete"],
+        "saves": len(manifest["saves"]),
+        "shards": shards,
+        "total_shards": -(-len(manifest["saves"]) // shard_size),
+        "failed": manifest["failed"],
+    }, 200
+
+
+@app.get("/export/bulk/<job>/<file>")
+@cross_origin()
+def get_bulk_export_file(job: str, file: str):
+    if not re.fullmatch("[0-9a-f]{16}", job):
+        return {"error": f"no export {job}"}, 404
+    if file != "manifest.json" and not re.fullmatch(r"shard-[0-9]+\.(jsonl|parquet)", file):
+        return {"error": f"no file {file} in export {job}"}, 404
+    return send_from_directory(Path(BULK_EXPORT_DIR, job).resolve(), file, as_attachment=True)
 
 
 @app.get("/annotations/score")
@@ -85,18 +210,26 @@ def get_score_annotations():
     ref_fileid = request.args.get("ref_fileid")
     ref_timestamp = request.args.get("ref_timestamp")
 
-    tokenizer_id = request.args.get("tokenizer", "EleutherAI/llemma_7b")
-    tokenizer = AutoTokenizer.from_pretrained(tokenizer_id)
+    tokenizer_id = request.args.get("tokenizer", DEFAULT_TOKENIZER)
+    tokenizer = get_tokenizer(tokenizer_id)
 
     tags = request.args.get("tags", "").split(";")
 
-    sys_json = export_annotations(fileid=fileid, userid=userid, timestamp=timestamp, tokenizer=tokenizer)
-    begin = sys_json["begin"]
-    end = sys_json["end"]
-    ref_json = export_annotations(
-        fileid=ref_fileid, userid=ref_userid, timestamp=ref_timestamp, tokenizer=tokenizer, begin=begin, end=end
-    )
-    scores = compute_score_and_diff(sys_json, ref_json, tags)
+    def compute():
+        # The scores only need the tag runs, so the compact exports are scored without expanding them
+        sys_json = export_spans(fileid=fileid, userid=userid, timestamp=timestamp, tokenizer=tokenizer)
+        begin = sys_json["begin"]
+        end = sys_json["end"]
+        ref_json = export_spans(
+            fileid=ref_fileid, userid=ref_userid, timestamp=ref_timestamp, tokenizer=tokenizer, begin=begin, end=end
+        )
+        return compute_score_and_diff(sys_json, ref_json, tags)
+
+    # Without a timestamp, the latest save is scored, which can change
+    if not timestamp or not ref_timestamp:
+        return compute(), 200
+    params = dict(userid=userid, ref_userid=ref_userid, tags=tags, tokenizer=tokenizer_id)
+    scores = cached_result("score", params, [(fileid, timestamp), (ref_fileid, ref_timestamp)], compute)
     return scores, 200
 
 
@@ -138,12 +271,33 @@ def post_annotations():
     fileid = request.args.get("fileid")
     autosave = request.args.get("autosave")
     savename = request.args.get("savename")
+    mode = request.args.get("mode", "snapshot")
     autosave = 1 if autosave == "true" else 0
-    annotations = request.get_json()["annotations"]
     if not fileid:
         return {"error": "missing fileid"}, 400
     if not userid:
         return {"error": "missing userid"}, 400
+
+    # Delta mode: only the changed annotations/links are sent, and applied on top of the existing autosave
+    if mode == "delta":
+        if not autosave or not savename:
+            return {"error": "delta saves need autosave=true and a savename"}, 400
+        body = request.get_json()
+        save_info = apply_autosave_delta(
+            fileid,
+            userid,
+            savename,
+            added=body.get("added", []),
+            modified=body.get("modified", []),
+            removed=body.get("removed", []),
+            added_links=body.get("addedLinks", []),
+            removed_links=body.get("removedLinks", []),
+        )
+        if save_info is None:
+            return {"error": "no autosave to apply the delta to, send a full snapshot first"}, 409
+        return save_info, 200
+
+    annotations = request.get_json()["annotations"]
     save_info = insert_annotations(fileid, userid, annotations, autosave=autosave, savename=savename)
     return save_info, 200
 
@@ -186,25 +340,30 @@ def get_annotations_diff():
     if userid is None or fileid is None or timestamps is None:
         return "Bad request: need userid, fileid, and timestamp!", 400
 
-    annos = []
-    result = []
-    begin = 999999999999
-    end = -1
-    for timestamp in timestamps:
-        save_info = load_save_info_from_timestamp(timestamp)
-        anno = load_annotations(fileid, save_info["userid"], timestamp, add_timestamp_to_ids=True)
-        for a in anno:
-            if a["start"] < begin:
-                begin = a["start"]
-            if a["end"] > end:
-                end = a["end"]
-        annos.append(anno)
-        result.append({"annotations": anno, **save_info})
+    def compute():
+        annos = []
+        result = []
+        begin = 999999999999
+        end = -1
+        for timestamp in timestamps:
+            save_info = load_save_info_from_timestamp(timestamp)
+            anno = load_annotations(fileid, save_info["userid"], timestamp, add_timestamp_to_ids=True)
+            for a in anno:
+                if a["start"] < begin:
+                    begin = a["start"]
+                if a["end"] > end:
+                    end = a["end"]
+            annos.append(anno)
+            result.append({"annotations": anno, **save_info})
 
-    tex = load_tex(fileid)
-    diff = compute_annotation_diff(tex, annos, tags, begin, end)
+        tex = load_tex(fileid)
+        diff = compute_annotation_diff(tex, annos, tags, begin, end)
+        return [dict(diff=d, **r) for d, r in zip(diff, result)]
 
-    return jsonify([dict(diff=d, **r) for d, r in zip(diff, result)]), 200
+    # The ids are prefixed with the timestamps as given, so those are part of the key
+    params = dict(timestamps=timestamps, tags=tags)
+    diffs = cached_result("diff", params, [(fileid, timestamp) for timestamp in timestamps], compute)
+    return jsonify(diffs), 200
 
 
 @app.post("/save/finalize")
@@ -246,7 +405,21 @@ def get_all_saves():
 @app.get("/documents")
 @cross_origin()
 def get_all_documents():
-    return {"documents": list_s3_documents()}
+    search = request.args.get("query", "")
+    sort = request.args.get("sort", "")
+    if sort and sort not in documents.SORT_KEYS:
+        return {"error": f"sort must be one of {', '.join(documents.SORT_KEYS)}"}, 400
+    descending = request.args.get("order", "asc") == "desc"
+    offset = request.args.get("offset", "0")
+    limit = request.args.get("limit", "")
+    if not re.fullmatch("[0-9]+", offset):
+        return {"error": "offset must be a non-negative integer"}, 400
+    if limit and not re.fullmatch("[0-9]+", limit):
+        return {"error": "limit must be a non-negative integer"}, 400
+    total, docs = documents.query(
+        search=search, sort=sort, descending=descending, offset=int(offset), limit=int(limit) if limit else None
+    )
+    return {"documents": docs, "total": total}
 
 
 @app.get("/tex")
@@ -296,6 +469,17 @@ def get_savename():
     }, 200
 
 
+@app.get("/stats")
+@cross_origin()
+def get_stats():
+    return {
+        "db_pool": pool_stats(),
+        "tokenizers": tokenizer_stats(),
+        "tex_cache": tex_cache_stats(),
+        "token_cache": token_cache_stats(),
+    }, 200
+
+
 @app.get("/user/admin")
 @cross_origin()
 def get_is_admin():
@@ -321,8 +505,7 @@ def login_user():
 @app.get("/dashboard")
 @cross_origin()
 def get_dashboard_data():
-    tags = ["definition", "theorem", "proof", "example", "name"]
-    data = load_dashboard_data(tags)
+    data = load_dashboard_data(DASHBOARD_TAGS)
     items = []
     for (fileid, start, end), row in data.iterrows():
         items.append(
@@ -366,13 +549,15 @@ def search_for_definition():
     # Do the fuzzysearch
     results = fuzzysearch(query, index, topk=topk, fileid=fileid)
 
-    # Remap the line numbers to the post-folding line numbers
-    new_results = []
+    # Remap the line numbers to the post-folding line numbers, one batch per book
+    by_book = {}
     for match in results:
-        old2new, lines = compute_fold_mapping(match["file"], width)
-        match["line"] = old2new.get(match["line"], match["line"])
-        match["percent"] = int(match["line"]) / int(lines)
-        match["file"] = str(Path(match["file"]).name)
-        new_results.append(match)
-
-    return jsonify({"results": new_results}), 200
+        by_book.setdefault(match["file"], []).append(match)
+    for book, matches in by_book.items():
+        new_lines, lines = map_folded_lines(book, width, [match["line"] for match in matches])
+        for match, line in zip(matches, new_lines):
+            match["line"] = line
+            match["percent"] = int(line) / int(lines)
+            match["file"] = str(Path(book).name)
+
+    return jsonify({"results": results}), 200
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+import argparse
+import logging
+import time
+from typing import NamedTuple, Optional
+
+import psycopg
+from psycopg.rows import dict_row
+
+from . import data_utils
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Key of the advisory lock held while migrating, so that only one worker applies migrations at a time
+MIGRATION_LOCK_ID = 72_019_845
+# Seconds between attempts to take the lock
+MIGRATION_LOCK_POLL = 0.5
+
+
+class Migration(NamedTuple):
+    """A schema change, applied once per database
+
+    `statements` run in a single transaction, then each of `indexes` (name and definition, e.g.
+    `ON annotations (annoid)`) is built with CREATE INDEX CONCURRENTLY so that writes aren't blocked meanwhile.
+    """
+
+    version: int
+    name: str
+    statements: tuple[str, ...] = ()
+    indexes: tuple[tuple[str, str], ...] = ()
+
+
+MIGRATIONS = [
+    Migration(
+        1,
+        "initial_schema",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS users
+            (
+                rowid SERIAL PRIMARY KEY,
+                userid TEXT,
+                password TEXT,
+                UNIQUE (userid)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS annotations
+            (
+                rowid SERIAL PRIMARY KEY,
+                annoid TEXT,
+                fileid TEXT,
+                userid TEXT,
+                start INTEGER,
+                "end" INTEGER,
+                text TEXT,
+                tag TEXT,
+                color TEXT,
+                savename TEXT,
+                autosave INTEGER,
+                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (fileid, userid, start, "end", tag, savename, "timestamp", autosave)
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS links
+            (
+                linkid SERIAL PRIMARY KEY,
+                fileid TEXT,
+                userid TEXT,
+                start INTEGER,
+                "end" INTEGER,
+                tag TEXT,
+                color TEXT,
+                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                source TEXT,
+                target TEXT,
+                UNIQUE (fileid, userid, start, "end", tag, source, target, "timestamp")
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS saves
+            (
+                saveid SERIAL PRIMARY KEY,
+                savename TEXT,
+                start INTEGER,
+                "end" INTEGER,
+                fileid TEXT,
+                userid TEXT,
+                final INTEGER,
+                autosave INTEGER,
+                deleted INTEGER DEFAULT 0,
+                "timestamp" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (savename, fileid, userid, autosave, "timestamp")
+            );
+            """,
+        ),
+    ),
+    Migration(
+        2,
+        "dashboard",
+        statements=(
+            """
+            CREATE TABLE IF NOT EXISTS dashboard_inputs
+            (
+                fileid TEXT,
+                userid TEXT,
+                savename TEXT,
+                "timestamp" TIMESTAMP,
+                initial_userid TEXT,
+                segments JSONB,
+                PRIMARY KEY (fileid, userid, savename, "timestamp")
+            );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS dashboard_groups
+            (
+                fileid TEXT,
+                start INTEGER,
+                "end" INTEGER,
+                tags JSONB,
+                members JSONB,
+                userids JSONB,
+                f1 JSONB,
+                "updated" TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (fileid, start, "end")
+            );
+            """,
+        ),
+    ),
+    Migration(
+        3,
+        "latest_saves",
+        statements=(
+            # Latest annotation timestamp per file, kept up to date by the insert paths
+            """
+            CREATE TABLE IF NOT EXISTS latest_saves
+            (
+                fileid TEXT PRIMARY KEY,
+                "timestamp" TIMESTAMP
+            );
+            """,
+            """
+            INSERT INTO latest_saves (fileid, "timestamp")
+                SELECT fileid, MAX("timestamp") FROM annotations WHERE fileid IS NOT NULL GROUP BY fileid
+            ON CONFLICT (fileid) DO NOTHING;
+            """,
+        ),
+    ),
+    Migration(
+        4,
+        "hot_path_indexes",
+        indexes=(
+            # load_annotations, latest_saves upkeep and the /annotations/all join
+            ("annotations_fileid_timestamp", 'ON annotations (fileid, "timestamp")'),
+            # latest save of a user, saves listing and the dashboard's "has annotations" check
+            ("annotations_fileid_userid_timestamp", 'ON annotations (fileid, userid, "timestamp")'),
+            # load_anno_from_annoid
+            ("annotations_annoid", "ON annotations (annoid)"),
+            # links of an annotation, with or without the save's timestamp
+            ("links_source_timestamp", 'ON links (source, "timestamp")'),
+            # autosave deltas
+            ("links_userid_timestamp", 'ON links (userid, "timestamp")'),
+            # load_save_info_from_timestamp
+            ("saves_timestamp", 'ON saves ("timestamp")'),
+            # get_initial_user_from_savename and the dashboard
+            ("saves_savename_timestamp", 'ON saves (savename, "timestamp")'),
+            # dashboard groups
+            ("saves_final_groups", 'ON saves (fileid, start, "end") WHERE final = 1 AND deleted = 0'),
+        ),
+    ),
+    Migration(
+        5,
+        "result_cache",
+        statements=(
+            # Score and diff results, with the saves (`<fileid>/<timestamp>`) each one was computed from
+            """
+            CREATE TABLE IF NOT EXISTS result_cache
+            (
+                key TEXT PRIMARY KEY,
+                saves TEXT[],
+                result TEXT,
+                used TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """,
+        ),
+        indexes=(
+            # invalidation when a save is deleted or (un)finalized
+            ("result_cache_saves", "ON result_cache USING GIN (saves)"),
+            # least recently used results, pruned past RESULT_CACHE_SIZE
+            ("result_cache_used", "ON result_cache (used)"),
+        ),
+    ),
+]
+
+
+def _apply(conn: psycopg.Connection, migration: Migration):
+    start = time.perf_counter()
+    with conn.transaction():
+        for statement in migration.statements:
+            conn.execute(statement)
+
+    for name, definition in migration.indexes:
+        # A concurrent build that failed leaves an invalid index behind, which IF NOT EXISTS would keep
+        index = conn.execute(
+            """
+            SELECT i.indisvalid AS valid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s AND pg_table_is_visible(c.oid);
+            """,
+            (name,),
+        ).fetchone()
+        if index is not None and not index["valid"]:
+            conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} {definition};")
+
+    conn.execute(
+        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s);", (migration.version, migration.name)
+    )
+    logger.info(f"Applied migration {migration.version} ({migration.name}) in {time.perf_counter() - start:.2f}s")
+
+
+def _lock(conn: psycopg.Connection):
+    # Poll rather than block in pg_advisory_lock: a waiting statement holds a snapshot, which CREATE INDEX
+    # CONCURRENTLY in the session holding the lock would wait on, deadlocking both
+    while not conn.execute("SELECT pg_try_advisory_lock(%s) AS locked;", (MIGRATION_LOCK_ID,)).fetchone()["locked"]:
+        time.sleep(MIGRATION_LOCK_POLL)
+
+
+def migrate(conn_str: Optional[str] = None, target: Optional[int] = None) -> list[int]:
+    """Applies pending migrations (up to `target`, if given) and returns their versions
+
+    Runs on its own autocommit connection, since concurrent index builds can't run inside a transaction. Workers
+    starting at the same time wait on an advisory lock, then find nothing left to do.
+    """
+    conn_str = conn_str or data_utils.CONN_STR
+    applied = []
+    with psycopg.connect(conn_str, autocommit=True, row_factory=dict_row) as conn:
+        _lock(conn)
+        try:
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS schema_migrations
+                (
+                    version INTEGER PRIMARY KEY,
+                    name TEXT,
+                    applied TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                """
+            )
+            done = {row["version"] for row in conn.execute("SELECT version FROM schema_migrations;")}
+            for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+                if migration.version in done or (target is not None and migration.version > target):
+                    continue
+                _apply(conn, migration)
+                applied.append(migration.version)
+        finally:
+            conn.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+    return applied
+
+
+def migration_status(conn_str: Optional[str] = None) -> list[dict]:
+    """Every known migration, with when it was applied (None if pending)"""
+    with psycopg.connect(conn_str or data_utils.CONN_STR, row_factory=dict_row) as conn:
+        exists = conn.execute("SELECT to_regclass('schema_migrations') IS NOT NULL AS exists;").fetchone()["exists"]
+        rows = conn.execute("SELECT version, applied FROM schema_migrations;").fetchall() if exists else []
+    applied = {row["version"]: row["applied"] for row in rows}
+    return [dict(version=m.version, name=m.name, applied=applied.get(m.version)) for m in MIGRATIONS]
+
+
+def check_migrations(conn_str: Optional[str] = None):
+    """Raises if any migration is pending
+
+    The app doesn't migrate by itself: index builds on large tables can outlast a worker's boot timeout. Migrations
+    run once per deploy instead, through `rye run migrate` or gunicorn's `on_starting` hook.
+    """
+    pending = [f"{row['version']} ({row['name']})" for row in migration_status(conn_str) if row["applied"] is None]
+    if pending:
+        raise RuntimeError(f"Pending database migrations {', '.join(pending)}; run `rye run migrate` first")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Database schema migrations")
+    parser.add_argument("command", choices=["migrate", "status"], nargs="?", default="migrate")
+    parser.add_argument("--target", type=int, default=None, help="stop after this version")
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        applied = migrate(target=args.target)
+        logger.info(f"Applied {len(applied)} migration(s)")
+    else:
+        for row in migration_status():
+            print(f"{row['version']:>4}  {row['name']:<24} {row['applied'] or 'pending'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,160 @@
 #!/usr/bin/env python3
 
-from sklearn.metrics import f1_score, precision_score, recall_score
-from sklearn.preprocessing import MultiLabelBinarizer
+import numpy as np
 from transformers import BatchEncoding
 
+from .spans import Segment, decode_spans
 
-def compute_annotation_score(sys: list[list[str]], ref: list[list[str]], tags: list[str]):
-    assert len(sys) == len(ref), "System and reference must be the same length!"
-    ref_no_prefix = [[r.replace('B-', '').replace('I-', '') for r in rs]  for rs in ref]
-    sys_no_prefix = [[s.replace('B-', '').replace('I-', '') for s in ss]  for ss in sys]
 
-    flat_ref = [r for rs in ref_no_prefix for r in rs]
-    flat_sys = [s for ss in sys_no_prefix for s in ss]
-    # Classes should be at most tags, but we want to only count the ones that have been actually annotated (otherwise scores will be weird)
-    classes = list(set(tags).intersection(set(flat_ref).union(set(flat_sys))))
-    mlb = MultiLabelBinarizer(classes=classes)
-    ref_bin = mlb.fit_transform(ref_no_prefix)
-    sys_bin = mlb.transform(sys_no_prefix)
+def _strip_prefix(tag: str) -> str:
+    return tag.replace("B-", "").replace("I-", "")
+
+
+def _row_labels(rows: list[list[str]]) -> list[tuple[str, ...]]:
+    """Strips the B-/I- prefixes of every position's tags
+
+    Positions often share the same list object (see `spans.expand_segments`), so each distinct list is only
+    processed once.
+    """
+    seen: dict[int, tuple[str, ...]] = {}
+    result = []
+    for tags in rows:
+        labels = seen.get(id(tags))
+        if labels is None:
+            labels = tuple(_strip_prefix(t) for t in tags)
+            seen[id(tags)] = labels
+        result.append(labels)
+    return result
+
+
+def tag_masks(rows: list[tuple[str, ...]], classes: list[str]) -> np.ndarray:
+    """Packs prefix-free tags into one boolean row per class
+
+    Parameters
+    ----------
+    rows : list[tuple[str, ...]]
+        Tags at each position, without B-/I- prefixes
+    classes : list[str]
+        Classes to keep; other tags are ignored
+
+    Returns
+    -------
+    np.ndarray
+        `(len(classes), len(rows))` boolean array, true where the class is present
+    """
+    index = {c: i for i, c in enumerate(classes)}
+    masks = np.zeros((len(classes), len(rows)), dtype=bool)
+    cols: dict[tuple[str, ...], list[int]] = {}
+    row_idx, class_idx = [], []
+    for pos, labels in enumerate(rows):
+        hits = cols.get(labels)
+        if hits is None:
+            hits = sorted({index[l] for l in labels if l in index})
+            cols[labels] = hits
+        for c in hits:
+            class_idx.append(c)
+            row_idx.append(pos)
+    masks[class_idx, row_idx] = True
+    return masks
+
+
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    # Same as sklearn's `_prf_divide` with zero_division=0
+    mask = denominator == 0.0
+    denominator = denominator.copy()
+    denominator[mask] = 1
+    result = numerator / denominator
+    result[mask] = 0.0
+    return result
+
+
+def score_tag_masks(sys_masks: np.ndarray, ref_masks: np.ndarray, classes: list[str]) -> dict:
+    """Macro F1/precision/recall plus a per-class breakdown, in one pass over the masks
+
+    Parameters
+    ----------
+    sys_masks, ref_masks : np.ndarray
+        `(len(classes), n)` boolean arrays from `tag_masks`
+    classes : list[str]
+        Class of each row of the masks
+
+    Returns
+    -------
+    dict
+        See `score_tag_counts`
+    """
+    tp = np.count_nonzero(sys_masks & ref_masks, axis=1)
+    pred = np.count_nonzero(sys_masks, axis=1)
+    true = np.count_nonzero(ref_masks, axis=1)
+    return score_tag_counts(tp, pred, true, sys_masks.shape[1], classes)
+
+
+def score_tag_counts(tp: np.ndarray, pred: np.ndarray, true: np.ndarray, n: int, classes: list[str]) -> dict:
+    """Macro F1/precision/recall plus a per-class breakdown from per-class counts
+
+    Reproduces sklearn's `f1_score`/`precision_score`/`recall_score` with `average="macro"` and `zero_division=0` on
+    the equivalent multilabel-indicator matrices, including its quirk of treating a single class as a binary problem
+    whose 0 and 1 labels are both averaged over.
+
+    Parameters
+    ----------
+    tp, pred, true : np.ndarray
+        Number of positions per class that are tagged in both, in the system and in the reference
+    n : int
+        Number of positions
+    classes : list[str]
+        Class of each count
+
+    Returns
+    -------
+    dict
+        `f1`, `precision` and `recall` (macro averaged), and `per_tag` with the same metrics and the support per class
+    """
+    if len(classes) == 0:
+        raise ValueError("No annotated classes to score")
+
+    precision = _divide(tp, pred)
+    recall = _divide(tp, true)
+    f1 = _divide(2.0 * tp, 1.0 * true + pred)
+    per_tag = {
+        c: {"f1": float(f1[i]), "precision": float(precision[i]), "recall": float(recall[i]), "support": int(true[i])}
+        for i, c in enumerate(classes)
+    }
+
+    if len(classes) == 1:
+        # Binary problem: average over whichever of the labels 0/1 occur
+        tn = n - pred[0] - true[0] + tp[0]
+        labels = []
+        if (n - pred[0]) > 0 or (n - true[0]) > 0:
+            labels.append((tn, n - pred[0], n - true[0]))
+        if pred[0] > 0 or true[0] > 0:
+            labels.append((tp[0], pred[0], true[0]))
+        tp, pred, true = (np.array(x) for x in zip(*labels))
+        precision = _divide(tp, pred)
+        recall = _divide(tp, true)
+        f1 = _divide(2.0 * tp, 1.0 * true + pred)
 
     return {
-        "f1": f1_score(ref_bin, sys_bin, average="macro", zero_division=0),
-        "precision": precision_score(ref_bin, sys_bin, average="macro", zero_division=0),
-        "recall": recall_score(ref_bin, sys_bin, average="macro", zero_division=0),
+        "f1": float(np.nanmean(f1)),
+        "precision": float(np.nanmean(precision)),
+        "recall": float(np.nanmean(recall)),
+        "per_tag": per_tag,
     }
 
+
+def compute_annotation_score(sys: list[list[str]], ref: list[list[str]], tags: list[str]):
+    assert len(sys) == len(ref), "System and reference must be the same length!"
+    ref_labels = _row_labels(ref)
+    sys_labels = _row_labels(sys)
+
+    # Build the label sets in order of first occurrence, which gives them the same iteration order (and thus the same
+    # class order and float summation order) as sets built from the flattened tag lists
+    ref_present = set(l for labels in dict.fromkeys(ref_labels) for l in labels)
+    sys_present = set(l for labels in dict.fromkeys(sys_labels) for l in labels)
+    # Classes should be at most tags, but we want to only count the ones that have been actually annotated (otherwise scores will be weird)
+    classes = list(set(tags).intersection(ref_present.union(sys_present)))
+    return score_tag_masks(tag_masks(sys_labels, classes), tag_masks(ref_labels, classes), classes)
+
 def compute_textual_diff(anno_a: list[tuple[int, int, str, str]], anno_b: list[tuple[int, int, str, str]], tags: list[str]):
     anno_a = sorted(set(map(tuple, anno_a)))
     anno_b = sorted(set(map(tuple, anno_b)))
@@ -50,9 +181,19 @@ def compute_textual_diff(anno_a: list[tuple[int, int, str, str]], anno_b: list[t
 
 def compute_score_and_diff(system: dict[str, list], reference: dict[str, list], tags: list[str]):
     # Get f1 score
-    tags_sys = [tag for text, tag in system['iob_tags']]
-    tags_ref = [tag for text, tag in reference['iob_tags']]
-    scores = compute_annotation_score(tags_sys, tags_ref, tags)
+    if 'spans' in system and 'spans' in reference:
+        # Compact exports are scored on their runs, without expanding them
+        from .agreement import pack_segments, score_packed
+
+        packed_sys = pack_segments(decode_spans(system['spans']))
+        packed_ref = pack_segments(decode_spans(reference['spans']))
+        scores = score_packed(packed_sys, packed_ref, tags)
+        num_tokens = packed_ref.length
+    else:
+        tags_sys = [tag for text, tag in system['iob_tags']]
+        tags_ref = [tag for text, tag in reference['iob_tags']]
+        scores = compute_annotation_score(tags_sys, tags_ref, tags)
+        num_tokens = len(tags_ref)
 
     # Get diff string
     annos_sys = [(anno['start'], anno['end'], anno['tag'], anno['text']) for anno in system['annotations']]
@@ -68,7 +209,7 @@ def compute_score_and_diff(system: dict[str, list], reference: dict[str, list],
     return f"""F1: {scores['f1']}
 Precision: {scores['precision']}
 Recall: {scores['recall']}
-#Tokens: {len(tags_ref)}
+#Tokens: {num_tokens}
 #Tags in system: {len(system['annotations'])}
 #Tags in reference: {len(reference['annotations'])}
 
@@ -99,44 +240,95 @@ def align_annotations_to_tokens(tokens: BatchEncoding, char_tags: list[list[str]
             continue
 
         tags_for_token = list({tag for token_tags in char_tags[span.start : span.end] for tag in token_tags})
-        if "O" in tags_for_token and len(tags_for_token) > 1:
-            tags_for_token.remove("O")
-
-        # Ensure that we only have B- or I- but not both
-        for tag in tags_for_token:
-            b = tag.replace("I-", "B-")
-            i = tag.replace("B-", "I-")
-            if b in tags_for_token and i in tags_for_token:
-                tags_for_token.remove(i)
-        aligned_tags.append(tags_for_token)
+        aligned_tags.append(_dedup_token_tags(tags_for_token))
     return aligned_tags
 
 
+def _dedup_token_tags(tags_for_token: list[str]) -> list[str]:
+    if "O" in tags_for_token and len(tags_for_token) > 1:
+        tags_for_token.remove("O")
+
+    # Ensure that we only have B- or I- but not both
+    for tag in tags_for_token:
+        b = tag.replace("I-", "B-")
+        i = tag.replace("B-", "I-")
+        if b in tags_for_token and i in tags_for_token:
+            tags_for_token.remove(i)
+    return tags_for_token
+
+
+def align_segments_to_tokens(tokens: BatchEncoding, segments: list[Segment]) -> list[list[str]]:
+    """Converts character-level tag runs to token-level tags
 
-def find_annos_at_index(annos: list[dict], index: int) -> set[tuple[int, int, str]]:
-    """Finds annotations which overlap with a given character index
+    Same output as `align_annotations_to_tokens` on the expanded runs, but each token only looks at the runs its
+    character span overlaps (found through the offset mapping), so the cost is proportional to the number of tokens
+    and runs rather than characters. Tokens overlapping the same runs share the same list object.
 
     Parameters
     ----------
-    annos : list[dict]
-        List of annotations to search through
-    index : int
-        Character index to consider
+    tokens : BatchEncoding
+        Output of a (fast) huggingface tokenizer on text, called with `return_offsets_mapping=True`, or of
+        `data_utils.TokenCache.tokenize`
+    segments : list[Segment]
+        Character-level tags as contiguous runs, from `spans.compute_tag_segments`
 
     Returns
     -------
-    set[tuple[int, int, str]]
-        Set of (start, end, tag) tuples which overlap with the index
+    list[list[str]]
+        Token-level tags (list of tags per token)
     """
+    token_ranges, range_tags = align_segments_to_token_ranges(tokens, segments)
+    return [range_tags[i] for i in token_ranges.tolist()]
 
-    result = set()
-    for anno in annos:
-        start = anno["start"]
-        end = anno["end"]
-        tag = anno["tag"]
-        if start <= index <= end:
-            result.add((start, end, tag))
-    return result
+
+def align_segments_to_token_ranges(
+    tokens: BatchEncoding, segments: list[Segment]
+) -> tuple[np.ndarray, list[list[str]]]:
+    """Same as `align_segments_to_tokens`, without building the list of tags of every token
+
+    Parameters
+    ----------
+    tokens : BatchEncoding
+        Output of a (fast) huggingface tokenizer on text, called with `return_offsets_mapping=True`, or of
+        `data_utils.TokenCache.tokenize`
+    segments : list[Segment]
+        Character-level tags as contiguous runs, from `spans.compute_tag_segments`
+
+    Returns
+    -------
+    np.ndarray
+        For each token, the index of its tags in the second value
+    list[list[str]]
+        Tags of each distinct range of runs overlapped by a token
+    """
+    if len(tokens["offset_mapping"]) == 0:
+        return np.zeros(0, dtype=np.int64), []
+
+    offsets = np.asarray(tokens["offset_mapping"], dtype=np.int64).reshape(-1, 2)
+    # Special tokens don't map to any characters; cached tokenizations (see `data_utils.TokenCache`) have none
+    if tokens.encodings is not None:
+        keep = np.array([sequence_id is not None for sequence_id in tokens.sequence_ids()], dtype=bool)
+        offsets = offsets[keep]
+
+    starts = np.array([start for start, _, _ in segments], dtype=np.int64)
+    length = segments[-1][1] if segments else 0
+    token_start = offsets[:, 0]
+    token_end = np.minimum(offsets[:, 1], length)
+
+    # Runs [first, last) overlapped by each token; empty tokens get the empty range
+    first = np.searchsorted(starts, token_start, side="right") - 1
+    last = np.searchsorted(starts, token_end, side="left")
+    empty = token_start >= token_end
+    first[empty] = 0
+    last[empty] = 0
+
+    # Work out the tags once per distinct range
+    stride = len(segments) + 1
+    keys, inverse = np.unique(first * stride + last, return_inverse=True)
+    range_tags = []
+    for lo, hi in zip((keys // stride).tolist(), (keys % stride).tolist()):
+        range_tags.append(_dedup_token_tags(list({tag for _, _, run_tags in segments[lo:hi] for tag in run_tags})))
+    return inverse.reshape(-1), range_tags
 
 
 def compute_annotation_diff(tex: str, annos_list: list[list[dict]], tags: list[str], start: int, end: int) -> list[list[dict]]:
@@ -145,6 +337,12 @@ def compute_annotation_diff(tex: str, annos_list: list[list[dict]], tags: list[s
     Given a list of annotation sets `annos_list` and a set of tags to compare `tags`, filter out
     every annotation which appears in all sets.
 
+    An annotation is identified by its `(start, end, tag)` key and covers every character index in
+    `[start, end]`, so whether it is shared by all sets doesn't depend on the position being looked at.
+    An annotation is therefore part of the diff iff its tag is in `tags`, its key is missing from at
+    least one set, and it covers at least one character of `tex[start : end + 1]`. That makes this
+    linear in the number of annotations instead of scanning every character.
+
     Parameters
     ----------
     tex : str
@@ -164,24 +362,19 @@ def compute_annotation_diff(tex: str, annos_list: list[list[dict]], tags: list[s
         A filtered version of `annos_list` containing annotations which don't appear in every annotation set.
     """
 
-    N = len(annos_list)
-    tex = tex[start : end + 1]
+    if len(annos_list) == 0:
+        return []
 
-    # Initialize the diffs, empty list for each character index
-    annos_at_index = [[set() for _ in tex] for _ in annos_list]
-    diffs = [set() for _ in annos_list]
+    # Last character index covered by the comparison window
+    last = start + len(tex[start : end + 1]) - 1
+    tags = set(tags)
 
-    # for each character, add all the annotations that exist at that index
-    for idx, char in enumerate(tex):
-        for anno_idx, annos in enumerate(annos_list):
-            annos_at_index[anno_idx][idx] = find_annos_at_index(annos, idx + start)
+    keys = [{(a["start"], a["end"], a["tag"]) for a in annos} for annos in annos_list]
+    shared = set.intersection(*keys)
 
-        # now compute the diffs
-        intersection = set.intersection(*(annos_at_index[i][idx] for i in range(N)))
-        for a in range(N):
-            # only add diffs for those things that are in the tags
-            annos = [i for i in annos_at_index[a][idx].difference(intersection) if i[-1] in tags]
-            diffs[a].update(annos)
+    def in_diff(anno: dict) -> bool:
+        key = (anno["start"], anno["end"], anno["tag"])
+        return anno["tag"] in tags and key not in shared and max(anno["start"], start) <= min(anno["end"], last)
 
     # Return a list of annotations which are part of the diff
-    return [[a for a in annos_list[idx] if (a["start"], a["end"], a["tag"]) in d] for idx, d in enumerate(diffs)]
+    return [[a for a in annos if in_diff(a)] for annos in annos_list]
@@ -1,23 +1,44 @@
-from functools import lru_cache
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from multiprocessing import get_context
+from typing import Optional, Union
+import fcntl
+import hashlib
+import json
 import os
-import re
+import sys
+import threading
 from pathlib import Path
-from subprocess import PIPE, STDOUT, Popen
-import subprocess
 from tqdm import tqdm
 
 import gdown
 import numpy as np
 import pandas as pd
 import logging
+import regex
 from rapidfuzz import process, fuzz
 from rapidfuzz.distance.LCSseq import normalized_distance, normalized_similarity
 
-from .data_utils import list_s3_documents, load_tex
+from .corpus import CorpusSource, CorpusSync
+from .data_utils import ByteLRUCache, documents, load_tex, tex_cache
+from .folding import FoldMapping, fold_mapping
+from .indexer import INDEX_WORKERS, compile_patterns, index_tex
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Memory budget for the definition indexes kept resident once loaded
+DEFINITION_INDEX_CACHE_BYTES = int(os.environ.get("DEFINITION_INDEX_CACHE_BYTES", 512 * 1024 * 1024))
+definition_indexes = ByteLRUCache(DEFINITION_INDEX_CACHE_BYTES)
+# Length of the character n-grams used to narrow down the rows a query can match
+SEARCH_NGRAM = 3
+# Threads used to score a query; -1 uses every core
+SEARCH_WORKERS = int(os.environ.get("SEARCH_WORKERS", -1))
+# Memory budget for the line mappings of folded books, by book and width
+FOLD_CACHE_BYTES = int(os.environ.get("FOLD_CACHE_BYTES", 64 * 1024 * 1024))
+fold_mappings = ByteLRUCache(FOLD_CACHE_BYTES)
+
 patterns = [
     r"an\? \([^ ]* \)*is an\? ",
     r"an\? \([^ ]* \)*is an\? \([^ ]* \)*if",
@@ -43,54 +64,35 @@ def list_all_textbooks():
     return df
 
 
-def download_books(output_dir: str):
+def list_textbooks() -> dict[str, str]:
+    """Google Drive URL of every textbook in the sheet, by name"""
     df = list_all_textbooks()
-    for tex_url, name in zip(df["tex"], df["name"]):
-        outputfile = Path(output_dir, name).with_suffix(".tex")
-        if outputfile.exists():
-            continue
-        with open(outputfile, "wb") as f:
-            tex_out = gdown.download(tex_url, f, quiet=True, fuzzy=True)
-
-    return [str(Path(output_dir, name).with_suffix(".tex")) for name in df["name"]]
-
-
-def download_papers(output_dir: str):
-    names = [x["name"] for x in list_s3_documents()]
-    for name in names:
-        outputfile = Path(output_dir, name).with_suffix(".tex")
-        if outputfile.exists():
-            continue
-        try:
-            logger.info(f"downloading {name}")
-            tex = load_tex(name)
-            with open(outputfile, "w") as f:
-                f.write(tex)
-        except:
-            logger.error(f"failed to get {name}")
-            continue
-
-    return [str(Path(output_dir, name).with_suffix(".tex")) for name in names]
-
-
-def index_tex(patterns: tuple[str, ...], tex: str, type: str):
-    p = Popen(
-        ["grep", "-oin", r"\|".join(patterns), tex],
-        stdout=PIPE,
-        stderr=STDOUT,
-    )
-    searched = []
-    for match in p.communicate()[0].decode().strip().split("\n"):
-        groups = re.match(r"(\d+):(.*)", match)
-        if groups is None:
-            continue
-        linenum, rest = groups.groups()
-        searched.append((tex, type, int(linenum), rest))
-
-    return searched
-
-
-def build_definition_index(patterns: list[str], books: list[str], papers: list[str]):
+    return dict(zip(df["name"], df["tex"]))
+
+
+def fetch_textbook(name: str, tex_url: str, path: Path):
+    if gdown.download(tex_url, str(path), quiet=True, fuzzy=True) is None:
+        raise OSError(f"could not download {tex_url}")
+
+
+def list_papers() -> dict[str, str]:
+    """S3 ETag of every paper, by name"""
+    return documents.versions()
+
+
+def fetch_paper(name: str, etag: str, path: Path):
+    # The listing says it changed, so don't trust a copy cached before that
+    tex_cache.expire(name)
+    path.write_text(load_tex(name))
+
+
+# Textbooks are versioned by their Drive URL, as Drive doesn't give a cheap content version
+CORPUS_SOURCES = [CorpusSource("book", list_textbooks, fetch_textbook), CorpusSource("paper", list_papers, fetch_paper)]
+
+
+def build_definition_index(
+    patterns: list[str], books: list[str], papers: list[str], workers: int = INDEX_WORKERS
+) -> pd.DataFrame:
     """Grep
 
     Greps through all the `books` using `patterns` and saves the result as a csv
@@ -101,27 +103,85 @@ def build_definition_index(patterns: list[str], books: list[str], papers: list[s
         A list of patterns to pass to grep, to be or'd together
     books : list[str]
         A list of paths to books to search through
+    papers : list[str]
+        A list of paths to papers to search through
+    workers : int
+        Number of processes the files are split over; with 0 or 1, they're searched in the calling process
 
     Returns
     -------
     pd.DataFrame :
         DataFrame with columns `[file, type, line, text]`
     """
+    columns = ["file", "type", "line", "text"]
+    try:
+        compile_patterns(tuple(patterns))
+    except (ValueError, regex.error) as e:
+        # grep failed on every file, which left the index empty
+        logger.error(f"invalid definition patterns: {e}")
+        return pd.DataFrame([], columns=columns)
+
+    files = books + papers
+    types = ["book"] * len(books) + ["paper"] * len(papers)
+    if workers <= 1 or len(files) <= 1:
+        results = map(index_tex, repeat(tuple(patterns)), files, types)
+        searched = [record for records in results for record in records]
+    else:
+        # Spawned like the agreement workers, so they don't inherit the web worker's threads
+        with ProcessPoolExecutor(min(workers, len(files)), mp_context=get_context("spawn")) as pool:
+            results = pool.map(index_tex, repeat(tuple(patterns)), files, types)
+            searched = [record for records in results for record in records]
 
-    searched = []
-    for book in books:
-        # Create definition index
-        searched.extend(index_tex(tuple(patterns), book, "book"))
-    for paper in papers:
-        # Create definition index
-        searched.extend(index_tex(tuple(patterns), paper, "paper"))
-
-    df = pd.DataFrame.from_records(searched, columns=["file", "type", "line", "text"])
+    df = pd.DataFrame.from_records(searched, columns=columns)
     return df
 
 
-@lru_cache(maxsize=100)
-def compute_fold_mapping(book: str, width: int):
+def update_definition_index(
+    patterns: list[str],
+    manifest: list[tuple[str, str, int, int]],
+    previous: Optional[pd.DataFrame] = None,
+    previous_manifest: Optional[list[tuple[str, str, int, int]]] = None,
+) -> pd.DataFrame:
+    """Definition index of the files in `manifest`, only re-indexing those that changed since `previous`
+
+    Parameters
+    ----------
+    patterns : list[str]
+        Patterns `previous` was built with
+    manifest : list[tuple[str, str, int, int]]
+        Files to index, see `corpus_manifest`
+    previous : pd.DataFrame, optional
+        An earlier index; everything is indexed if not given
+    previous_manifest : list[tuple[str, str, int, int]], optional
+        Files `previous` was built from
+
+    Returns
+    -------
+    pd.DataFrame :
+        Same as `build_definition_index` over every file
+    """
+    before = set(map(tuple, previous_manifest or [])) if previous is not None else set()
+    changed = [(path, type) for path, type, *stat in manifest if (path, type, *stat) not in before]
+    books = [path for path, type in changed if type == "book"]
+    papers = [path for path, type in changed if type == "paper"]
+    logger.info(f"Indexing {len(changed)} of {len(manifest)} files...")
+    df = build_definition_index(patterns, books, papers)
+    if previous is None or len(changed) == len(manifest):
+        return df
+
+    unchanged = {(path, type) for path, type, *stat in manifest if (path, type, *stat) in before}
+    kept = previous[[(file, type) in unchanged for file, type in zip(previous["file"], previous["type"])]]
+    parts = [part for part in (kept, df) if len(part)]
+    if not parts:
+        return df
+    merged = pd.concat(parts, ignore_index=True)
+    # Same order as when indexing everything at once: by file, then by position in the file
+    order = {(path, type): i for i, (path, type, *_) in enumerate(manifest)}
+    rank = [order[(file, type)] for file, type in zip(merged["file"], merged["type"])]
+    return merged.iloc[np.argsort(rank, kind="stable")].reset_index(drop=True)
+
+
+def compute_fold_mapping(book: str, width: int) -> FoldMapping:
     """Reindex a book's old lines to post-folding lines
 
     Parameters
@@ -131,66 +191,177 @@ def compute_fold_mapping(book: str, width: int):
 
     Returns
     -------
-    tuple :
-        Tuple containing `old2new` (mapping between old/new line numbers) and `lines` (total line count of post-folding)
+    FoldMapping :
+        Mapping between old/new line numbers and total line count of post-folding, see `folding.fold_mapping`
+    """
+    stat = os.stat(book)
+    key = (book, width, stat.st_size, stat.st_mtime_ns)
+    mapping = fold_mappings.get(key)
+    if mapping is None:
+        mapping = fold_mapping(Path(book).read_bytes(), width)
+        fold_mappings.put(key, mapping, mapping.nbytes)
+    return mapping
+
+
+def map_folded_lines(book: str, width: int, lines: list[int]) -> tuple[list[int], int]:
+    """Post-folding line of each of `lines` (unchanged if not mapped), and the total line count of post-folding"""
+    mapping = compute_fold_mapping(book, width)
+    return mapping.map(lines).tolist(), mapping.lines
+
+
+def _patterns_digest(patterns: list[str]) -> str:
+    return hashlib.sha256(json.dumps(list(patterns)).encode()).hexdigest()
+
+
+def corpus_manifest(files: list[tuple[str, str]]) -> list[tuple[str, str, int, int]]:
+    """Path, type, size and mtime (ns) of each `(path, type)` in the corpus; missing files have size and mtime -1"""
+    manifest = []
+    for path, type in files:
+        try:
+            stat = os.stat(path)
+            manifest.append((path, type, stat.st_size, stat.st_mtime_ns))
+        except OSError:
+            manifest.append((path, type, -1, -1))
+    return manifest
+
+
+def definition_index_key(patterns: list[str], manifest: list[tuple[str, str, int, int]]) -> str:
+    """Digest of the patterns and the state of the files an index was built from, stable across processes"""
+    return hashlib.sha256(json.dumps(dict(patterns=list(patterns), files=manifest)).encode()).hexdigest()
+
+
+def _definition_index_path(tex_dir: str, patterns: list[str], key: str) -> Path:
+    return Path(tex_dir, f"index.{_patterns_digest(patterns)}.{key}.feather")
+
+
+def _definition_index_pointer(tex_dir: str, patterns: list[str]) -> Optional[dict]:
+    """Key and manifest of the latest index for `patterns`"""
+    try:
+        pointer = json.loads(Path(tex_dir, f"index.{_patterns_digest(patterns)}.json").read_text())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(pointer, dict) or "key" not in pointer or "files" not in pointer:
+        return None
+    pointer["files"] = [tuple(entry) for entry in pointer["files"]]
+    return pointer
+
+
+def _cached_definition_index(tex_dir: str, patterns: list[str], key: str) -> Optional["DefinitionSearch"]:
+    engine = definition_indexes.get(key)
+    if engine is not None:
+        return engine
+    path = _definition_index_path(tex_dir, patterns, key)
+    try:
+        df = pd.read_feather(path)
+    except OSError:
+        return None
+    logger.info(f"Found cache: loading from {path.name}")
+    engine = DefinitionSearch(df)
+    definition_indexes.put(key, engine, engine.nbytes)
+    return engine
+
+
+def _load_definition_index(tex_dir: str, patterns: list[str]) -> Optional["DefinitionSearch"]:
+    """Resident or on-disk index for `patterns`, if the files it was built from haven't changed since"""
+    pointer = _definition_index_pointer(tex_dir, patterns)
+    if pointer is None or corpus_manifest([entry[:2] for entry in pointer["files"]]) != pointer["files"]:
+        return None
+    return _cached_definition_index(tex_dir, patterns, pointer["key"])
+
+
+def _write_atomic(path: Path, write):
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def download_and_index_tex(
+    tex_dir: str, extraPatterns: list[str], sources: Optional[list[CorpusSource]] = None
+) -> "DefinitionSearch":
+    """Search over the definition index of the corpus in `tex_dir` for `extraPatterns`, syncing and indexing it if
+    needed
+
+    Indexes are stored as `index.<patterns digest>.<key>.feather`, where the key digests the patterns and the path,
+    size and mtime of every indexed file, and `index.<patterns digest>.json` holds the key and files of the latest one.
+    Once loaded, an index stays in memory, ready to search, until evicted from `definition_indexes`.
+
+    Every `CORPUS_SYNC_TTL` seconds, new and changed documents are downloaded from `sources` (`CORPUS_SOURCES` by
+    default), and only their files are re-indexed. That happens in the background while the current index is served;
+    only a worker without any index waits for it.
     """
-    # Get total lines for book
-    fold = Popen(
-        ["fold", "-s", "-w", str(width), book],
-        stdout=PIPE,
-    )
-    wc = Popen(
-        ["wc", "-l"],
-        stdin=fold.stdout,
-        stdout=PIPE,
-        stderr=STDOUT,
-    )
-    lines = int(wc.communicate()[0].decode().strip())
-
-    # Get mapping between old/new line numbers
-    nl = Popen(
-        ["nl", "-ba", "-w2", "-s", ":::", book],
-        stdout=PIPE,
-        stderr=STDOUT,
-    )
-    fold = Popen(
-        ["fold", "-s", "-w", str(width)],
-        stdin=nl.stdout,
-        stdout=PIPE,
-        stderr=STDOUT,
-    )
-    cmd = ["grep", "-oin", r"^[0-9]\+:::"]
-
-    fold_out = fold.communicate()[0]
-    grep_out = subprocess.check_output(
-        cmd,
-        input=fold_out,
-        # stdout=PIPE,
-        stderr=STDOUT,
-    ).decode()
-
-    old2new = {}
-    for line in grep_out.splitlines():
-        new, old, *_ = line.split(":")
-        old2new[int(old)] = int(new)
-    return (old2new, lines)
-
-
-def download_and_index_tex(tex_dir: str, extraPatterns: list[str]):
-    uniq = hash(",".join(extraPatterns))
-    save_file = Path(tex_dir, f"index.{uniq}.csv")
-    if save_file.exists():
-        logger.info(f"Found cache: loading from index.{uniq}.csv")
-        return pd.read_csv(save_file)
-    logger.info("Cache miss, need to re-index...")
+    corpus = CorpusSync(tex_dir, CORPUS_SOURCES if sources is None else sources)
+    engine = _load_definition_index(tex_dir, extraPatterns)
+    if engine is None:
+        return _sync_definition_index(tex_dir, extraPatterns, corpus, blocking=True)
+
+    if corpus.due() and _refreshing.acquire(blocking=False):
+        thread = threading.Thread(target=_refresh_definition_index, args=(tex_dir, extraPatterns, corpus), daemon=True)
+        thread.start()
+    return engine
+
+
+# Held while a thread of this worker refreshes an index in the background
+_refreshing = threading.Lock()
+
+
+def _refresh_definition_index(tex_dir: str, extraPatterns: list[str], corpus: CorpusSync):
+    try:
+        _sync_definition_index(tex_dir, extraPatterns, corpus, blocking=False)
+    except Exception:
+        logger.exception("Failed to refresh the definition index, serving the previous one")
+    finally:
+        _refreshing.release()
+
+
+def _sync_definition_index(
+    tex_dir: str, extraPatterns: list[str], corpus: CorpusSync, blocking: bool
+) -> Optional["DefinitionSearch"]:
+    """Syncs the corpus and brings the index up to date; returns None if not `blocking` and another worker is on it"""
     Path(tex_dir).mkdir(exist_ok=True, parents=True)
-    books = download_books(tex_dir)
-    papers = download_papers(tex_dir)
-    # df = build_definition_index(patterns + extraPatterns, books, papers)
-    df = build_definition_index(extraPatterns, books, papers)
-    logger.info(f"Re-indexed, found {len(df)} patterns")
-    df.to_csv(save_file, index=False)
-    return df
+    with open(Path(tex_dir, "index.lock"), "w") as lock:
+        # Only one worker syncs and (re)builds an index; the others wait and load it, or keep serving theirs
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        engine = _load_definition_index(tex_dir, extraPatterns)
+        if engine is not None and not corpus.due():
+            return engine
+
+        try:
+            files = corpus.sync()
+        except Exception:
+            if engine is None:
+                raise
+            logger.exception("Failed to sync the definition library, keeping the current index")
+            return engine
+        manifest = corpus_manifest(files)
+        key = definition_index_key(extraPatterns, manifest)
+        pointer = _definition_index_pointer(tex_dir, extraPatterns)
+        previous = _cached_definition_index(tex_dir, extraPatterns, pointer["key"]) if pointer else None
+        if previous is not None and pointer["key"] == key:
+            return previous
+
+        logger.info("Cache miss, need to re-index...")
+        # df = build_definition_index(patterns + extraPatterns, books, papers)
+        if previous is None:
+            df = update_definition_index(extraPatterns, manifest)
+        else:
+            df = update_definition_index(extraPatterns, manifest, previous.index, pointer["files"])
+        logger.info(f"Re-indexed, found {len(df)} patterns")
+
+        path = _definition_index_path(tex_dir, extraPatterns, key)
+        _write_atomic(path, df.to_feather)
+        pointer = json.dumps(dict(key=key, files=manifest)).encode()
+        _write_atomic(Path(tex_dir, f"index.{_patterns_digest(extraPatterns)}.json"), lambda p: p.write_bytes(pointer))
+        # Indexes of these patterns over older versions of the corpus won't be used again
+        for old in Path(tex_dir).glob(f"index.{_patterns_digest(extraPatterns)}.*.feather"):
+            if old != path:
+                old.unlink(missing_ok=True)
+
+    engine = DefinitionSearch(df)
+    definition_indexes.put(key, engine, engine.nbytes)
+    return engine
 
 
 def scorer(query, match, **kwargs):
@@ -204,20 +375,92 @@ def scorer(query, match, **kwargs):
     return max([fuzz.WRatio(pat, match, **kwargs) for pat in mod_queries])
 
 
-def fuzzysearch(query: str, index: pd.DataFrame, topk: int = 20, fileid: str = ""):
-    if fileid:
-        new_index = index[index["file"].apply(lambda x: str(Path(x).name)) == fileid]
-        assert isinstance(new_index, pd.DataFrame)
-    else:
-        new_index = index[index["type"] == "book"]
-
-    # Force the query text to be in the
-    new_index = new_index[new_index["text"].apply(lambda x: query.strip().lower() in x.lower())]  # type:ignore
-
-    results = process.extract(
-        query.strip(),
-        new_index.to_dict(orient="records"),  # type:ignore
-        scorer=lambda a, b, **kwargs: fuzz.partial_token_set_ratio(a, b["text"], **kwargs),
-        limit=topk,
-    )
-    return [match for match, score, dist in results]
+class DefinitionSearch:
+    """Fuzzy search over a definition index, with everything that doesn't depend on the query worked out once
+
+    Parameters
+    ----------
+    index : pd.DataFrame
+        Definition index with columns `[file, type, line, text]`, see `build_definition_index`
+    """
+
+    def __init__(self, index: pd.DataFrame):
+        self.index = index
+        self.texts = index["text"].tolist()
+        self.lowered = [text.lower() for text in self.texts]
+        self.books = np.flatnonzero(index["type"].to_numpy() == "book")
+        rows_by_name = defaultdict(list)
+        for row, file in enumerate(index["file"]):
+            rows_by_name[str(Path(file).name)].append(row)
+        self.rows_by_name = {name: np.array(rows) for name, rows in rows_by_name.items()}
+
+        # Rows containing each character n-gram of the lowercased text
+        postings = defaultdict(list)
+        for row, text in enumerate(self.lowered):
+            for gram in {text[i : i + SEARCH_NGRAM] for i in range(len(text) - SEARCH_NGRAM + 1)}:
+                postings[gram].append(row)
+        self.postings = {gram: np.array(rows, dtype=np.int32) for gram, rows in postings.items()}
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory used by the index and the search structures"""
+        strings = sum(sys.getsizeof(text) for text in self.lowered)
+        arrays = sum(rows.nbytes for rows in self.postings.values()) + self.books.nbytes
+        arrays += sum(rows.nbytes for rows in self.rows_by_name.values())
+        # Keys and entries of the dicts
+        overhead = 100 * (len(self.postings) + len(self.rows_by_name))
+        return int(self.index.memory_usage(deep=True).sum()) + strings + arrays + overhead
+
+    def candidates(self, query: str, fileid: str = "") -> np.ndarray:
+        """Rows of `fileid` (or of books, if not given) whose lowercased text contains the lowercased query, in order"""
+        scope = self.rows_by_name.get(fileid, np.array([], dtype=np.int64)) if fileid else self.books
+        query = query.lower()
+        if len(query) >= SEARCH_NGRAM:
+            grams = sorted(
+                {query[i : i + SEARCH_NGRAM] for i in range(len(query) - SEARCH_NGRAM + 1)},
+                key=lambda gram: len(self.postings.get(gram, ())),
+            )
+            # Rows with every n-gram of the query, which is checked as a whole below
+            for gram in grams:
+                if gram not in self.postings:
+                    return np.array([], dtype=np.int64)
+                scope = np.intersect1d(scope, self.postings[gram], assume_unique=True)
+        return np.array([row for row in scope if query in self.lowered[row]], dtype=np.int64)
+
+    def search(self, query: str, topk: int = 20, fileid: str = "") -> list[dict]:
+        """Top `topk` rows containing the query, by `fuzz.partial_token_set_ratio` then by position in the index
+
+        Parameters
+        ----------
+        query : str
+            Text to look for; surrounding whitespace is ignored
+        topk : int
+            Number of results
+        fileid : str
+            Only search this file; all books if empty
+
+        Returns
+        -------
+        list[dict]
+            Matching rows of the index, best first
+        """
+        query = query.strip()
+        rows = self.candidates(query, fileid)
+        if len(rows) == 0 or topk <= 0:
+            return []
+        # The scorer is symmetric, so scoring each row against the query spreads the rows over the workers
+        scores = process.cdist(
+            [self.texts[row] for row in rows],
+            [query],
+            scorer=fuzz.partial_token_set_ratio,
+            dtype=np.float64,
+            workers=SEARCH_WORKERS,
+        )[:, 0]
+        best = rows[np.argsort(-scores, kind="stable")[:topk]]
+        return self.index.iloc[best].to_dict(orient="records")  # type:ignore
+
+
+def fuzzysearch(query: str, index: Union[DefinitionSearch, pd.DataFrame], topk: int = 20, fileid: str = ""):
+    if not isinstance(index, DefinitionSearch):
+        index = DefinitionSearch(index)
+    return index.search(query, topk=topk, fileid=fileid)
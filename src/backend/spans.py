@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+from bisect import bisect_left, insort
+
+# Markers for the annotated region, never exported as tags
+ENDPOINT_TAGS = ("begin annotation", "end annotation")
+
+Segment = tuple[int, int, list[str]]
+
+
+def compute_tag_segments(annotations: list[dict], offset: int, length: int) -> list[Segment]:
+    """Computes character-level IOB tags as runs of identical tags
+
+    Equivalent to tagging every character of every annotation (`B-<tag>` on its first character, `I-<tag>` on the
+    rest, `O` where nothing applies), but the work is proportional to the number of annotations rather than the number
+    of characters they cover. Tags at a position are listed in the order the annotations are given, duplicates
+    included.
+
+    Parameters
+    ----------
+    annotations : list[dict]
+        Annotations with `start`, `end` and `tag`; the begin/end markers are ignored
+    offset : int
+        Character index (in the file) of position 0
+    length : int
+        Number of characters to tag; anything past it is dropped
+
+    Returns
+    -------
+    list[Segment]
+        Contiguous `(start, end, tags)` runs covering `[0, length)`, with adjacent runs always differing in tags
+    """
+    spans = []
+    bounds = {0, length}
+    for idx, anno in enumerate(annotations):
+        if anno["tag"] in ENDPOINT_TAGS:
+            continue
+        start = anno["start"] - offset
+        end = min(anno["end"] - offset, length)
+        if max(start, 0) >= end:
+            continue
+        spans.append((start, end, idx, anno["tag"]))
+        bounds.update(b for b in (start, start + 1, end) if 0 <= b <= length)
+
+    by_start = sorted(spans, key=lambda s: max(s[0], 0))
+    by_end = sorted(spans, key=lambda s: s[1])
+    bounds = sorted(bounds)
+
+    segments: list[Segment] = []
+    active: list[tuple[int, int, str]] = []
+    i = j = 0
+    for pos, nxt in zip(bounds, bounds[1:]):
+        while j < len(by_end) and by_end[j][1] <= pos:
+            start, end, idx, tag = by_end[j]
+            del active[bisect_left(active, (idx, start, tag))]
+            j += 1
+        while i < len(by_start) and max(by_start[i][0], 0) <= pos:
+            start, end, idx, tag = by_start[i]
+            insort(active, (idx, start, tag))
+            i += 1
+
+        tags = [("B-" if start == pos else "I-") + tag for _, start, tag in active] or ["O"]
+        if segments and segments[-1][2] == tags:
+            segments[-1] = (segments[-1][0], nxt, tags)
+        else:
+            segments.append((pos, nxt, tags))
+    return segments
+
+
+def expand_segments(segments: list[Segment]) -> list[list[str]]:
+    """Expands runs back to one tag list per character
+
+    Characters within a run share the same list object, so this costs one pointer per character.
+    """
+    tags: list[list[str]] = []
+    for start, end, run_tags in segments:
+        tags.extend([run_tags] * (end - start))
+    return tags
+
+
+def compress_tags(tags: list[list[str]]) -> list[Segment]:
+    """Inverse of `expand_segments`: groups per-character tag lists into runs of equal tags"""
+    segments: list[Segment] = []
+    for pos, char_tags in enumerate(tags):
+        if segments and (segments[-1][2] is char_tags or segments[-1][2] == char_tags):
+            segments[-1] = (segments[-1][0], pos + 1, segments[-1][2])
+        else:
+            segments.append((pos, pos + 1, char_tags))
+    return segments
+
+
+def decode_spans(spans: list) -> list[Segment]:
+    """Runs of a compact export (see `data.export_spans`), e.g. after a JSON round trip, as segments"""
+    return [(start, end, list(tags)) for start, end, tags in spans]
+
+
+def decode_iob_tags(exported: dict) -> list[tuple[str, list[str]]]:
+    """The `iob_tags` of a compact export: each token (or character) with its tags"""
+    units = exported["tokens"] if "tokens" in exported else exported["tex"]
+    return list(zip(units, expand_segments(decode_spans(exported["spans"]))))
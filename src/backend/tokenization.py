@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from transformers import AutoTokenizer, PreTrainedTokenizer
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOKENIZER = "EleutherAI/llemma_7b"
+
+# Directory with one sub-directory per tokenizer id (e.g. `$TOKENIZER_DIR/EleutherAI/llemma_7b`)
+TOKENIZER_DIR = os.environ.get("TOKENIZER_DIR", None)
+# Never reach out to the hub, only use local files/the HF cache
+TOKENIZER_OFFLINE = os.environ.get("TOKENIZER_OFFLINE", "0") == "1"
+# Max number of distinct tokenizers resident per worker
+TOKENIZER_CACHE_SIZE = int(os.environ.get("TOKENIZER_CACHE_SIZE", 4))
+# Semicolon-separated tokenizer ids to load at startup
+TOKENIZER_PRELOAD = [t for t in os.environ.get("TOKENIZER_PRELOAD", "").split(";") if t]
+
+
+class TokenizerRegistry:
+    """Loads each tokenizer once per worker and keeps the most recently used ones resident
+
+    Parameters
+    ----------
+    max_size : int
+        Max number of tokenizers kept in memory; the least recently used one is dropped past that
+    local_dir : str, optional
+        Directory to load tokenizers from instead of the hub
+    offline : bool
+        If true, only local files are used
+    """
+
+    def __init__(self, max_size: int, local_dir: Optional[str] = None, offline: bool = False):
+        self.max_size = max_size
+        self.local_dir = local_dir
+        self.offline = offline
+        self._tokenizers: OrderedDict[str, PreTrainedTokenizer] = OrderedDict()
+        self._lock = threading.Lock()
+        self._metrics: dict[str, dict] = {}
+        self._evictions = 0
+
+    def _load(self, tokenizer_id: str) -> PreTrainedTokenizer:
+        if self.local_dir is not None and Path(self.local_dir, tokenizer_id).is_dir():
+            return AutoTokenizer.from_pretrained(Path(self.local_dir, tokenizer_id), local_files_only=True)
+        return AutoTokenizer.from_pretrained(tokenizer_id, local_files_only=self.offline)
+
+    def get(self, tokenizer_id: str) -> PreTrainedTokenizer:
+        """Returns the tokenizer for `tokenizer_id`, loading it if it isn't resident"""
+        with self._lock:
+            metrics = self._metrics.setdefault(tokenizer_id, dict(loads=0, hits=0, load_seconds=0.0))
+            if tokenizer_id in self._tokenizers:
+                self._tokenizers.move_to_end(tokenizer_id)
+                metrics["hits"] += 1
+                return self._tokenizers[tokenizer_id]
+
+            start = time.perf_counter()
+            tokenizer = self._load(tokenizer_id)
+            elapsed = time.perf_counter() - start
+            metrics["loads"] += 1
+            metrics["load_seconds"] += elapsed
+            metrics["last_load_seconds"] = elapsed
+            logger.info(f"Loaded tokenizer {tokenizer_id} in {elapsed:.2f}s")
+
+            self._tokenizers[tokenizer_id] = tokenizer
+            while len(self._tokenizers) > self.max_size:
+                evicted, _ = self._tokenizers.popitem(last=False)
+                self._evictions += 1
+                logger.info(f"Evicted tokenizer {evicted}")
+            return tokenizer
+
+    def warmup(self, tokenizer_ids: list[str]):
+        """Loads `tokenizer_ids` ahead of the first request; failures are logged, not raised"""
+        for tokenizer_id in tokenizer_ids[: self.max_size]:
+            try:
+                self.get(tokenizer_id)
+            except Exception:
+                logger.exception(f"Failed to preload tokenizer {tokenizer_id}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "resident": list(self._tokenizers.keys()),
+                "max_size": self.max_size,
+                "evictions": self._evictions,
+                "tokenizers": {k: dict(v) for k, v in self._metrics.items()},
+            }
+
+
+registry = TokenizerRegistry(TOKENIZER_CACHE_SIZE, local_dir=TOKENIZER_DIR, offline=TOKENIZER_OFFLINE)
+
+
+def get_tokenizer(tokenizer_id: str = DEFAULT_TOKENIZER) -> PreTrainedTokenizer:
+    return registry.get(tokenizer_id)
+
+
+def warmup_tokenizers():
+    registry.warmup(TOKENIZER_PRELOAD)
+
+
+def tokenizer_stats() -> dict:
+    return registry.stats()
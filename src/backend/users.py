@@ -1,9 +1,7 @@
 #!/usr/bin/env python3
 import os
-import psycopg
 from passlib.hash import bcrypt
-from psycopg.rows import dict_row
-from .data_utils import CONN_STR, query_db
+from .data_utils import get_connection, query_db
 
 hasher = bcrypt.using(13)
 
@@ -32,7 +30,7 @@ def authenticate_user(userid, plain_password):
 def add_user(userid, plain_password):
     """Adds new user"""
     hashed_pw = get_hashed_password(plain_password)
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
+    with get_connection() as conn:
         check = "SELECT userid FROM users WHERE userid = %(userid)s;"
         result = conn.execute(check, dict(userid=userid))
         if len(result.fetchall()) > 0:
@@ -40,18 +38,3 @@ def add_user(userid, plain_password):
         insert = "INSERT INTO users (userid, password) VALUES (%(userid)s, %(password)s);"
         conn.execute(insert, dict(userid=userid, password=hashed_pw))
         return True
-
-
-def init_users_db():
-    with psycopg.connect(CONN_STR, row_factory=dict_row) as conn:
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users
-            (
-                rowid SERIAL PRIMARY KEY,
-                userid TEXT,
-                password TEXT,
-                UNIQUE (userid)
-            );
-        """
-        )
@@ -0,0 +1,24 @@
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+# The backend reads these at import: keep it away from the real account and the secrets it would fetch
+os.environ["AWS_ACCESS_KEY_ID"] = "testing"
+os.environ["AWS_SECRET_ACCESS_KEY"] = "testing"
+os.environ["AWS_DEFAULT_REGION"] = "us-east-1"
+os.environ.setdefault("POSTGRES_PASSWORD", "testing")
+# Index in the test process rather than spawning workers
+os.environ["INDEX_WORKERS"] = "1"
+
+BUCKET = "tex-annotation"
+
+
+@pytest.fixture
+def s3():
+    """S3 client for a local stand-in of the bucket, with an empty `texs/` prefix"""
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
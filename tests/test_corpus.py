@@ -0,0 +1,193 @@
+import os
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from conftest import BUCKET
+from src.backend import data_utils, search
+from src.backend.corpus import CorpusSource, CorpusSync
+from src.backend.data_utils import DocumentCatalogue, TexCache
+
+
+class FakeSheet:
+    """Stand-in for the textbook sheet and Drive downloads"""
+
+    def __init__(self, books: dict[str, str]):
+        self.books = dict(books)
+        self.down = False
+        self.fetched = []
+
+    def list(self) -> dict[str, str]:
+        if self.down:
+            raise OSError("sheet unavailable")
+        # Versioned by URL, as the real sheet is
+        return {name: f"https://drive/{name}/{hash(text)}" for name, text in self.books.items()}
+
+    def fetch(self, name: str, url: str, path: Path):
+        self.fetched.append(name)
+        path.write_text(self.books[name])
+
+
+def put_paper(s3, name: str, text: str):
+    s3.put_object(Bucket=BUCKET, Key=f"texs/{name}", Body=text.encode())
+
+
+@pytest.fixture
+def papers(s3, tmp_path, monkeypatch):
+    """The paper source, listing and fetching from the moto bucket; returns the names it fetched"""
+    cache = TexCache(s3, BUCKET, str(tmp_path / "tex-cache"), 1 << 20, 60, 1 << 20)
+    monkeypatch.setattr(search, "documents", DocumentCatalogue(s3, BUCKET, 0))
+    monkeypatch.setattr(search, "tex_cache", cache)
+    monkeypatch.setattr(data_utils, "tex_cache", cache)
+
+    fetched = []
+
+    def fetch(name: str, etag: str, path: Path):
+        fetched.append(name)
+        search.fetch_paper(name, etag, path)
+
+    put_paper(s3, "p1.tex", "A group is a set with an operation.\n")
+    put_paper(s3, "p2.tex", "We define a ring to be a group with more.\n")
+    return CorpusSource("paper", search.list_papers, fetch), fetched
+
+
+BOOKS = {
+    "b1": "A field is a ring where division works.\nNothing here.\n",
+    "b2": "The kernel of a map is the set sent to zero.\n",
+    "b3": "We call a space compact if every cover has a finite subcover.\n",
+}
+
+
+def file_names(files: list[tuple[str, str]]) -> list[tuple[str, str]]:
+    return [(Path(path).name, type) for path, type in files]
+
+
+def test_sync_skips_unchanged_documents(tmp_path, papers):
+    paper_source, fetched_papers = papers
+    sheet = FakeSheet(BOOKS)
+    corpus = CorpusSync(tmp_path / "texs", [CorpusSource("book", sheet.list, sheet.fetch), paper_source], ttl=0)
+
+    files = corpus.sync()
+    assert file_names(files) == [
+        ("b1.tex", "book"),
+        ("b2.tex", "book"),
+        ("b3.tex", "book"),
+        ("p1.tex", "paper"),
+        ("p2.tex", "paper"),
+    ]
+    assert sorted(sheet.fetched) == ["b1", "b2", "b3"]
+    assert sorted(fetched_papers) == ["p1.tex", "p2.tex"]
+
+    assert corpus.sync() == files
+    assert len(sheet.fetched) == 3
+    assert len(fetched_papers) == 2
+
+
+def test_sync_changed_new_and_removed_documents(s3, tmp_path, papers):
+    paper_source, fetched_papers = papers
+    sheet = FakeSheet(BOOKS)
+    corpus = CorpusSync(tmp_path / "texs", [CorpusSource("book", sheet.list, sheet.fetch), paper_source], ttl=0)
+    corpus.sync()
+    sheet.fetched.clear()
+    fetched_papers.clear()
+
+    sheet.books["b1"] = "A field is a commutative ring where division works.\n"
+    sheet.books["b4"] = "The dual of a space is the set of its functionals.\n"
+    del sheet.books["b3"]
+    put_paper(s3, "p1.tex", "A monoid is a set with an associative operation.\n")
+    put_paper(s3, "p3.tex", "We call a map open if images of open sets are open.\n")
+    s3.delete_object(Bucket=BUCKET, Key="texs/p2.tex")
+
+    files = corpus.sync()
+    assert file_names(files) == [
+        ("b1.tex", "book"),
+        ("b2.tex", "book"),
+        ("b4.tex", "book"),
+        ("p1.tex", "paper"),
+        ("p3.tex", "paper"),
+    ]
+    assert sorted(sheet.fetched) == ["b1", "b4"]
+    assert sorted(fetched_papers) == ["p1.tex", "p3.tex"]
+    assert corpus.path("b1").read_text() == sheet.books["b1"]
+    assert corpus.path("p1.tex").read_text() == "A monoid is a set with an associative operation.\n"
+    assert not corpus.path("b3").exists()
+    assert not corpus.path("p2.tex").exists()
+
+
+def test_incremental_index_matches_full_rebuild(s3, tmp_path, papers, monkeypatch):
+    paper_source, _ = papers
+    sheet = FakeSheet(BOOKS)
+    corpus = CorpusSync(tmp_path / "texs", [CorpusSource("book", sheet.list, sheet.fetch), paper_source], ttl=0)
+    previous_manifest = search.corpus_manifest(corpus.sync())
+    previous = search.update_definition_index(search.patterns, previous_manifest)
+    assert len(previous) > 0
+
+    sheet.books["b1"] = "A field is a ring where every nonzero element is a unit.\n"
+    sheet.books["b4"] = "The dual of a space is the set of its functionals.\n"
+    del sheet.books["b2"]
+    put_paper(s3, "p3.tex", "We call a map open if images of open sets are open.\n")
+    s3.delete_object(Bucket=BUCKET, Key="texs/p1.tex")
+    manifest = search.corpus_manifest(corpus.sync())
+
+    indexed = []
+    build = search.build_definition_index
+
+    def spy(patterns, books, papers, *args, **kwargs):
+        indexed.extend(Path(path).name for path in books + papers)
+        return build(patterns, books, papers, *args, **kwargs)
+
+    monkeypatch.setattr(search, "build_definition_index", spy)
+    incremental = search.update_definition_index(search.patterns, manifest, previous, previous_manifest)
+    assert sorted(indexed) == ["b1.tex", "b4.tex", "p3.tex"]
+
+    full = search.update_definition_index(search.patterns, manifest)
+    pd.testing.assert_frame_equal(incremental, full)
+    assert {Path(file).name for file in full["file"]} >= {"b1.tex", "b4.tex", "p3.tex", "p2.tex"}
+
+
+def test_outage_keeps_the_last_manifest(tmp_path, papers):
+    paper_source, _ = papers
+    sheet = FakeSheet(BOOKS)
+    corpus = CorpusSync(tmp_path / "texs", [CorpusSource("book", sheet.list, sheet.fetch), paper_source], ttl=60)
+    files = corpus.sync()
+    recorded = corpus.manifest_path.read_text()
+    os.utime(corpus.manifest_path, (0, 0))
+    assert corpus.due()
+
+    sheet.down = True
+    with pytest.raises(OSError):
+        corpus.sync()
+    # Nothing was touched, and the failed check counts as one
+    assert corpus.manifest_path.read_text() == recorded
+    assert all(Path(path).exists() for path, _ in files)
+    assert not corpus.due()
+
+
+def test_outage_serves_the_last_index(tmp_path, papers):
+    paper_source, _ = papers
+    sheet = FakeSheet(BOOKS)
+    sources = [CorpusSource("book", sheet.list, sheet.fetch), paper_source]
+    tex_dir = str(tmp_path / "texs")
+    engine = search.download_and_index_tex(tex_dir, search.patterns, sources)
+    pointer = Path(tex_dir, f"index.{search._patterns_digest(search.patterns)}.json").read_text()
+    os.utime(Path(tex_dir, "sync.json"), (0, 0))
+
+    sheet.down = True
+    assert search.download_and_index_tex(tex_dir, search.patterns, sources) is engine
+    # Wait for the background refresh, which fails and keeps the index
+    assert search._refreshing.acquire(timeout=30)
+    search._refreshing.release()
+
+    assert Path(tex_dir, f"index.{search._patterns_digest(search.patterns)}.json").read_text() == pointer
+    assert not CorpusSync(tex_dir, sources).due()
+    assert search.download_and_index_tex(tex_dir, search.patterns, sources) is engine
+
+
+def test_outage_without_an_index_raises(tmp_path, papers):
+    paper_source, _ = papers
+    sheet = FakeSheet(BOOKS)
+    sheet.down = True
+    sources = [CorpusSource("book", sheet.list, sheet.fetch), paper_source]
+    with pytest.raises(OSError):
+        search.download_and_index_tex(str(tmp_path / "texs"), search.patterns, sources)
@@ -0,0 +1,142 @@
+import os
+import time
+from pathlib import Path
+
+from conftest import BUCKET
+from src.backend.data_utils import ByteLRUCache, DiskBudget, TexCache
+
+
+def put_tex(s3, name: str, text: str):
+    s3.put_object(Bucket=BUCKET, Key=f"texs/{name}", Body=text.encode())
+
+
+def make_cache(s3, cache_dir: Path, max_bytes: int = 1 << 20, ttl: float = 60, max_disk_bytes: int = 1 << 20):
+    return TexCache(s3, BUCKET, str(cache_dir), max_bytes, ttl, max_disk_bytes)
+
+
+def disk_bytes(root: Path) -> int:
+    return sum(path.stat().st_size for path in root.rglob("*") if path.is_file())
+
+
+def test_miss_then_memory_hit(s3, tmp_path):
+    put_tex(s3, "a.tex", "héllo")
+    cache = make_cache(s3, tmp_path)
+
+    assert cache.load("a.tex") == "héllo"
+    assert cache.load("a.tex") == "héllo"
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"], stats["disk_hits"]) == (1, 1, 0)
+
+
+def test_disk_hit_without_s3(s3, tmp_path):
+    put_tex(s3, "a.tex", "hello")
+    make_cache(s3, tmp_path).load("a.tex")
+    s3.delete_object(Bucket=BUCKET, Key="texs/a.tex")
+
+    # Another worker shares the disk tier, and trusts it until the TTL is up
+    cache = make_cache(s3, tmp_path)
+    assert cache.load("a.tex") == "hello"
+    stats = cache.stats()
+    assert (stats["misses"], stats["memory_hits"], stats["disk_hits"]) == (0, 0, 1)
+
+
+def test_revalidates_after_ttl(s3, tmp_path):
+    put_tex(s3, "a.tex", "hello")
+    cache = make_cache(s3, tmp_path, ttl=0.05)
+    cache.load("a.tex")
+    time.sleep(0.1)
+
+    # The conditional GET answers 304, so the cached copy is kept
+    assert cache.load("a.tex") == "hello"
+    stats = cache.stats()
+    assert (stats["misses"], stats["revalidated"]) == (1, 1)
+
+
+def test_changed_object_is_downloaded_again(s3, tmp_path):
+    put_tex(s3, "a.tex", "hello")
+    cache = make_cache(s3, tmp_path, ttl=0)
+    _, digest = cache.load_with_digest("a.tex")
+    put_tex(s3, "a.tex", "changed")
+
+    text, new_digest = cache.load_with_digest("a.tex")
+    assert text == "changed"
+    assert new_digest != digest
+    stats = cache.stats()
+    assert (stats["misses"], stats["revalidated"]) == (2, 0)
+
+
+def test_byte_lru_cache_evicts_least_recently_used():
+    cache = ByteLRUCache(10)
+    cache.put("a", "a", 4)
+    cache.put("b", "b", 4)
+    cache.get("a")
+    cache.put("c", "c", 4)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == "a" and cache.get("c") == "c"
+    assert (cache.nbytes, cache.evictions) == (8, 1)
+
+    # Bigger than the whole budget: never cached, and nothing is evicted for it
+    cache.put("d", "d", 11)
+    assert cache.get("d") is None
+    assert (len(cache), cache.nbytes) == (2, 8)
+
+
+def test_memory_tier_is_bounded(s3, tmp_path):
+    for i in range(3):
+        put_tex(s3, f"{i}.tex", str(i) * 1000)
+    cache = make_cache(s3, tmp_path, max_bytes=2500)
+    for i in range(3):
+        cache.load(f"{i}.tex")
+
+    stats = cache.stats()
+    assert stats["memory_bytes"] <= 2500
+    assert (stats["memory_items"], stats["memory_evictions"]) == (2, 1)
+    # The evicted copy is still on disk
+    assert cache.load("0.tex") == "0" * 1000
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_tier_is_bounded(s3, tmp_path):
+    for i in range(20):
+        put_tex(s3, f"{i}.tex", f"{i:02d}" * 500)
+    cache = make_cache(s3, tmp_path, max_bytes=0, max_disk_bytes=5000)
+    for i in range(20):
+        cache.load(f"{i}.tex")
+        # Reading an object keeps it from being pruned
+        cache.load("0.tex")
+
+    assert disk_bytes(tmp_path / "objects") <= 5000
+    assert cache.stats()["disk_evictions"] == 15
+    misses = cache.stats()["misses"]
+    assert cache.load("0.tex") == "00" * 500
+    assert cache.stats()["misses"] == misses
+
+    # A pruned object is downloaded again
+    assert cache.load("1.tex") == "01" * 500
+    assert cache.stats()["misses"] == misses + 1
+
+
+def test_disk_budget_prunes_oldest_first(tmp_path):
+    for i, name in enumerate(["a", "b", "c"]):
+        path = tmp_path / "objects" / name
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(b"x" * 60)
+        os.utime(path, (1000 + i, 1000 + i))
+
+    budget = DiskBudget(tmp_path, 100)
+    budget.prune()
+    assert sorted(path.name for path in tmp_path.rglob("*") if path.is_file()) == ["c"]
+    assert budget.evictions == 2
+
+
+def test_disk_budget_spares_temporary_files_being_written(tmp_path):
+    stale = tmp_path / "a.1.tmp"
+    stale.write_bytes(b"x" * 60)
+    os.utime(stale, (0, 0))
+    fresh = tmp_path / "b.1.tmp"
+    fresh.write_bytes(b"x" * 60)
+
+    DiskBudget(tmp_path, 10).prune()
+    assert not stale.exists()
+    assert fresh.exists()
@@ -0,0 +1,66 @@
+import os
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from src.backend.folding import fold_line, fold_mapping
+
+pytestmark = pytest.mark.skipif(
+    not all(shutil.which(tool) for tool in ("fold", "nl", "grep", "wc")), reason="needs coreutils and grep"
+)
+# folding.py follows coreutils in the C locale
+ENV = dict(os.environ, LC_ALL="C")
+
+
+def run(args: list[str], input: bytes) -> bytes:
+    return subprocess.run(args, input=input, stdout=subprocess.PIPE, env=ENV).stdout
+
+
+def pipeline_mapping(content: bytes, width: int) -> tuple[dict[int, int], int]:
+    """What `compute_fold_mapping` got out of the shell pipelines before `fold_mapping` replaced them"""
+    lines = int(run(["wc", "-l"], run(["fold", "-s", "-w", str(width)], content)).strip())
+    numbered = run(["fold", "-s", "-w", str(width)], run(["nl", "-ba", "-w2", "-s", ":::"], content))
+    old2new = {}
+    for line in run(["grep", "-oin", r"^[0-9]\+:::"], numbered).decode().splitlines():
+        new, old, *_ = line.split(":")
+        old2new[int(old)] = int(new)
+    return old2new, lines
+
+
+def random_book(rng: random.Random) -> bytes:
+    words = [b"a", b"the", b"group", b"x", b"\\mathbb{R}", b"definitionally", b"e" * 45, b"\xc3\xa9t\xc3\xa9"]
+    blanks = [b" ", b" ", b"  ", b"\t", b"\n", b"\n\n"]
+    if rng.random() < 0.3:
+        words += [b"\b", b"\r", b"a\rb", b"\t\t"]
+    if rng.random() < 0.2:
+        # nl's logical page delimiters
+        blanks += [b"\n\\:\\:\n", b"\n\\:\n", b"\n\\:\\:\\:\n"]
+    content = b"".join(rng.choice(words) + rng.choice(blanks) for _ in range(rng.randint(0, 400)))
+    if rng.random() < 0.2:
+        content = content.replace(b"\n", b"\r\n")
+    if rng.random() < 0.5:
+        content = content.rstrip(b"\n")
+    return content
+
+
+@pytest.mark.parametrize("seed", range(60))
+def test_matches_fold_and_nl(seed):
+    rng = random.Random(seed)
+    content = random_book(rng)
+    width = rng.choice([1, 2, 5, 7, 8, 10, 13, 20, 40, 80])
+
+    mapping = fold_mapping(content, width)
+    old2new, lines = pipeline_mapping(content, width)
+    assert dict(zip(mapping.old.tolist(), mapping.new.tolist())) == old2new
+    assert mapping.lines == lines
+
+
+@pytest.mark.parametrize("seed", range(60))
+def test_fold_line_matches_fold(seed):
+    rng = random.Random(seed)
+    line = random_book(rng).replace(b"\n", b" ")
+    width = rng.randint(1, 30)
+    expected = run(["fold", "-s", "-w", str(width)], line + b"\n").split(b"\n")[:-1]
+    assert fold_line(line, width) == expected
@@ -0,0 +1,64 @@
+import random
+
+import pytest
+from sklearn.metrics import f1_score, precision_score, recall_score
+from sklearn.preprocessing import MultiLabelBinarizer
+
+from src.backend.scoring import compute_annotation_score
+
+TAGS = ["definition", "theorem", "proof", "example", "name"]
+
+
+def sklearn_score(sys: list[list[str]], ref: list[list[str]], tags: list[str]) -> dict:
+    """The scoring `compute_annotation_score` replaced, with a multilabel indicator matrix per side"""
+    ref_no_prefix = [[r.replace("B-", "").replace("I-", "") for r in rs] for rs in ref]
+    sys_no_prefix = [[s.replace("B-", "").replace("I-", "") for s in ss] for ss in sys]
+    flat_ref = [r for rs in ref_no_prefix for r in rs]
+    flat_sys = [s for ss in sys_no_prefix for s in ss]
+    classes = list(set(tags).intersection(set(flat_ref).union(set(flat_sys))))
+    mlb = MultiLabelBinarizer(classes=classes)
+    ref_bin = mlb.fit_transform(ref_no_prefix)
+    sys_bin = mlb.transform(sys_no_prefix)
+    per_tag = f1_score(ref_bin, sys_bin, average=None, zero_division=0)
+    return {
+        "f1": f1_score(ref_bin, sys_bin, average="macro", zero_division=0),
+        "precision": precision_score(ref_bin, sys_bin, average="macro", zero_division=0),
+        "recall": recall_score(ref_bin, sys_bin, average="macro", zero_division=0),
+        "per_tag_f1": dict(zip(classes, per_tag.tolist())) if len(classes) > 1 else None,
+    }
+
+
+def random_rows(rng: random.Random, n: int, tags: list[str]) -> list[list[str]]:
+    """Token tags like an export's: runs of the same list, with B-/I- prefixes, `O` and tags that aren't scored"""
+    rows = []
+    while len(rows) < n:
+        picked = rng.sample(tags + ["other"], rng.randint(0, 2))
+        tags_for_run = [rng.choice(["B-", "I-"]) + tag for tag in picked] or ["O"]
+        rows.extend([tags_for_run] * rng.randint(1, 30))
+    return rows[:n]
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_sklearn_macro_scores(seed):
+    rng = random.Random(seed)
+    # Few tags make the single-class (binary) case and classes missing from one side likely
+    tags = rng.sample(TAGS, rng.choice([1, 2, len(TAGS)]))
+    n = rng.randint(1, 2000)
+    sys, ref = random_rows(rng, n, tags), random_rows(rng, n, tags)
+    if not {t[2:] for row in sys + ref for t in row} & set(tags):
+        ref[0] = ["B-" + tags[0]]
+
+    expected = sklearn_score(sys, ref, tags)
+    scores = compute_annotation_score(sys, ref, tags)
+    assert scores["f1"] == expected["f1"]
+    assert scores["precision"] == expected["precision"]
+    assert scores["recall"] == expected["recall"]
+    if expected["per_tag_f1"] is not None:
+        assert {tag: score["f1"] for tag, score in scores["per_tag"].items()} == expected["per_tag_f1"]
+
+
+def test_single_class_is_scored_as_binary():
+    # sklearn averages over both labels 0 and 1 of a lone class
+    sys = [["B-proof"], ["O"], ["O"], ["I-proof"]]
+    ref = [["B-proof"], ["I-proof"], ["O"], ["O"]]
+    assert compute_annotation_score(sys, ref, ["proof"])["f1"] == sklearn_score(sys, ref, ["proof"])["f1"] == 0.5